@@ -0,0 +1,285 @@
+import sys
+import timeit
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from NNLoss import dice_loss, ce_dice_loss, binary_hybrid_loss
+from SOASNet_basic import SOASNet
+from adamW import AdamW
+from NNUtils import ModelEMA, EWC
+from NNReparam import check_merged_strip_banks
+# ==========================================================================
+# Speed and memory benchmarks of the training building blocks.
+# Memory is the size of the tensors saved for backward, on gpu also the peak
+# allocated memory of one forward + backward.
+# ==========================================================================
+
+
+def saved_tensors_size(function, *inputs):
+    # :return: megabytes of tensors kept by autograd for the backward of function(*inputs)
+    sizes = []
+
+    def pack(tensor):
+        sizes.append(tensor.numel() * tensor.element_size())
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        function(*inputs)
+
+    return sum(sizes) / 1024 ** 2
+
+
+def measure(function, inputs, repeats):
+    # :param function: returns the loss of the inputs
+    # :param inputs: tensors, the first one requires grad
+    # :return: milliseconds of forward + backward, saved tensors MB, peak gpu MB (0 on cpu)
+    def step():
+        inputs[0].grad = None
+        function(*inputs).backward()
+        if inputs[0].is_cuda:
+            torch.cuda.synchronize()
+
+    step()
+
+    if inputs[0].is_cuda:
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        step()
+        peak = (torch.cuda.max_memory_allocated() - base) / 1024 ** 2
+    else:
+        peak = 0.0
+
+    time = timeit.timeit(step, number=repeats) / repeats * 1000
+
+    return time, saved_tensors_size(function, *inputs), peak
+
+
+def benchmark_multi_class_loss(batch=4, no_class=8, size=512, repeats=20, device='cpu'):
+    # current loss (cross-entropy on softmax outputs) against unfused cross-entropy + one-hot Dice and the fused ce_dice_loss
+    logits = torch.randn(batch, no_class, size, size, device=device, requires_grad=True)
+    labels = torch.randint(0, no_class + 1, (batch, 1, size, size), device=device)
+
+    def current(logits, labels):
+        return nn.CrossEntropyLoss(reduction='mean', ignore_index=8)(torch.softmax(logits, dim=1), labels.squeeze(1))
+
+    def unfused(logits, labels):
+        labels = labels.squeeze(1)
+        valid = (labels != 8).unsqueeze(1).float()
+        ce = nn.CrossEntropyLoss(reduction='mean', ignore_index=8)(logits, labels)
+        probs = torch.softmax(logits, dim=1) * valid
+        one_hot = F.one_hot(torch.where(labels == 8, torch.zeros_like(labels), labels), no_class).permute(0, 3, 1, 2).float() * valid
+        intersection = (probs * one_hot).sum(dim=(0, 2, 3))
+        union = probs.sum(dim=(0, 2, 3)) + one_hot.sum(dim=(0, 2, 3))
+        return ce + 1 - ((2 * intersection + 0.1) / (union + 0.1)).mean()
+
+    def logits_ce(logits, labels):
+        return nn.CrossEntropyLoss(reduction='mean', ignore_index=8)(logits, labels.squeeze(1))
+
+    def fused_ce(logits, labels):
+        return ce_dice_loss(ce_weight=1.0, dice_weight=0.0, ignore_index=8)(logits, labels)[0]
+
+    def fused(logits, labels):
+        return ce_dice_loss(ce_weight=1.0, dice_weight=1.0, ignore_index=8)(logits, labels)[0]
+
+    for name, function in [('softmax + ce (current)', current), ('ce from logits', logits_ce), ('fused ce', fused_ce), ('ce + one-hot dice', unfused), ('fused ce + dice', fused)]:
+        time, saved, peak = measure(function, [logits, labels], repeats)
+        print('{:<28} {:8.2f} ms  saved {:8.2f} MB  peak {:8.2f} MB'.format(name, time, saved, peak))
+
+
+def benchmark_binary_loss(batch=4, size=512, repeats=20, device='cpu'):
+    # current hybrid and mix-up hybrid losses against binary_hybrid_loss
+    logits = torch.randn(batch, 1, size, size, device=device, requires_grad=True)
+    labels_1 = (torch.rand(batch, 1, size, size, device=device) > 0.5).float()
+    labels_2 = (torch.rand(batch, 1, size, size, device=device) > 0.5).float()
+    lam = torch.rand(batch, device=device)
+
+    def current(logits, labels_1, labels_2, lam):
+        return dice_loss(torch.sigmoid(logits), labels_1) + nn.BCEWithLogitsLoss(reduction='mean')(logits, labels_1)
+
+    def fused(logits, labels_1, labels_2, lam):
+        return binary_hybrid_loss(logits, labels_1)
+
+    def current_mixup(logits, labels_1, labels_2, lam):
+        return (lam * dice_loss(torch.sigmoid(logits), labels_1)
+                + (1 - lam) * dice_loss(torch.sigmoid(logits), labels_2)
+                + lam * nn.BCEWithLogitsLoss(reduction='mean')(logits, labels_1)
+                + (1 - lam) * nn.BCEWithLogitsLoss(reduction='mean')(logits, labels_2)).mean()
+
+    def fused_mixup(logits, labels_1, labels_2, lam):
+        return binary_hybrid_loss(logits, labels_1, labels_2, lam)
+
+    for name, function in [('hybrid (current)', current), ('fused hybrid', fused), ('mix-up hybrid (current)', current_mixup), ('fused mix-up hybrid', fused_mixup)]:
+        time, saved, peak = measure(function, [logits, labels_1, labels_2, lam], repeats)
+        print('{:<28} {:8.2f} ms  saved {:8.2f} MB  peak {:8.2f} MB'.format(name, time, saved, peak))
+
+
+def benchmark_optimizer(width=16, depth=4, depth_limit=6, steps=10, repeats=20, device='cpu'):
+    # optimizer step of SOASNet: AdamW one parameter at a time against its multi-tensor path and torch.optim.AdamW
+    model = SOASNet(in_ch=1, width=width, depth=depth, norm='bn', n_classes=2, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit).to(device)
+    parameters = list(model.parameters())
+    gradients = [torch.randn_like(p) for p in parameters]
+    print('{} parameter tensors, {} parameters'.format(len(parameters), sum(p.numel() for p in parameters)))
+
+    def copies():
+        tensors = [p.detach().clone().requires_grad_(True) for p in parameters]
+        for tensor, gradient in zip(tensors, gradients):
+            tensor.grad = gradient.clone()
+        return tensors
+
+    for amsgrad in [False, True]:
+        # the multi-tensor path takes the same steps as the loop:
+        loop, foreach = copies(), copies()
+        loop_optimizer = AdamW(loop, lr=1e-3, weight_decay=1e-5, amsgrad=amsgrad, foreach=False)
+        foreach_optimizer = AdamW(foreach, lr=1e-3, weight_decay=1e-5, amsgrad=amsgrad, foreach=True)
+        for _ in range(steps):
+            loop_optimizer.step()
+            foreach_optimizer.step()
+        difference = max((a - b).abs().max().item() for a, b in zip(loop, foreach))
+        print('amsgrad {}: max difference loop / foreach after {} steps {:.3g}'.format(amsgrad, steps, difference))
+
+    for name, optimizer in [('adamW.AdamW loop', AdamW(copies(), lr=1e-3, weight_decay=1e-5, foreach=False)),
+                            ('adamW.AdamW foreach', AdamW(copies(), lr=1e-3, weight_decay=1e-5, foreach=True)),
+                            ('torch.optim.AdamW loop', torch.optim.AdamW(copies(), lr=1e-3, weight_decay=1e-5, foreach=False)),
+                            ('torch.optim.AdamW foreach', torch.optim.AdamW(copies(), lr=1e-3, weight_decay=1e-5, foreach=True))]:
+
+        def step():
+            optimizer.step()
+            if device == 'cuda':
+                torch.cuda.synchronize()
+
+        step()
+        # best of 5 rounds, a step is short enough to be disturbed by anything else running:
+        time = min(timeit.repeat(step, number=repeats, repeat=5)) / repeats * 1000
+        print('{:<28} {:8.3f} ms'.format(name, time))
+
+
+def benchmark_ema(width=16, depth=4, depth_limit=6, repeats=100, device='cpu'):
+    # mean teacher update of SOASNet: convolution weights one module at a time (former dynamic_ema) against ModelEMA
+    student = SOASNet(in_ch=1, width=width, depth=depth, norm='bn', n_classes=2, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit).to(device)
+    teacher = SOASNet(in_ch=1, width=width, depth=depth, norm='bn', n_classes=2, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit).to(device)
+
+    def current():
+        with torch.no_grad():
+            for module1, module2 in zip(student.modules(), teacher.modules()):
+                if isinstance(module1, nn.Conv2d):
+                    module2.weight.data = 0.99 * module2.weight.data + 0.01 * module1.weight.data
+
+    # the updates of ModelEMA cover every parameter and buffer:
+    reference = [tensor.clone() for tensor in teacher.state_dict().values()]
+    sources = [tensor.clone() for tensor in student.state_dict().values()]
+    ModelEMA(student, teacher, flatten=True).update(ratio=0.99)
+    difference = max((tensor.float() - (0.99 * old.float() + 0.01 * source.float() if tensor.is_floating_point() else source.float())).abs().max().item()
+                     for tensor, old, source in zip(teacher.state_dict().values(), reference, sources))
+    print('max difference to 0.99 * teacher + 0.01 * student over the state dict {:.3g}'.format(difference))
+
+    for name, update in [('conv weights loop (current)', current),
+                         ('ModelEMA multi-tensor', ModelEMA(student, teacher, flatten=False).update),
+                         ('ModelEMA flat buffers', ModelEMA(student, teacher, flatten=True).update)]:
+
+        def step():
+            update()
+            if device == 'cuda':
+                torch.cuda.synchronize()
+
+        step()
+        time = min(timeit.repeat(step, number=repeats, repeat=5)) / repeats * 1000
+        print('{:<28} {:8.3f} ms'.format(name, time))
+
+
+def benchmark_ewc(width=16, depth=4, depth_limit=6, size=64, samples=16, repeats=20, device='cpu'):
+    # EWC penalty + backward of SOASNet: one term per parameter tensor (former penalty) against the multi-tensor penalty
+    model = SOASNet(in_ch=1, width=width, depth=depth, norm='bn', n_classes=2, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit).to(device)
+    images = torch.randn(samples, 1, size, size, device=device)
+    labels = (torch.rand(samples, 1, size, size, device=device) > 0.5).float()
+    loader = [(images[k:k + 4], labels[k:k + 4], None) for k in range(0, samples, 4)]
+
+    start = timeit.default_timer()
+    ewc = EWC(model, loader, device, samples)
+    print('Fisher information of {} scans {:8.2f} s'.format(samples, timeit.default_timer() - start))
+
+    precision = {n: f.view_as(p) for n, p, f in zip(ewc.names, ewc.params, torch.split(ewc._precision_matrices, [p.numel() for p in ewc.params]))}
+    means = {n: m.view_as(p) for n, p, m in zip(ewc.names, ewc.params, torch.split(ewc._means, [p.numel() for p in ewc.params]))}
+
+    def current():
+        loss = 0
+        for n, p in model.named_parameters():
+            loss += (precision[n] * (p - means[n]) ** 2).sum()
+        return loss
+
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(torch.randn_like(p) * 1e-2)
+
+    # same penalty and gradients:
+    model.zero_grad()
+    current().backward()
+    gradients = [p.grad.clone() for p in ewc.params]
+    model.zero_grad()
+    ewc.penalty().backward()
+    difference = max((p.grad - gradient).abs().max().item() for p, gradient in zip(ewc.params, gradients))
+    print('penalty {:.6g} / {:.6g}, max gradient difference {:.3g}'.format(current().item(), ewc.penalty().item(), difference))
+
+    for name, penalty in [('per-tensor penalty (current)', current), ('multi-tensor penalty', ewc.penalty)]:
+
+        def step():
+            model.zero_grad()
+            penalty().backward()
+            if device == 'cuda':
+                torch.cuda.synchronize()
+
+        step()
+        time = min(timeit.repeat(step, number=repeats, repeat=5)) / repeats * 1000
+        print('{:<28} {:8.3f} ms'.format(name, time))
+
+
+def benchmark_reparam(width=16, depth=4, depth_limit=6, batch=4, size=512, repeats=10, device='cpu'):
+    # inference forward of SOASNet: summed strip-conv banks (current) against one merged conv per bank
+    model = SOASNet(in_ch=1, width=width, depth=depth, norm='bn', n_classes=2, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit).to(device)
+    merged, difference = check_merged_strip_banks(model, size=size // 4)
+    print('max output difference of the merged banks {:.3g}'.format(difference))
+
+    images = torch.randn(batch, 1, size, size, device=device)
+
+    for name, network in [('summed banks (current)', model), ('merged banks', merged)]:
+
+        def step():
+            with torch.no_grad():
+                network(images)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+
+        step()
+        time = min(timeit.repeat(step, number=repeats, repeat=5)) / repeats * 1000
+        print('{:<28} {:8.3f} ms'.format(name, time))
+
+
+if __name__ == '__main__':
+    #
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    #
+    benchmarks = sys.argv[1:] if len(sys.argv) > 1 else ['multi_class_loss', 'binary_loss', 'optimizer', 'ema', 'ewc', 'reparam']
+    #
+    if 'multi_class_loss' in benchmarks:
+        print('multi-class loss, 4 x 8 x 512 x 512 on ' + device)
+        benchmark_multi_class_loss(device=device)
+    #
+    if 'binary_loss' in benchmarks:
+        print('binary loss, 4 x 1 x 512 x 512 on ' + device)
+        benchmark_binary_loss(device=device)
+    #
+    if 'optimizer' in benchmarks:
+        print('AdamW step of SOASNet, width 16, depth 4 on ' + device)
+        benchmark_optimizer(device=device)
+    #
+    if 'ema' in benchmarks:
+        print('EMA update of SOASNet, width 16, depth 4 on ' + device)
+        benchmark_ema(device=device)
+    #
+    if 'ewc' in benchmarks:
+        print('EWC penalty of SOASNet, width 16, depth 4 on ' + device)
+        benchmark_ewc(device=device)
+    #
+    if 'reparam' in benchmarks:
+        print('inference forward of SOASNet, width 16, depth 4, 4 x 1 x 512 x 512 on ' + device)
+        benchmark_reparam(device=device)
@@ -0,0 +1,321 @@
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import hashlib
+import argparse
+import itertools
+import subprocess
+# ==========================================================================
+# Declarative experiment queue.
+# An experiment spec (json, e.g. Experiments/experiments.json) lists groups
+# of runs. Every group is expanded over its grid, folds and repeats into
+# jobs, one job being one trainSingleModel run. The local scheduler runs the
+# jobs as separate processes, as many at a time as the cpu-thread and memory
+# budgets of the node allow, each pinned to its own cores.
+#
+# Every job is identified by the hash of its full configuration:
+# - queue/finished/<hash>.json marks a finished job, it is skipped next time
+# - queue/leases/<hash>.lease is held while a job runs, so schedulers on
+#   several nodes sharing the queue folder do not run the same job twice.
+#   A lease is refreshed while its job runs, a lease not refreshed for
+#   lease_timeout seconds belongs to a dead node and is taken over.
+#
+# Usage:
+#   python Experiment_queue.py Experiments/experiments.json --threads 32 --memory 64
+#   python Experiment_queue.py Experiments/experiments.json --list
+# ==========================================================================
+
+# keys of a group which are read by the scheduler and are not training arguments:
+scheduler_keys = ('name', 'grid', 'folds', 'repeats', 'threads', 'memory')
+
+
+def expand_spec(spec):
+    # :param spec: dictionary with 'defaults' (optional) and a list of 'experiments' groups
+    # a group holds arguments of trainJob / trainSingleModel, plus:
+    # 'grid': {key: list of values}, runs the cartesian product of the lists,
+    #         a value which is a dictionary sets several arguments at once,
+    #         a model which is a list of network tags trains them together on the same batches
+    # 'folds': list of data splits, data_directory + str(fold) + '/' is used and the fold is the repeat tag
+    # 'repeats': number of repeats of each configuration (on each fold)
+    # 'threads' / 'memory': cpu threads and GB of memory reserved for each job
+    # :return: list of jobs, dictionaries with 'name', 'threads', 'memory', 'hash' and 'config'
+    jobs = []
+    #
+    for group in spec['experiments']:
+        #
+        group = dict(spec.get('defaults', {}), **group)
+        grid = group.get('grid', {})
+        keys = sorted(grid.keys())
+        folds = group.get('folds', [None])
+        repeats = group.get('repeats', 1)
+        #
+        for values in itertools.product(*[grid[key] for key in keys]):
+            #
+            config = {key: value for key, value in group.items() if key not in scheduler_keys}
+            #
+            for key, value in zip(keys, values):
+                if isinstance(value, dict):
+                    config.update(value)
+                else:
+                    config[key] = value
+            #
+            for fold in folds:
+                #
+                for repeat in range(1, repeats + 1):
+                    #
+                    job_config = dict(config)
+                    #
+                    if fold is None:
+                        job_config['repeat'] = repeat
+                    else:
+                        job_config['data_directory'] = os.path.join(config['data_directory'], str(fold)) + '/'
+                        job_config['repeat'] = fold if repeats == 1 else str(fold) + '_' + str(repeat)
+                    #
+                    jobs.append({'name': group.get('name', str(config['model'])),
+                                 'threads': group.get('threads', 4),
+                                 'memory': group.get('memory', 7),
+                                 'hash': config_hash(job_config),
+                                 'config': job_config})
+    #
+    return jobs
+
+
+def config_hash(config):
+    # :return: hash of the configuration of a job, independent of the key order
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def make_folder(folder):
+    try:
+        os.makedirs(folder)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def write_json(path, content):
+    # written to a temporary file and renamed, readers never see a partial file
+    temp_path = path + '.' + socket.gethostname() + '_' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(content, f, indent=4, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+class Lease(object):
+    # exclusive claim of a job on a shared filesystem
+    def __init__(self, folder, job_hash, lease_timeout):
+        self.path = os.path.join(folder, job_hash + '.lease')
+        self.lease_timeout = lease_timeout
+
+    def acquire(self):
+        # :return: True if the job is now ours
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+            # the lease of a dead node is renamed away first, only one node can win the rename:
+            try:
+                if time.time() - os.path.getmtime(self.path) < self.lease_timeout:
+                    return False
+                stale_path = self.path + '.' + socket.gethostname() + '_' + str(os.getpid()) + '.stale'
+                os.rename(self.path, stale_path)
+                os.remove(stale_path)
+            except OSError:
+                return False
+            return self.acquire()
+        #
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'node': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}, f)
+        return True
+
+    def refresh(self):
+        try:
+            os.utime(self.path, None)
+        except OSError:
+            pass
+
+    def release(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class Scheduler(object):
+    # runs jobs on the local node within the thread and memory budgets
+    def __init__(self, jobs, work_directory, queue_directory, threads=None, memory=None, lease_timeout=600, poll=10):
+        # :param jobs: output of expand_spec
+        # :param work_directory: working directory of the jobs, the models are saved in ../../saved_models_<log>
+        # :param queue_directory: folder shared by all nodes, holding jobs, leases, finished markers and logs
+        # :param threads: cpu threads of this node given to jobs, all cores available to the process by default
+        # :param memory: GB of memory of this node given to jobs, unlimited by default
+        # :param lease_timeout: seconds after which the lease of a job which is not refreshed is taken over
+        # :param poll: seconds between two scheduling rounds
+        self.jobs = jobs
+        self.work_directory = work_directory
+        self.queue_directory = queue_directory
+        self.lease_timeout = lease_timeout
+        self.poll = poll
+        #
+        if hasattr(os, 'sched_getaffinity'):
+            self.free_cores = sorted(os.sched_getaffinity(0))
+        else:
+            self.free_cores = list(range(os.cpu_count()))
+        #
+        if threads is not None:
+            self.free_cores = self.free_cores[:threads]
+        #
+        self.free_memory = float('inf') if memory is None else memory
+        self.running = []
+        self.failed = set()
+        #
+        for folder in ['jobs', 'leases', 'finished', 'logs']:
+            make_folder(os.path.join(queue_directory, folder))
+
+    def is_finished(self, job):
+        return os.path.isfile(os.path.join(self.queue_directory, 'finished', job['hash'] + '.json'))
+
+    def start(self, job, lease):
+        cores = self.free_cores[:job['threads']]
+        self.free_cores = self.free_cores[job['threads']:]
+        self.free_memory -= job['memory']
+        #
+        job_file = os.path.join(self.queue_directory, 'jobs', job['hash'] + '.json')
+        write_json(job_file, job)
+        #
+        env = dict(os.environ)
+        env['OMP_NUM_THREADS'] = str(len(cores))
+        env['MKL_NUM_THREADS'] = str(len(cores))
+        #
+        def pin():
+            if hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(0, cores)
+        #
+        log_file = open(os.path.join(self.queue_directory, 'logs', job['hash'] + '.log'), 'a')
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run', os.path.abspath(job_file), '--queue', os.path.abspath(self.queue_directory)],
+                                   cwd=self.work_directory, env=env, stdout=log_file, stderr=subprocess.STDOUT, preexec_fn=pin)
+        #
+        self.running.append((job, lease, process, cores, log_file))
+        print('Started {} {} on cores {}'.format(job['name'], job['hash'], cores))
+
+    def collect(self):
+        # frees the resources of the finished jobs, refreshes the leases of the running ones
+        still_running = []
+        #
+        for job, lease, process, cores, log_file in self.running:
+            #
+            if process.poll() is None:
+                lease.refresh()
+                still_running.append((job, lease, process, cores, log_file))
+                continue
+            #
+            log_file.close()
+            lease.release()
+            self.free_cores = sorted(self.free_cores + cores)
+            self.free_memory += job['memory']
+            #
+            if process.returncode == 0 and self.is_finished(job):
+                print('Finished {} {}'.format(job['name'], job['hash']))
+            else:
+                self.failed.add(job['hash'])
+                print('Failed {} {}, see {}'.format(job['name'], job['hash'], os.path.join(self.queue_directory, 'logs', job['hash'] + '.log')))
+        #
+        self.running = still_running
+
+    def run(self):
+        # :return: hashes of the jobs which failed on this node
+        while True:
+            #
+            self.collect()
+            running = set(job['hash'] for job, _, _, _, _ in self.running)
+            waiting = [job for job in self.jobs if job['hash'] not in running and job['hash'] not in self.failed and not self.is_finished(job)]
+            #
+            if len(waiting) == 0 and len(self.running) == 0:
+                break
+            #
+            for job in waiting:
+                #
+                if job['threads'] > len(self.free_cores) or job['memory'] > self.free_memory:
+                    continue
+                #
+                lease = Lease(os.path.join(self.queue_directory, 'leases'), job['hash'], self.lease_timeout)
+                #
+                if lease.acquire():
+                    # another node may have finished it between the check and the lease:
+                    if self.is_finished(job):
+                        lease.release()
+                    else:
+                        self.start(job, lease)
+            #
+            if len(self.running) == 0:
+                # every waiting job is leased by other nodes or does not fit this node:
+                if all(job['threads'] > len(self.free_cores) or job['memory'] > self.free_memory for job in waiting):
+                    print('Jobs need more threads / memory than the budget of this node.')
+                    break
+            #
+            time.sleep(self.poll)
+        #
+        return self.failed
+
+
+def run_job(job_file, queue_directory):
+    # entry point of a job process: trains, then writes the finished marker
+    with open(job_file) as f:
+        job = json.load(f)
+    #
+    import torch
+    torch.set_num_threads(job['threads'])
+    torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.benchmark = False
+    #
+    from OCT_train import trainJob
+    #
+    saved_model = trainJob(**job['config'])
+    # several saved models when several networks are trained together:
+    if isinstance(saved_model, list):
+        saved_model = [os.path.abspath(path) for path in saved_model]
+    else:
+        saved_model = os.path.abspath(saved_model)
+    #
+    write_json(os.path.join(queue_directory, 'finished', job['hash'] + '.json'), {'job': job, 'model': saved_model, 'node': socket.gethostname(), 'time': time.time()})
+
+
+if __name__ == '__main__':
+    #
+    parser = argparse.ArgumentParser(description='Run the experiments of a spec file.')
+    parser.add_argument('spec', nargs='?', help='experiment spec, e.g. Experiments/experiments.json')
+    parser.add_argument('--threads', type=int, default=None, help='cpu threads of this node for jobs, default all')
+    parser.add_argument('--memory', type=float, default=None, help='GB of memory of this node for jobs, default unlimited')
+    parser.add_argument('--queue', default=None, help='shared queue folder, default queue/ next to the spec')
+    parser.add_argument('--lease-timeout', type=float, default=600, help='seconds before the lease of a dead node is taken over')
+    parser.add_argument('--list', action='store_true', help='only list the jobs and their state')
+    parser.add_argument('--run', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    #
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    #
+    if args.run is not None:
+        run_job(args.run, args.queue)
+        sys.exit(0)
+    #
+    spec_directory = os.path.dirname(os.path.abspath(args.spec))
+    queue_directory = args.queue if args.queue is not None else os.path.join(spec_directory, 'queue')
+    #
+    with open(args.spec) as f:
+        jobs = expand_spec(json.load(f))
+    #
+    scheduler = Scheduler(jobs, work_directory=spec_directory, queue_directory=queue_directory, threads=args.threads, memory=args.memory, lease_timeout=args.lease_timeout)
+    #
+    if args.list is True:
+        for job in jobs:
+            state = 'finished' if scheduler.is_finished(job) else 'waiting'
+            print('{} {:<10} {:<30} repeat {}'.format(job['hash'], state, str(job['config']['model']) + '_' + job['name'], job['config']['repeat']))
+        sys.exit(0)
+    #
+    failed = scheduler.run()
+    #
+    print('Finished. {} failed jobs.'.format(len(failed)))
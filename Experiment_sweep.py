@@ -0,0 +1,164 @@
+import os
+import sys
+import json
+import math
+import random
+import argparse
+import itertools
+
+from Experiment_queue import config_hash, make_folder, write_json
+# ==========================================================================
+# Early-stopping sweeps over a grid of trainJob configurations.
+# Successive halving trains every configuration for a few epochs, keeps the
+# best 1 / eta of them by validation iou and trains those eta times longer,
+# until the survivors reach the full epochs. Hyperband runs several such
+# brackets, from many configurations on a small budget to a few on the full
+# budget. A configuration which is not promoted is paused, not lost: its
+# training checkpoint stays on disk and a promotion continues it from there,
+# with the lr schedule of the full epochs from the start (see stop_epoch in
+# trainSingleModel).
+#
+# The sweep state, every validation iou measured so far, is kept in
+# sweeps/<spec name>_<method>.json next to the spec, a sweep started again skips
+# every training already done.
+#
+# Usage:
+#   python Experiment_sweep.py Experiments/sweep.json
+#   python Experiment_sweep.py Experiments/sweep.json --method successive_halving
+# ==========================================================================
+
+
+def sweep_configurations(spec):
+    # :param spec: dictionary with 'defaults' (trainJob arguments, 'epochs' is the full budget) and 'grid' ({key: list of values})
+    # a grid value which is a dictionary sets several arguments at once, as in Experiment_queue.py
+    # :return: list of configurations, one per point of the grid
+    keys = sorted(spec['grid'].keys())
+    configurations = []
+    #
+    for values in itertools.product(*[spec['grid'][key] for key in keys]):
+        #
+        config = dict(spec['defaults'])
+        #
+        for key, value in zip(keys, values):
+            if isinstance(value, dict):
+                config.update(value)
+            else:
+                config[key] = value
+        # experiment names do not hold depth or depth_limit, the repeat tag keeps the checkpoints of the grid points apart:
+        config['repeat'] = 'sweep_' + config_hash(config)
+        #
+        configurations.append(config)
+    #
+    return configurations
+
+
+def rungs(min_epochs, max_epochs, eta):
+    # :return: epochs of the rungs from about min_epochs to max_epochs, max_epochs / eta^k rounded
+    # every rung is derived from max_epochs, the brackets of a sweep share them: a paused run is only ever continued
+    s = max(0, int(math.floor(math.log(max_epochs / min_epochs, eta) + 1e-9)))
+    #
+    return sorted(set(max(1, int(round(max_epochs / eta ** k))) for k in range(s, -1, -1)))
+
+
+def successive_halving(configurations, min_epochs, max_epochs, eta, train):
+    # :param configurations: configurations of the bracket
+    # :param min_epochs: epochs of the first rung, rounded to the nearest rung below, see rungs
+    # :param max_epochs: epochs of the last rung
+    # :param eta: 1 / eta of the configurations are promoted to eta times more epochs
+    # :param train: train(config, epochs) -> validation iou after that many epochs
+    # :return: list of (validation iou, configuration) of the last rung, best first
+    results = []
+    #
+    for epochs in rungs(min_epochs, max_epochs, eta):
+        #
+        if len(configurations) == 0:
+            break
+        #
+        results = sorted([(train(config, epochs), config) for config in configurations], key=lambda result: result[0], reverse=True)
+        configurations = [config for _, config in results[:max(1, len(results) // eta)]]
+    #
+    return results
+
+
+def hyperband(configurations, min_epochs, max_epochs, eta, train, seed=0):
+    # :param configurations: configurations to sample the brackets from
+    # :return: list of (validation iou, configuration) of the last rungs of all brackets, best first
+    s_max = int(math.floor(math.log(max_epochs / min_epochs, eta) + 1e-9))
+    generator = random.Random(seed)
+    results = []
+    #
+    for s in range(s_max, -1, -1):
+        # bracket s starts n configurations at max_epochs / eta^s epochs:
+        n = int(math.ceil((s_max + 1) / (s + 1) * eta ** s))
+        bracket = generator.sample(configurations, min(n, len(configurations)))
+        #
+        results += successive_halving(bracket, max_epochs / eta ** s, max_epochs, eta, train)
+    #
+    return sorted(results, key=lambda result: result[0], reverse=True)
+
+
+class Sweep(object):
+    # trains configurations for a number of epochs, memorising the validation iou in the state file
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.state = {}
+        #
+        if os.path.isfile(state_file):
+            with open(state_file) as f:
+                self.state = json.load(f)
+
+    def train(self, config, epochs):
+        # :return: validation iou of the configuration after epochs epochs
+        job_hash = config_hash(config)
+        trial = self.state.setdefault(job_hash, {'config': config, 'iou': {}})
+        #
+        if str(epochs) not in trial['iou']:
+            #
+            from OCT_train import trainJob
+            #
+            print('Training {} {} to epoch {} of {}'.format(config['model'], job_hash, epochs, config['epochs']))
+            trial['iou'][str(epochs)] = trainJob(stop_epoch=epochs, **config)
+            write_json(self.state_file, self.state)
+        #
+        print('{} {} epoch {}: val iou {:.4f}'.format(config['model'], job_hash, epochs, trial['iou'][str(epochs)]))
+        #
+        return trial['iou'][str(epochs)]
+
+
+if __name__ == '__main__':
+    #
+    parser = argparse.ArgumentParser(description='Successive halving / Hyperband sweep over the grid of a sweep spec.')
+    parser.add_argument('spec', help='sweep spec, e.g. Experiments/sweep.json')
+    parser.add_argument('--method', default=None, choices=['successive_halving', 'hyperband'], help='overrides the method of the spec')
+    args = parser.parse_args()
+    #
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    #
+    with open(args.spec) as f:
+        spec = json.load(f)
+    #
+    settings = dict({'method': 'hyperband', 'min_epochs': 5, 'eta': 3, 'seed': 0}, **spec.get('sweep', {}))
+    method = args.method if args.method is not None else settings['method']
+    #
+    spec_directory = os.path.dirname(os.path.abspath(args.spec))
+    make_folder(os.path.join(spec_directory, 'sweeps'))
+    sweep = Sweep(os.path.join(spec_directory, 'sweeps', os.path.splitext(os.path.basename(args.spec))[0] + '_' + method + '.json'))
+    # the models are saved in ../../saved_models_<log> of the working directory, as for Experiment_queue.py:
+    os.chdir(spec_directory)
+    #
+    configurations = sweep_configurations(spec)
+    max_epochs = spec['defaults']['epochs']
+    #
+    if method == 'hyperband':
+        results = hyperband(configurations, settings['min_epochs'], max_epochs, settings['eta'], sweep.train, seed=settings['seed'])
+    else:
+        results = successive_halving(configurations, settings['min_epochs'], max_epochs, settings['eta'], sweep.train)
+    #
+    best_iou, best_config = results[0]
+    print('Best configuration, val iou {:.4f}:'.format(best_iou))
+    print(json.dumps(best_config, indent=4, sort_keys=True))
+    #
+    # the best run continues from its checkpoint at the full epochs, it is saved and tested:
+    from OCT_train import trainJob
+    #
+    print('Saved model: {}'.format(trainJob(**best_config)))
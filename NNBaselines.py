@@ -3,6 +3,8 @@ import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 
+from NNCheckpoint import checkpointing_policy, run_stage
+
 
 def double_conv(in_channels, out_channels, step, norm):
     #
@@ -614,13 +616,14 @@ class MSFPAttentionUNet(nn.Module):
 
 class SegNet(nn.Module):
     #
-    def __init__(self, in_ch, width, depth, n_classes, dropout, side_output, norm='bn'):
-        #
+    def __init__(self, in_ch, width, depth, n_classes, dropout, side_output, norm='bn', checkpointing=None):
+        # checkpointing: None, 'all' or a list of 'encoder', 'decoder', see NNCheckpoint
         super(SegNet, self).__init__()
         #
         self.side_output_mode = side_output
         self.dropout_mode = dropout
         self.depth = depth
+        self.checkpointing = checkpointing_policy(checkpointing)
         #
         if n_classes == 2:
 
@@ -677,7 +680,7 @@ class SegNet(nn.Module):
 
         for i in range(len(self.encoders)):
             #
-            x, indice, shape = self.encoders[i](x)
+            x, indice, shape = run_stage(self, 'encoder', self.encoders[i], x)
             #
             encoder_features.append(x)
             encoder_indices.append(indice)
@@ -685,7 +688,7 @@ class SegNet(nn.Module):
             #
         for i in range(len(encoder_features)):
             #
-            x = self.decoders[len(encoder_features) - i - 1](x, encoder_indices[len(encoder_features) - i - 1], encoder_pool_shapes[len(encoder_features) - i - 1])
+            x = run_stage(self, 'decoder', self.decoders[len(encoder_features) - i - 1], x, encoder_indices[len(encoder_features) - i - 1], encoder_pool_shapes[len(encoder_features) - i - 1])
             #
             if self.dropout_mode is True:
                 #
@@ -0,0 +1,228 @@
+import os
+import errno
+import queue
+import random
+import threading
+import contextlib
+import torch
+import torch.nn as nn
+import numpy as np
+
+from torch.utils.checkpoint import checkpoint
+# ==========================================================================
+# Activation checkpointing for the encoder / decoder stages of the networks.
+# A checkpointed stage only keeps its inputs for backward and recomputes its
+# activations when the gradients are needed: less memory, one more forward.
+# ==========================================================================
+
+checkpointing_stages = ('encoder', 'decoder', 'strip')
+
+
+def checkpointing_policy(policy):
+    # :param policy: None or 'none', 'all', or one or a list of 'encoder', 'decoder' and 'strip'
+    # 'encoder' / 'decoder': every level of the encoder / decoder loop is recomputed as a whole
+    # 'strip': only the multi-kernel strip-conv banks of the height and width paths are recomputed
+    # :return: set of checkpointed stage tags
+    if policy is None or policy == 'none':
+        return set()
+    #
+    if policy == 'all':
+        policy = checkpointing_stages
+    elif isinstance(policy, str):
+        policy = [policy]
+    #
+    for stage in policy:
+        if stage not in checkpointing_stages:
+            raise ValueError("Invalid checkpointing stage: {}".format(stage))
+    #
+    stages = set(policy)
+    # strip banks inside a checkpointed level are already recomputed with the level:
+    if 'strip' in stages:
+        if 'encoder' not in stages:
+            stages.add('encoder_strip')
+        if 'decoder' not in stages:
+            stages.add('decoder_strip')
+    #
+    return stages
+
+
+@contextlib.contextmanager
+def frozen_batchnorm_statistics(model):
+    # the recomputation in backward must not update BN running statistics a second time,
+    # so it updates throw-away copies of the buffers instead of the buffers themselves
+    running_stats = []
+    for layer in model.modules():
+        if isinstance(layer, nn.modules.batchnorm._BatchNorm) and layer.track_running_stats is True:
+            running_stats.append((layer, layer.running_mean, layer.running_var, layer.num_batches_tracked))
+            layer.running_mean = layer.running_mean.clone()
+            layer.running_var = layer.running_var.clone()
+            layer.num_batches_tracked = layer.num_batches_tracked.clone()
+    try:
+        yield
+    finally:
+        for layer, running_mean, running_var, num_batches_tracked in running_stats:
+            layer.running_mean = running_mean
+            layer.running_var = running_var
+            layer.num_batches_tracked = num_batches_tracked
+
+
+def run_stage(model, stage, function, *inputs):
+    # :param model: network owning the stage, its checkpointing attribute holds the policy
+    # :param stage: stage tag, see checkpointing_policy
+    # :param function: module or method computing the stage
+    # :param inputs: inputs of the stage
+    # :return: outputs of the stage
+    if stage in getattr(model, 'checkpointing', ()) and model.training is True and torch.is_grad_enabled():
+        #
+        return checkpoint(function, *inputs, use_reentrant=False, context_fn=lambda: (contextlib.nullcontext(), frozen_batchnorm_statistics(model)))
+    #
+    return function(*inputs)
+
+
+# ==========================================================================
+# Resumable training checkpoints.
+# A checkpoint holds everything needed to continue a run after preemption:
+# model and optimizer states, epoch and step counters, learning rate and the
+# random number generator states. The states are copied to the cpu on the
+# training thread, then written by a background thread to a temporary file
+# which is renamed over the checkpoint, so a job killed in the middle of a
+# write always leaves the previous complete checkpoint behind.
+# ==========================================================================
+
+
+def cpu_copy(state):
+    # :param state: nested dicts / lists / tuples of tensors, e.g. a state_dict
+    # :return: same structure with every tensor copied to the cpu
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, dict):
+        return {key: cpu_copy(value) for key, value in state.items()}
+    elif isinstance(state, (list, tuple)):
+        return type(state)(cpu_copy(value) for value in state)
+    #
+    return state
+
+
+def rng_states():
+    # :return: states of python, numpy and torch random number generators
+    numpy_state = np.random.get_state()
+    states = {'python': random.getstate(),
+              'numpy': (numpy_state[0], torch.from_numpy(numpy_state[1].astype(np.int64)), numpy_state[2], numpy_state[3], numpy_state[4]),
+              'torch': torch.get_rng_state()}
+    #
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    #
+    return states
+
+
+def set_rng_states(states):
+    # :param states: output of rng_states
+    random.setstate(states['python'])
+    numpy_state = states['numpy']
+    np.random.set_state((numpy_state[0], numpy_state[1].numpy().astype(np.uint32), numpy_state[2], numpy_state[3], numpy_state[4]))
+    torch.set_rng_state(states['torch'])
+    #
+    if torch.cuda.is_available() and 'cuda' in states:
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+class TrainingCheckpoint(object):
+    # Periodic asynchronous checkpoint of one training run.
+    # Only the latest checkpoint is kept: if a write is still running when the
+    # next one is requested, the waiting (older) one is replaced by the new one.
+    def __init__(self, path, model, optimizer):
+        # :param path: checkpoint file, e.g. ../../saved_models_log/checkpoints/model_name_Checkpoint.pt
+        # :param model: network module
+        # :param optimizer: optimizer of the model
+        self.path = path
+        self.model = model
+        self.optimizer = optimizer
+        self.error = None
+        #
+        folder = os.path.dirname(path)
+        #
+        if folder != '':
+            #
+            try:
+                os.makedirs(folder)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+        #
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def _write_loop(self):
+        while True:
+            state = self.queue.get()
+            #
+            if state is None:
+                break
+            #
+            try:
+                temp_path = self.path + '.tmp'
+                #
+                with open(temp_path, 'wb') as f:
+                    torch.save(state, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                #
+                os.replace(temp_path, self.path)
+                #
+            except Exception as exc:
+                self.error = exc
+
+    def save(self, epoch, step, **extra):
+        # :param epoch: number of finished epochs, training resumes from this epoch
+        # :param step: number of finished optimizer steps
+        # :param extra: anything else needed to resume, e.g. the best validation score
+        if self.error is not None:
+            raise RuntimeError("Writing checkpoint {} failed".format(self.path)) from self.error
+        #
+        state = {'model': cpu_copy(self.model.state_dict()),
+                 'optimizer': cpu_copy(self.optimizer.state_dict()),
+                 'lr': [param_group['lr'] for param_group in self.optimizer.param_groups],
+                 'epoch': epoch,
+                 'step': step,
+                 'rng': rng_states(),
+                 'extra': cpu_copy(extra)}
+        # drop the checkpoint still waiting to be written, the new one supersedes it:
+        try:
+            self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        #
+        self.queue.put(state)
+
+    def load(self):
+        # restores model, optimizer and random states from the checkpoint if it exists
+        # :return: checkpoint dictionary without the model / optimizer states, None if there is no checkpoint
+        if not os.path.isfile(self.path):
+            return None
+        #
+        state = torch.load(self.path, map_location='cpu')
+        #
+        self.model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        #
+        for param_group, lr in zip(self.optimizer.param_groups, state['lr']):
+            param_group['lr'] = lr
+        #
+        set_rng_states(state['rng'])
+        #
+        return {'epoch': state['epoch'], 'step': state['step'], 'extra': state['extra']}
+
+    def close(self):
+        # waits until the last requested checkpoint is on disk
+        self.queue.put(None)
+        self.thread.join()
+        #
+        if self.error is not None:
+            raise RuntimeError("Writing checkpoint {} failed".format(self.path)) from self.error
+
+    def remove(self):
+        # deletes the checkpoint once the run is finished and saved, after close: a new run of the experiment starts from scratch
+        if os.path.isfile(self.path):
+            os.remove(self.path)
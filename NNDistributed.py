@@ -0,0 +1,166 @@
+import os
+import socket
+import multiprocessing.connection
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.distributed.nn.functional as distributed_functional
+# ==========================================================================
+# Data-parallel training on cpus with the gloo backend.
+# Every process trains a replica of the network on its own shard of the
+# training set, gradients are averaged by DistributedDataParallel. Processes
+# are launched locally with launch(), several nodes run one launch each with
+# the same MASTER_ADDR / MASTER_PORT and NNODES, and their own NODE_RANK.
+# ==========================================================================
+
+
+def number_of_nodes():
+    return int(os.environ.get('NNODES', 1))
+
+
+def is_main_process():
+    # :return: True on rank 0, or when training is not distributed
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+class DistributedBatchNorm2d(nn.BatchNorm2d):
+    # BatchNorm normalising with the statistics of the whole distributed batch.
+    # nn.SyncBatchNorm only runs on gpus, here the per-channel sums are all-reduced
+    # with the autograd-aware all_reduce, so the gradients flow through the shared
+    # statistics of every process as they would for a single big batch.
+    def forward(self, input):
+        #
+        if self.training is False or not dist.is_initialized() or dist.get_world_size() == 1:
+            return super(DistributedBatchNorm2d, self).forward(input)
+        #
+        channels = input.size(1)
+        # sums in float64, E[x^2] - E[x]^2 loses precision in float32:
+        count = torch.full((1,), input.numel() // channels, dtype=torch.float64, device=input.device)
+        sums = torch.cat([input.sum(dim=(0, 2, 3), dtype=torch.float64), (input * input).sum(dim=(0, 2, 3), dtype=torch.float64), count])
+        sums = distributed_functional.all_reduce(sums)
+        #
+        total = sums[-1]
+        mean = sums[:channels] / total
+        var = (sums[channels:2 * channels] / total - mean * mean).clamp(min=0)
+        #
+        if self.track_running_stats is True:
+            with torch.no_grad():
+                self.num_batches_tracked += 1
+                momentum = 1.0 / float(self.num_batches_tracked) if self.momentum is None else self.momentum
+                self.running_mean.mul_(1 - momentum).add_(mean.to(self.running_mean.dtype), alpha=momentum)
+                self.running_var.mul_(1 - momentum).add_((var * total / (total - 1).clamp(min=1)).to(self.running_var.dtype), alpha=momentum)
+        #
+        scale = torch.rsqrt(var + self.eps).to(input.dtype)
+        shift = (-mean).to(input.dtype) * scale
+        #
+        if self.affine is True:
+            scale = scale * self.weight
+            shift = shift * self.weight + self.bias
+        #
+        return input * scale.view(1, -1, 1, 1) + shift.view(1, -1, 1, 1)
+
+
+def _swap_batchnorm(module, source, target):
+    # replaces every source BatchNorm2d of the module by a target one sharing its parameters and buffers
+    for name, child in module.named_children():
+        #
+        if type(child) is source:
+            layer = target(child.num_features, eps=child.eps, momentum=child.momentum, affine=child.affine, track_running_stats=child.track_running_stats)
+            layer.load_state_dict(child.state_dict())
+            layer.train(child.training)
+            setattr(module, name, layer.to(next(iter(child.state_dict().values())).device))
+        else:
+            _swap_batchnorm(child, source, target)
+    #
+    return module
+
+
+def convert_distributed_batchnorm(model):
+    # :return: model with its BatchNorm2d layers synchronised across the processes
+    return _swap_batchnorm(model, nn.BatchNorm2d, DistributedBatchNorm2d)
+
+
+def revert_distributed_batchnorm(model):
+    # :return: model with plain BatchNorm2d layers again, e.g. before saving it
+    return _swap_batchnorm(model, DistributedBatchNorm2d, nn.BatchNorm2d)
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _worker(local_rank, processes, cores, function, args, kwargs, results):
+    rank = int(os.environ.get('NODE_RANK', 0)) * processes + local_rank
+    world_size = number_of_nodes() * processes
+    # every process gets its own share of the cores, intra-op threads do not compete:
+    if hasattr(os, 'sched_setaffinity') and len(cores) > 0:
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(max(1, len(cores)))
+    #
+    dist.init_process_group('gloo', init_method='env://', rank=rank, world_size=world_size)
+    #
+    try:
+        result = function(*args, **kwargs)
+        if rank == 0:
+            results.put(result)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(function, processes, args=(), kwargs=None):
+    # runs function(*args, **kwargs) in processes processes of this node, each in the process group
+    # :param function: training entry, it must set up its data and model for its rank
+    # :param processes: number of processes on this node
+    # :param args: positional arguments of function
+    # :param kwargs: keyword arguments of function
+    # :return: what function returns on rank 0, None on the other nodes
+    if number_of_nodes() == 1:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', str(_free_port()))
+    elif 'MASTER_ADDR' not in os.environ or 'MASTER_PORT' not in os.environ:
+        raise ValueError('MASTER_ADDR and MASTER_PORT must be set when training on several nodes.')
+    #
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = []
+    # cores split in contiguous blocks, one per process, neighbouring cores usually share a socket:
+    share = len(cores) // processes
+    #
+    # fork where available: experiment scripts have no __main__ guard, spawn would run them again
+    if 'fork' in mp.get_all_start_methods():
+        context = mp.get_context('fork')
+    else:
+        context = mp.get_context('spawn')
+    results = context.SimpleQueue()
+    workers = []
+    #
+    for local_rank in range(processes):
+        worker_cores = cores[local_rank * share:(local_rank + 1) * share] if share > 0 else cores
+        worker = context.Process(target=_worker, args=(local_rank, processes, worker_cores, function, args, kwargs or {}, results))
+        worker.start()
+        workers.append(worker)
+    #
+    # the others would wait forever in their next collective for a process which died:
+    running = list(workers)
+    failed = []
+    #
+    while len(running) > 0 and len(failed) == 0:
+        multiprocessing.connection.wait([worker.sentinel for worker in running])
+        running = [worker for worker in running if worker.exitcode is None]
+        failed = [local_rank for local_rank, worker in enumerate(workers) if worker.exitcode not in (None, 0)]
+    #
+    for worker in running:
+        worker.terminate()
+        worker.join()
+    #
+    if len(failed) > 0:
+        raise RuntimeError('Distributed training processes {} failed.'.format(failed))
+    #
+    if int(os.environ.get('NODE_RANK', 0)) == 0:
+        return results.get()
+    #
+    return None
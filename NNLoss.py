@@ -97,3 +97,161 @@ class focal_loss(nn.Module):
             return torch.mean(F_loss)
         else:
             return F_loss
+
+
+# ==========================================================================
+# Fused multi-class loss: cross-entropy with ignore_index + soft Dice from
+# logits. The forward computes one softmax (exp of logits - logsumexp) and
+# reads the probability of the target class with gather, so no one-hot
+# target and no log_softmax tensor is built. Only the probabilities are kept
+# for backward, the gradient w.r.t. the logits is computed in closed form.
+# ==========================================================================
+
+
+class _CEDiceFunction(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, logits, target, ignore_index, ce_weight, dice_weight, smooth):
+        # :param logits: N x C x H x W
+        # :param target: N x H x W, long
+        no_class = logits.size(1)
+        valid = (target != ignore_index) & (target >= 0) & (target < no_class)
+        target = torch.where(valid, target, torch.zeros_like(target)).unsqueeze(1)
+        valid = valid.unsqueeze(1).to(logits.dtype)
+        #
+        lse = torch.logsumexp(logits, dim=1, keepdim=True)
+        probs = (logits - lse).exp_()
+        log_prob_target = logits.gather(1, target) - lse
+        prob_target = torch.exp(log_prob_target) * valid
+        #
+        valid_no = valid.sum().clamp(min=1)
+        ce = -(log_prob_target * valid).sum() / valid_no
+        # per-class soft Dice, sums over the valid pixels only:
+        intersection = torch.zeros(no_class, dtype=logits.dtype, device=logits.device).scatter_add_(0, target.reshape(-1), prob_target.reshape(-1))
+        target_sum = torch.zeros(no_class, dtype=logits.dtype, device=logits.device).scatter_add_(0, target.reshape(-1), valid.reshape(-1))
+        probs_sum = torch.einsum('nchw,nhw->c', probs, valid.squeeze(1))
+        denominator = probs_sum + target_sum + smooth
+        dice = 1 - ((2 * intersection + smooth) / denominator).mean()
+        #
+        ctx.save_for_backward(probs, target, valid, prob_target, intersection, denominator, valid_no)
+        ctx.ce_weight = ce_weight
+        ctx.dice_weight = dice_weight
+        ctx.smooth = smooth
+        # the separate terms are for logging only, the backward is that of the weighted loss:
+        ctx.mark_non_differentiable(ce, dice)
+        #
+        return ce_weight * ce + dice_weight * dice, ce, dice
+
+    @staticmethod
+    def backward(ctx, grad_output, grad_ce, grad_dice):
+        # grad_ce / grad_dice are None or zero, the separate terms are not differentiable
+        probs, target, valid, prob_target, intersection, denominator, valid_no = ctx.saved_tensors
+        no_class = probs.size(1)
+        # d loss / d probs = valid * (a_c + b_c * [target == c]):
+        a = ctx.dice_weight / no_class * (2 * intersection + ctx.smooth) / denominator ** 2
+        b = -ctx.dice_weight / no_class * 2 / denominator
+        ce_scale = ctx.ce_weight * valid / valid_no
+        # softmax backward: d logits_c = probs_c * (g_c - sum_k probs_k * g_k), plus probs - one-hot for the cross-entropy
+        grad_logits = probs * a.view(1, -1, 1, 1)
+        probs_g = valid * (grad_logits.sum(dim=1, keepdim=True) + prob_target * b[target])
+        grad_logits.mul_(valid).addcmul_(probs, ce_scale - probs_g)
+        grad_logits.scatter_add_(1, target, prob_target * b[target] - ce_scale)
+        #
+        return grad_logits * grad_output, None, None, None, None, None
+
+
+class ce_dice_loss(nn.Module):
+    # multi-class loss: ce_weight * cross-entropy + dice_weight * mean soft Dice over classes
+    def __init__(self, ce_weight=1.0, dice_weight=1.0, ignore_index=8, smooth=0.1):
+        # :param ce_weight: weight of the cross-entropy, 0 for Dice only
+        # :param dice_weight: weight of the soft Dice loss, 0 for cross-entropy only
+        # :param ignore_index: pixels with this label are left out of both terms
+        # :param smooth: smoothing term of the Dice score
+        super(ce_dice_loss, self).__init__()
+        self.ce_weight = ce_weight
+        self.dice_weight = dice_weight
+        self.ignore_index = ignore_index
+        self.smooth = smooth
+
+    def forward(self, logits, target):
+        # :param logits: model outputs before softmax, N x C x H x W
+        # :param target: labels, N x H x W or N x 1 x H x W
+        # :return: weighted loss, cross-entropy, Dice loss, only the weighted loss is differentiable
+        if target.dim() == 4:
+            target = target.squeeze(1)
+        # without Dice the native cross-entropy kernel from the logits is faster:
+        if self.dice_weight == 0:
+            ce = F.cross_entropy(logits, target.long(), ignore_index=self.ignore_index)
+            return self.ce_weight * ce, ce.detach(), torch.zeros_like(ce).detach()
+        #
+        return _CEDiceFunction.apply(logits, target.long(), self.ignore_index, self.ce_weight, self.dice_weight, self.smooth)
+
+
+# ==========================================================================
+# Fused binary loss: soft Dice and BCE from logits against one target, or
+# against two mix-up targets with ratio lam, from a single sigmoid.
+# The BCE of the two targets equals the BCE of the mixed target
+# lam * y_1 + (1 - lam) * y_2, and both Dice scores only need global sums,
+# so the forward is one elementwise pass followed by reductions. Only the
+# probabilities are saved for the closed-form backward.
+# ==========================================================================
+
+
+class _BinaryHybridFunction(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, logits, labels_1, labels_2, lam, dice_weight, bce_weight, smooth):
+        # :param lam: float or 0-dim tensor, the weight of labels_1
+        probs = torch.sigmoid(logits)
+        labels = labels_1 if labels_2 is None else torch.lerp(labels_2, labels_1, lam)
+        bce = F.binary_cross_entropy_with_logits(logits, labels)
+        #
+        probs_sum = probs.sum()
+        union_1 = probs_sum + labels_1.sum() + smooth
+        dice_1 = 1 - (2 * torch.dot(probs.reshape(-1), labels_1.reshape(-1)) + smooth) / union_1
+        #
+        if labels_2 is None:
+            dice = dice_1
+            union_2 = dice_2 = None
+        else:
+            union_2 = probs_sum + labels_2.sum() + smooth
+            dice_2 = 1 - (2 * torch.dot(probs.reshape(-1), labels_2.reshape(-1)) + smooth) / union_2
+            dice = lam * dice_1 + (1 - lam) * dice_2
+        #
+        ctx.save_for_backward(probs, labels_1, labels_2, labels, union_1, union_2, dice_1, dice_2)
+        ctx.lam = lam
+        ctx.dice_weight = dice_weight
+        ctx.bce_weight = bce_weight
+        #
+        return dice_weight * dice + bce_weight * bce
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        probs, labels_1, labels_2, labels, union_1, union_2, dice_1, dice_2 = ctx.saved_tensors
+        # d dice / d probs = (1 - dice) / union - 2 * y / union, the per-pixel part is an addcmul:
+        if labels_2 is None:
+            grad_probs = torch.addcmul(ctx.dice_weight * (1 - dice_1) / union_1, labels_1, -2 * ctx.dice_weight / union_1)
+        else:
+            grad_probs = torch.addcmul(ctx.dice_weight * (ctx.lam * (1 - dice_1) / union_1 + (1 - ctx.lam) * (1 - dice_2) / union_2), labels_1, -2 * ctx.dice_weight * ctx.lam / union_1)
+            grad_probs.addcmul_(labels_2, -2 * ctx.dice_weight * (1 - ctx.lam) / union_2)
+        # sigmoid backward, then the bce gradient (probs - labels) / n:
+        grad_logits = grad_probs.mul_(probs).mul_(1 - probs)
+        grad_logits.add_(probs, alpha=ctx.bce_weight / probs.numel()).sub_(labels, alpha=ctx.bce_weight / probs.numel())
+        #
+        return grad_logits * grad_output, None, None, None, None, None, None
+
+
+def binary_hybrid_loss(logits, labels_1, labels_2=None, lam=1.0, dice_weight=1.0, bce_weight=1.0, smooth=0.1):
+    # dice_weight * Dice + bce_weight * BCE, the two terms of dice_loss and nn.BCEWithLogitsLoss
+    # :param logits: model outputs before sigmoid
+    # :param labels_1: binary labels, same shape as logits
+    # :param labels_2: labels of the second mix-up images, None without mix-up
+    # :param lam: mix-up ratio of labels_1, a float or a tensor of ratios of the batch (its mean is used)
+    # :param dice_weight: weight of the Dice loss, 0 for BCE only
+    # :param bce_weight: weight of the BCE, 0 for Dice only
+    # :param smooth: smoothing term of the Dice score
+    # :return: mean loss of the batch
+    if isinstance(lam, torch.Tensor):
+        lam = lam.mean().to(logits.dtype)
+    #
+    return _BinaryHybridFunction.apply(logits, labels_1, labels_2, lam, dice_weight, bce_weight, smooth)
@@ -76,6 +76,68 @@ def segmentation_scores(label_trues, label_preds, n_class):
     return mean_iu
 
 
+class StreamingMetrics(object):
+    # Training loss and confusion matrix accumulated on the training device over all batches of an epoch.
+    # update() only launches device kernels, nothing is copied to the host until summary(),
+    # which is called once when the metrics are reported.
+    def __init__(self, n_class, device, distributed=False):
+        # :param n_class: 2 or multi-class
+        # :param device: training device
+        # :param distributed: True to sum the metrics of all the processes in summary(), every process must call it
+        self.n_class = n_class
+        self.device = device
+        self.distributed = distributed
+        self.reset()
+
+    def reset(self):
+        # the last bin of the histogram collects the pixels with labels outside [0, n_class)
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=self.device)
+        self.hist = torch.zeros(self.n_class ** 2 + 1, dtype=torch.float64, device=self.device)
+
+    def update(self, outputs_logits, labels, loss=None, weight=None):
+        # :param outputs_logits: model outputs before sigmoid / softmax
+        # :param labels: ground truth of the same batch
+        # :param loss: loss of the batch, added to the loss sum without its graph
+        # :param weight: optional weight of each sample in the confusion matrix, e.g. lam for mix-up
+        with torch.no_grad():
+            #
+            if loss is not None:
+                self.loss_sum += loss.detach().to(torch.float64)
+            #
+            if self.n_class == 2:
+                predictions = (outputs_logits > 0).long()
+            else:
+                predictions = torch.argmax(outputs_logits, dim=1)
+            #
+            predictions = predictions.reshape(-1)
+            labels = labels.reshape(-1).long()
+            valid = (labels >= 0) & (labels < self.n_class)
+            index = torch.where(valid, self.n_class * labels + predictions, torch.full_like(labels, self.n_class ** 2))
+            #
+            if weight is None:
+                counts = torch.ones_like(index, dtype=torch.float64)
+            else:
+                counts = weight.reshape(-1, 1).to(torch.float64).expand(-1, index.numel() // weight.numel()).reshape(-1)
+            # bincount as a scatter-add, torch.bincount synchronises on cuda to size its output:
+            self.hist.scatter_add_(0, index, counts)
+
+    def summary(self, batches):
+        # :param batches: number of batches of the loss sum
+        # :return: mean loss, mean iou over classes
+        loss_sum, hist = self.loss_sum, self.hist
+        #
+        if self.distributed is True:
+            # one all-reduce of the loss sum and the histogram, the loss is averaged over the processes:
+            summed = torch.cat([loss_sum.view(1), hist])
+            torch.distributed.all_reduce(summed)
+            loss_sum, hist = summed[0] / torch.distributed.get_world_size(), summed[1:]
+        #
+        loss_sum, hist = loss_sum.item(), hist[:-1].cpu().numpy().reshape(self.n_class, self.n_class)
+        iu = np.diag(hist) / (hist.sum(axis=1) + hist.sum(axis=0) - np.diag(hist) + 1e-8)
+        #
+        return loss_sum / batches, np.nanmean(iu)
+
+
 def intersectionAndUnion(imPred, imLab, numClass):
 
     imPred = np.asarray(imPred).copy()
@@ -0,0 +1,159 @@
+import copy
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+# ==========================================================================
+# Structural re-parameterisation of the SOASNet strip-conv banks.
+# At every level the height and width paths sum the outputs of parallel
+# strip convolutions with the same stride but different kernel sizes,
+# paddings and group counts. A convolution is linear in its weights, so for
+# inference the bank is one convolution: every kernel is zero-padded into the
+# largest one, aligned by its padding, and every weight is expanded to the
+# coarsest group count of the bank with zeros outside its own groups.
+# The merged network is for inference only, it does not train like the
+# original (the zero blocks would learn).
+# ==========================================================================
+
+strip_banks = ('height_encoders_first', 'width_encoders_first', 'height_encoders', 'width_encoders', 'height_decoders', 'width_decoders')
+
+
+def dense_weight(conv):
+    # :param conv: nn.Conv2d
+    # :return: weight of the convolution without groups, out_channels x in_channels x kernel, zero outside the groups
+    weight = conv.weight.detach()
+    out_group = conv.out_channels // conv.groups
+    in_group = conv.in_channels // conv.groups
+    dense = weight.new_zeros((conv.out_channels, conv.in_channels) + tuple(conv.kernel_size))
+    #
+    for group in range(conv.groups):
+        dense[group * out_group:(group + 1) * out_group, group * in_group:(group + 1) * in_group] = weight[group * out_group:(group + 1) * out_group]
+    #
+    return dense
+
+
+def merge_convs(convs):
+    # :param convs: parallel nn.Conv2d on the same input whose outputs are summed
+    # :return: one nn.Conv2d computing the sum, wherever the outputs of the convs have the same size
+    reference = convs[0]
+    #
+    for conv in convs:
+        if conv.stride != reference.stride or conv.in_channels != reference.in_channels or conv.out_channels != reference.out_channels:
+            raise ValueError('Only convolutions with the same channels and stride can be merged.')
+        if conv.dilation != (1, 1) or conv.padding_mode != 'zeros':
+            raise ValueError('Only convolutions without dilation and with zero padding can be merged.')
+    #
+    padding = tuple(max(conv.padding[d] for conv in convs) for d in range(2))
+    # a kernel with a smaller padding starts later in the merged kernel, its taps stay on the same input pixels:
+    kernel_size = tuple(max(padding[d] - conv.padding[d] + conv.kernel_size[d] for conv in convs) for d in range(2))
+    groups = min(conv.groups for conv in convs)
+    #
+    for conv in convs:
+        if conv.groups % groups != 0:
+            raise ValueError('The group counts {} do not nest.'.format([conv.groups for conv in convs]))
+    #
+    merged = nn.Conv2d(reference.in_channels, reference.out_channels, kernel_size=kernel_size, stride=reference.stride, padding=padding, groups=groups,
+                       bias=any(conv.bias is not None for conv in convs)).to(device=reference.weight.device, dtype=reference.weight.dtype)
+    #
+    out_group = reference.out_channels // groups
+    in_group = reference.in_channels // groups
+    #
+    with torch.no_grad():
+        #
+        merged.weight.zero_()
+        #
+        for conv in convs:
+            #
+            dense = dense_weight(conv)
+            top = padding[0] - conv.padding[0]
+            left = padding[1] - conv.padding[1]
+            # the groups of a finer conv are blocks inside the coarser groups of the merged conv:
+            merged.weight[:, :, top:top + conv.kernel_size[0], left:left + conv.kernel_size[1]] += torch.cat([dense[group * out_group:(group + 1) * out_group, group * in_group:(group + 1) * in_group] for group in range(groups)])
+        #
+        if merged.bias is not None:
+            merged.bias.copy_(sum(conv.bias for conv in convs if conv.bias is not None))
+    #
+    return merged
+
+
+def merge_strip_banks(model):
+    # :param model: SOASNet network of any variant, changed in place
+    # :return: the model, every strip-conv bank replaced by one conv in the first group of the bank, the other groups set to None
+    groups = getattr(model, 'strip_bank_groups', ())
+    #
+    if model.mode != 'low_rank_attn' or len(groups) < 2 or model.strip_banks_merged is True:
+        return model
+    #
+    for bank in strip_banks:
+        #
+        names = [bank + '_group_' + str(group) for group in groups]
+        convs = [getattr(model, name, None) for name in names]
+        #
+        if any(conv is None for conv in convs):
+            continue
+        #
+        if isinstance(convs[0], nn.ModuleList):
+            merged = nn.ModuleList([merge_convs(list(level)) for level in zip(*convs)])
+        else:
+            merged = merge_convs(convs)
+        #
+        setattr(model, names[0], merged)
+        #
+        for name in names[1:]:
+            setattr(model, name, None)
+    #
+    model.strip_banks_merged = True
+    #
+    return model
+
+
+def check_merged_strip_banks(model, size=64, batch=2, tolerance=1e-4):
+    # parity of a merged copy of the model with the model, in eval mode on random scans
+    # :param size: side of the random scans, a multiple of 2^(depth + 1)
+    # :return: merged copy of the model, maximum absolute difference of the outputs
+    model = model.eval()
+    merged = merge_strip_banks(copy.deepcopy(model))
+    #
+    parameter = next(model.parameters())
+    images = torch.randn(batch, model.first_layer[0].in_channels, size, size, device=parameter.device, dtype=parameter.dtype)
+    #
+    with torch.no_grad():
+        outputs = model(images)
+        merged_outputs = merged(images)
+    #
+    # the side outputs are compared too:
+    if isinstance(outputs, tuple):
+        outputs, merged_outputs = [outputs[0]] + list(outputs[1]), [merged_outputs[0]] + list(merged_outputs[1])
+    else:
+        outputs, merged_outputs = [outputs], [merged_outputs]
+    #
+    difference = max((output - merged_output).abs().max().item() for output, merged_output in zip(outputs, merged_outputs))
+    #
+    if difference > tolerance * max(1.0, max(output.abs().max().item() for output in outputs)):
+        raise RuntimeError('The merged strip-conv banks differ from the original ones by {:.3g}.'.format(difference))
+    #
+    return merged, difference
+
+
+# ==========================================================================
+# Height and width paths in one call.
+# The width path runs on transposed features: its (1, k) strip convs with
+# stride (1, 2) are then (k, 1) strip convs with stride (2, 1) like those of
+# the height path. With the two paths concatenated along the channels, a
+# height conv and a width conv are one grouped conv with twice the groups,
+# and shared layers (the 1x1 bottlenecks, the upsampling) run once.
+# ==========================================================================
+
+
+def paired_conv(height_conv, width_conv, x):
+    # :param height_conv: nn.Conv2d of the height path
+    # :param width_conv: nn.Conv2d of the width path, as applied to non-transposed features, it can be height_conv for a shared layer
+    # :param x: height path features and transposed width path features concatenated along the channels
+    # :return: outputs of both convs concatenated along the channels, the width path output transposed
+    weight = torch.cat([height_conv.weight, torch.transpose(width_conv.weight, 2, 3)], dim=0)
+    #
+    bias = None
+    #
+    if height_conv.bias is not None:
+        bias = torch.cat([height_conv.bias, width_conv.bias], dim=0)
+    #
+    return F.conv2d(x, weight, bias, stride=height_conv.stride, padding=height_conv.padding, groups=2 * height_conv.groups)
@@ -2,6 +2,7 @@ import torch
 import random
 import numpy as np
 import os
+import json
 import torch.nn as nn
 import glob
 import tifffile as tiff
@@ -51,60 +52,433 @@ def cosine_rampdown(current, rampdown_length):
     return float(.5 * (np.cos(np.pi * current / rampdown_length) + 1))
 
 
+class ModelEMA(object):
+    # Exponential moving average of all the parameters and buffers of a model into another of the same architecture,
+    # e.g. the teacher of a mean teacher. The float tensors of each model are moved into one contiguous buffer
+    # per dtype and device, the modules keep views of it, so an update is one lerp over the whole model.
+    # Create it after moving the models to their device, .to() would replace the views.
+    def __init__(self, model1, model2, mode='static', every=1, flatten=True):
+        # :param model1: model, the student in 'static' mode
+        # :param model2: model of the same architecture, in 'static' mode the teacher following model1
+        # :param mode: 'static': model2 follows model1,
+        #              'dynamic': the model of the higher loss follows the one of the lower loss,
+        #              'average': both are set to their mean
+        # :param every: update only every this many calls of update(), the ratio is raised to this power
+        #               so the averaging horizon in steps stays the same
+        # :param flatten: False to keep the tensors apart, then an update is one multi-tensor lerp
+        self.mode = mode
+        self.every = every
+        self.calls = 0
+        #
+        tensors1 = self.tensors(model1)
+        tensors2 = self.tensors(model2)
+        #
+        if [tensor.shape for _, _, _, tensor in tensors1] != [tensor.shape for _, _, _, tensor in tensors2]:
+            raise ValueError('The models of an EMA must have the same architecture.')
+        # integer buffers, e.g. num_batches_tracked of BatchNorm, are copied instead of averaged:
+        self.integers1 = [tensor for _, _, _, tensor in tensors1 if not tensor.is_floating_point()]
+        self.integers2 = [tensor for _, _, _, tensor in tensors2 if not tensor.is_floating_point()]
+        #
+        self.floats1 = self.flatten([entry for entry in tensors1 if entry[3].is_floating_point()], flatten)
+        self.floats2 = self.flatten([entry for entry in tensors2 if entry[3].is_floating_point()], flatten)
+
+    @staticmethod
+    def tensors(model):
+        # :return: list of (module, 'parameter' or 'buffer', name, tensor) of all the parameters and buffers of the model
+        tensors = []
+        seen = set()
+        #
+        for module in model.modules():
+            #
+            for kind, members in [('parameter', module._parameters), ('buffer', module._buffers)]:
+                #
+                for name, tensor in members.items():
+                    #
+                    if tensor is None or id(tensor) in seen:
+                        continue
+                    #
+                    seen.add(id(tensor))
+                    tensors.append((module, kind, name, tensor.data if kind == 'parameter' else tensor))
+        #
+        return tensors
+
+    @staticmethod
+    def flatten(entries, flatten):
+        # :return: one contiguous buffer per dtype and device holding the tensors, the modules are given views of it
+        if flatten is False:
+            return [tensor for _, _, _, tensor in entries]
+        #
+        groups = {}
+        #
+        for entry in entries:
+            groups.setdefault((entry[3].dtype, entry[3].device), []).append(entry)
+        #
+        buffers = []
+        #
+        for group in groups.values():
+            #
+            buffer = torch.cat([tensor.reshape(-1) for _, _, _, tensor in group])
+            offset = 0
+            #
+            for module, kind, name, tensor in group:
+                #
+                view = buffer[offset:offset + tensor.numel()].view_as(tensor)
+                offset += tensor.numel()
+                #
+                if kind == 'parameter':
+                    module._parameters[name].data = view
+                else:
+                    module._buffers[name] = view
+            #
+            buffers.append(buffer)
+        #
+        return buffers
+
+    @torch.no_grad()
+    def update(self, loss1=None, loss2=None, ratio=0.99):
+        # :param loss1: loss of model1, only used in 'dynamic' mode
+        # :param loss2: loss of model2, only used in 'dynamic' mode
+        # :param ratio: weight of the old values of the following model at every step
+        self.calls += 1
+        #
+        if self.calls % self.every != 0:
+            return
+        #
+        if self.mode == 'average':
+            #
+            torch._foreach_lerp_(self.floats1, self.floats2, 0.5)
+            torch._foreach_copy_(self.floats2, self.floats1)
+            #
+            if len(self.integers1) > 0:
+                torch._foreach_copy_(self.integers2, self.integers1)
+            #
+            return
+        #
+        if self.mode == 'static' or (self.mode == 'dynamic' and loss1 <= loss2):
+            source_floats, target_floats, source_integers, target_integers = self.floats1, self.floats2, self.integers1, self.integers2
+        elif self.mode == 'dynamic':
+            source_floats, target_floats, source_integers, target_integers = self.floats2, self.floats1, self.integers2, self.integers1
+        else:
+            raise ValueError('Invalid EMA mode: {}'.format(self.mode))
+        #
+        torch._foreach_lerp_(target_floats, source_floats, 1 - ratio ** self.every)
+        #
+        if len(source_integers) > 0:
+            torch._foreach_copy_(target_integers, source_integers)
+
+
 def dynamic_ema(model1, model2, loss1, loss2, ratio, mode):
-    #
-    if mode == 'dynamic':
-        maximum_acc = min(loss1, loss2)
-        # copy the weights of the best model to others
-        if maximum_acc == loss1:
-            #
-            for conv_layer_1, conv_layer_2 in zip(model1.modules(), model2.modules()):
-                if isinstance(conv_layer_1, nn.Conv2d) and isinstance(conv_layer_2, nn.Conv2d):
-                    conv_layer_2.weight.data = (1 - ratio) * conv_layer_1.weight.data.detach() + ratio * conv_layer_2.weight.data
-                    if conv_layer_1.bias is True and conv_layer_2.bias is True:
-                        conv_layer_2.bias.data = (1 - ratio) * conv_layer_1.bias.data.detach() + ratio * conv_layer_2.bias.data
-
-        elif maximum_acc == loss2:
-            #
-            for conv_layer_1, conv_layer_2 in zip(model1.modules(), model2.modules()):
-                if isinstance(conv_layer_1, nn.Conv2d) and isinstance(conv_layer_2, nn.Conv2d):
-                    conv_layer_1.weight.data = (1 - ratio) * conv_layer_2.weight.data.detach() + ratio * conv_layer_1.weight.data
-                    if conv_layer_1.bias is True and conv_layer_2.bias is True:
-                        conv_layer_1.bias.data = (1 - ratio) * conv_layer_2.bias.data.detach() + ratio * conv_layer_1.bias.data
-
-    elif mode == 'static':
-        # model1 is always the teacher
-        # ratio_static = 0.99
-        for conv_layer_1, conv_layer_2 in zip(model1.modules(), model2.modules()):
-            if isinstance(conv_layer_1, nn.Conv2d) and isinstance(conv_layer_2, nn.Conv2d):
-                conv_layer_2.weight.data = (1 - ratio) * conv_layer_1.weight.data.detach() + ratio * conv_layer_2.weight.data
-                if conv_layer_1.bias is True and conv_layer_2.bias is True:
-                    conv_layer_2.bias.data = (1 - ratio) * conv_layer_1.bias.data.detach() + ratio * conv_layer_2.bias.data
-
-    elif mode == 'average':
-
-        for conv_layer_1, conv_layer_2 in zip(model1.modules(), model2.modules()):
-            if isinstance(conv_layer_1, nn.Conv2d) and isinstance(conv_layer_2, nn.Conv2d):
-                conv_layer_1.weight.data = (conv_layer_1.weight.data + conv_layer_2.weight.data.detach()) / 2
-                conv_layer_2.weight.data = conv_layer_1.weight.data.detach()
-                if conv_layer_1.bias is True and conv_layer_2.bias is True:
-                    conv_layer_1.bias.data = (conv_layer_1.bias.data + conv_layer_2.bias.data.detach()) / 2
-                    conv_layer_2.bias.data = conv_layer_1.bias.data.detach()
+    # one EMA update of every parameter and buffer, see ModelEMA, keep a ModelEMA for the updates of a training
+    ModelEMA(model1, model2, mode=mode, flatten=False).update(loss1, loss2, ratio)
 
 
 def create_model(model_type, device, student_mode=True):
+    # :param student_mode: True to freeze every parameter, e.g. for the teacher of a mean teacher updated by ModelEMA
     model = model_type
     model.to(device)
     if student_mode is True:
-        for layer in model.modules():
-            if isinstance(layer, nn.Conv2d):
-                layer.weight.requires_grad = False
-                if layer.bias is True:
-                    layer.bias.requires_grad = False
+        for parameter in model.parameters():
+            parameter.requires_grad = False
+    return model
+
+
+class FullBatchStatistics(object):
+    # BatchNorm over the full effective batch when gradients are accumulated over micro-batches:
+    # collect() runs one no-grad forward of the full batch, which records the batch mean / variance
+    # at the input of every BN layer and updates the running statistics once per optimizer step.
+    # Inside the with-block, BN layers normalise each micro-batch with those recorded statistics.
+    # The statistics are treated as constants in backward.
+    def __init__(self, model, enabled=True):
+        #
+        self.model = model
+        self.enabled = enabled
+        self.bn_layers = [layer for layer in model.modules() if isinstance(layer, nn.modules.batchnorm._BatchNorm)]
+        self.batch_means = {}
+        self.batch_vars = {}
+        self.running_stats = {}
+
+    def _record(self, layer, inputs):
+        #
+        x = inputs[0]
+        dims = [0] + list(range(2, x.dim()))
+        self.batch_means[layer] = x.mean(dim=dims)
+        self.batch_vars[layer] = x.var(dim=dims, unbiased=False)
+
+    def collect(self, images):
+        #
+        if self.enabled is False or len(self.bn_layers) == 0:
+            return
+        #
+        handles = [layer.register_forward_pre_hook(self._record) for layer in self.bn_layers]
+        #
+        with torch.no_grad():
+            self.model(images)
+        #
+        for handle in handles:
+            handle.remove()
+
+    def __enter__(self):
+        #
+        if self.enabled is True:
+            for layer in self.bn_layers:
+                self.running_stats[layer] = (layer.running_mean, layer.running_var)
+                layer.running_mean = self.batch_means[layer]
+                layer.running_var = self.batch_vars[layer]
+                layer.training = False
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        #
+        if self.enabled is True:
+            for layer in self.bn_layers:
+                layer.running_mean, layer.running_var = self.running_stats[layer]
+                layer.training = self.model.training
+            self.running_stats = {}
+        return False
+
+
+class MultiSeedBatchSampler(torch.utils.data.Sampler):
+    # batches of the copies trained together by StackedModels: every copy has its own shuffling of the data set, a batch
+    # holds the next batch_size indices of every copy one copy after the other. All copies run over the same number of
+    # scans, their batches always have the same size, the last one included.
+    def __init__(self, length, batch_size, seeds, shuffle=True, seed=0):
+        # :param length: size of the data set
+        # :param seeds: number of copies
+        # :param shuffle: False for the data set order for every copy
+        # :param seed: seed of the shufflings, drawn again from it with the epoch, see set_epoch
+        self.length = length
+        self.batch_size = batch_size
+        self.seeds = seeds
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        #
+        if self.shuffle is True:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed * 100003 + self.epoch)
+            orders = torch.stack([torch.randperm(self.length, generator=generator) for k in range(self.seeds)])
+        else:
+            orders = torch.arange(self.length).repeat(self.seeds, 1)
+        #
+        for start in range(0, self.length, self.batch_size):
+            yield orders[:, start:start + self.batch_size].reshape(-1).tolist()
+
+    def __len__(self):
+        return (self.length + self.batch_size - 1) // self.batch_size
+
+
+class StackedModels(object):
+    # N copies of one architecture trained together: the parameters and buffers of the copies are
+    # stacked along a new first dimension and the forward is vectorised over the copies with torch.func.vmap.
+    # The stacked parameters are ordinary leaf tensors, backward and element-wise optimisers such as AdamW
+    # then update all the copies at once and independently.
+    def __init__(self, models):
+        # :param models: list of networks of the same architecture, e.g. initialised with different seeds
+        self.models = models
+        self.params, self.buffers = torch.func.stack_module_state(models)
+        self.base = deepcopy(models[0]).to('meta')
+        self.training = True
+
+    def parameters(self):
+        return list(self.params.values())
+
+    def train(self, mode=True):
+        self.training = mode
+        self.base.train(mode)
+        return self
+
+    def eval(self):
+        return self.train(False)
+
+    def _forward(self, params, buffers, images):
+        return torch.func.functional_call(self.base, (params, buffers), (images,))
+
+    def __call__(self, images):
+        # :param images: N x batch x channel x height x width, the k-th batch goes to the k-th copy
+        # :return: N x batch x class x height x width
+        return torch.func.vmap(self._forward, randomness='different')(self.params, self.buffers, images)
+
+    def state_dict(self):
+        return {'params': self.params, 'buffers': self.buffers}
+
+    def load_state_dict(self, state):
+        with torch.no_grad():
+            for name, tensor in list(state['params'].items()) + list(state['buffers'].items()):
+                stacked = self.params[name] if name in self.params else self.buffers[name]
+                stacked.copy_(tensor)
+
+    def unstack(self):
+        # copies the stacked weights back into the individual networks
+        # :return: list of the networks
+        with torch.no_grad():
+            for k, model in enumerate(self.models):
+                for name, tensor in list(model.named_parameters()) + list(model.named_buffers()):
+                    stacked = self.params[name] if name in self.params else self.buffers[name]
+                    tensor.copy_(stacked[k])
+        return self.models
+
+
+class WeightAveraging(object):
+    # averaged weights of one training run: the mean of the top-k epochs by validation iou, or a stochastic weight
+    # average (SWA) of the epochs of the tail of the run. The snapshots are kept on the cpu. The BatchNorm statistics
+    # of averaged weights must be computed again, see recalibrate_batchnorm.
+    def __init__(self, model, mode='top_k', top_k=5):
+        # :param model: network being trained
+        # :param mode: 'top_k' or 'swa'
+        # :param top_k: number of epochs of the top-k average
+        if mode not in ('top_k', 'swa'):
+            raise ValueError('Invalid weight averaging: {}'.format(mode))
+        #
+        self.mode = mode
+        self.top_k = top_k
+        self.parameters = [p for p in model.parameters()]
+        # top-k: list of (validation iou, weights), best first; swa: running mean of the weights and the number of epochs in it
+        self.snapshots = []
+        self.average = None
+        self.count = 0
+
+    def weights(self):
+        return [p.detach().to('cpu', copy=True) for p in self.parameters]
+
+    def update(self, validate_iou=None):
+        # :param validate_iou: validation iou of the current weights, only used in 'top_k' mode
+        if self.mode == 'swa':
+            #
+            self.count += 1
+            #
+            if self.average is None:
+                self.average = self.weights()
+            else:
+                torch._foreach_lerp_(self.average, self.weights(), 1.0 / self.count)
+            #
+            return
+        # weights which do not enter the top-k are not copied:
+        if len(self.snapshots) < self.top_k or validate_iou > self.snapshots[-1][0]:
+            #
+            self.snapshots.append((float(validate_iou), self.weights()))
+            self.snapshots.sort(key=lambda snapshot: snapshot[0], reverse=True)
+            del self.snapshots[self.top_k:]
+
+    def average_into(self, model):
+        # copies the averaged weights into the network
+        # :return: number of epochs averaged, 0 when there is nothing to average and the network is unchanged
+        if self.mode == 'swa':
+            weights, count = self.average, self.count
+        elif len(self.snapshots) > 0:
+            weights = [w.clone() for w in self.snapshots[0][1]]
+            for _, snapshot in self.snapshots[1:]:
+                torch._foreach_add_(weights, snapshot)
+            torch._foreach_div_(weights, float(len(self.snapshots)))
+            count = len(self.snapshots)
+        else:
+            weights, count = None, 0
+        #
+        if count > 0:
+            with torch.no_grad():
+                for p, w in zip(model.parameters(), weights):
+                    p.copy_(w)
+        #
+        return count
+
+    def state_dict(self):
+        return {'snapshots': self.snapshots, 'average': self.average, 'count': self.count}
+
+    def load_state_dict(self, state):
+        self.snapshots = [(iou, weights) for iou, weights in state['snapshots']]
+        self.average = state['average']
+        self.count = state['count']
+
+
+def recalibrate_batchnorm(model, loader, device):
+    # BatchNorm running statistics of averaged weights: reset, then one pass over the training loader without gradients,
+    # the statistics are the cumulative average of all its batches (momentum None), as for SWA
+    bn_layers = [layer for layer in model.modules() if isinstance(layer, nn.modules.batchnorm._BatchNorm) and layer.track_running_stats is True]
+    #
+    if len(bn_layers) == 0:
+        return model
+    #
+    momenta = [layer.momentum for layer in bn_layers]
+    #
+    for layer in bn_layers:
+        layer.reset_running_stats()
+        layer.momentum = None
+    #
+    training = model.training
+    model.train()
+    #
+    with torch.no_grad():
+        for batch in loader:
+            # the mixed-up images of mix-up batches, see CustomDataset_OCT:
+            images = batch[5] if len(batch) == 7 else batch[0]
+            model(images.to(device=device, dtype=torch.float32))
+    #
+    for layer, momentum in zip(bn_layers, momenta):
+        layer.momentum = momentum
+    #
+    model.train(training)
+    #
     return model
 
 
-def getData_OCT(data_directory, train_batchsize, shuffle_mode, augmentation_train, augmentation_test):
+def resize_scale(schedule, epoch, epochs):
+    # :param schedule: list of (fraction of the epochs, scale), e.g. [(0.5, 0.25), (0.8, 0.5)]:
+    #                  quarter size for the first half of the epochs, half size until 80 %, native size after
+    # :return: scale of the training batches at this epoch
+    for fraction, scale in sorted(schedule):
+        if epoch < fraction * epochs:
+            return scale
+    #
+    return 1.0
+
+
+class BatchResize(object):
+    # Collate function of the training loader which downsamples every batch in the loader workers,
+    # for training the early epochs at a fraction of the resolution (progressive resizing).
+    # The scale is read when an epoch starts its workers, set it before iterating over the loader.
+    def __init__(self, collate_fn, square, multiple):
+        # :param collate_fn: collate function of the loader, its batches are resized
+        # :param square: True to scale both axes, for the SOASNet models which need square inputs,
+        #                otherwise only the A-scan (height) axis is scaled
+        # :param multiple: sizes are rounded to a multiple of this, e.g. 2 ** (depth + 1) for SOASNet
+        self.collate_fn = collate_fn
+        self.square = square
+        self.multiple = multiple
+        self.scale = 1.0
+
+    def __call__(self, samples):
+        batch = self.collate_fn(samples)
+        #
+        if self.scale == 1.0:
+            return batch
+        #
+        batch = list(batch)
+        height, width = batch[0].shape[-2:]
+        size = (max(self.multiple, int(round(height * self.scale / self.multiple)) * self.multiple), width)
+        #
+        if self.square is True:
+            size = (size[0], size[0])
+        # batches are (images, labels, names) or for mix-up (images_1, labels_1, names_1, images_2, labels_2, mixed_up_image, lam):
+        images, labels = ([0], [1]) if len(batch) == 3 else ([0, 3, 5], [1, 4])
+        #
+        for i in images:
+            # area averaging keeps the intensities of the A-scans which are merged:
+            batch[i] = F.interpolate(batch[i], size=size, mode='area')
+        #
+        for i in labels:
+            batch[i] = F.interpolate(batch[i].float(), size=size, mode='nearest').to(batch[i].dtype)
+        #
+        return tuple(batch)
+
+
+def getData_OCT(data_directory, train_batchsize, shuffle_mode, augmentation_train, augmentation_test, rank=0, world_size=1):
+    # :param train_batchsize: batch size of each optimizer step, split over the processes when distributed
+    # :param rank: rank of this process in distributed training
+    # :param world_size: number of processes, each one loads only its own shard of the training set
 
     train_image_folder = data_directory + 'train/images'
     train_label_folder = data_directory + 'train/masks'
@@ -125,7 +499,19 @@ def getData_OCT(data_directory, train_batchsize, shuffle_mode, augmentation_trai
 
     num_cores = 4
 
-    trainloader = data.DataLoader(train_dataset, batch_size=train_batchsize, shuffle=shuffle_mode, num_workers=2*num_cores, drop_last=False)
+    if world_size > 1:
+
+        if train_batchsize % world_size != 0:
+            raise ValueError('Batch size {} is not divisible by {} processes.'.format(train_batchsize, world_size))
+
+        # the sampler shuffles, set_epoch() of the sampler gives a new order every epoch:
+        train_sampler = data.distributed.DistributedSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=shuffle_mode)
+
+        trainloader = data.DataLoader(train_dataset, batch_size=train_batchsize // world_size, sampler=train_sampler, num_workers=max(1, 2*num_cores // world_size), drop_last=False)
+
+    else:
+
+        trainloader = data.DataLoader(train_dataset, batch_size=train_batchsize, shuffle=shuffle_mode, num_workers=2*num_cores, drop_last=False)
     valloader = data.DataLoader(validate_dataset, batch_size=2, shuffle=False, num_workers=2, drop_last=False)
 
     return trainloader, train_dataset, valloader, test_dataset_1, test_dataset_2
@@ -133,23 +519,30 @@ def getData_OCT(data_directory, train_batchsize, shuffle_mode, augmentation_trai
 
 class CustomDataset_OCT(torch.utils.data.Dataset):
 
-    def __init__(self, imgs_folder, labels_folder, teacher_student, transforms):
+    def __init__(self, imgs_folder, labels_folder, teacher_student, transforms, image_files=None, label_files=None):
 
         # 1. Initialize file paths or a list of file names.
+        # image_files / label_files: lists of paired files used instead of the folders, e.g. a manifest of scans
         self.imgs_folder = imgs_folder
         self.labels_folder = labels_folder
         self.transform = transforms
         self.teacher_student = teacher_student
+        self.image_files = image_files
+        self.label_files = label_files
 
     def __getitem__(self, index):
         # 1. Read one data from file (e.g. using numpy.fromfile, PIL.Image.open).
         # 2. Preprocess the data (e.g. torchvision.Transform).
         # 3. Return a data pair (e.g. image and label).
-        all_images = glob.glob(os.path.join(self.imgs_folder, '*.jpg'))
-        all_labels = glob.glob(os.path.join(self.labels_folder, '*.npy'))
-        # sort all in the same order, very important
-        all_labels.sort()
-        all_images.sort()
+        if self.image_files is not None:
+            all_images = self.image_files
+            all_labels = self.label_files
+        else:
+            all_images = glob.glob(os.path.join(self.imgs_folder, '*.jpg'))
+            all_labels = glob.glob(os.path.join(self.labels_folder, '*.npy'))
+            # sort all in the same order, very important
+            all_labels.sort()
+            all_images.sort()
 
         image = imageio.imread(all_images[index])
         image = np.array(image, dtype='float32')
@@ -269,9 +662,336 @@ class CustomDataset_OCT(torch.utils.data.Dataset):
 
     def __len__(self):
         # You should change 0 to the total size of your dataset.
+        if self.image_files is not None:
+            return len(self.image_files)
         return len(glob.glob(os.path.join(self.imgs_folder, '*.jpg')))
 
 
+class UnlabelledDataset_OCT(torch.utils.data.Dataset):
+    # B-scans without masks for semi-supervised training, every item is two perturbations of the same scan:
+    # the perturbations are photometric only, so the predictions of both views stay aligned pixel by pixel
+    def __init__(self, imgs_folder):
+        # the pool is large, the file names are listed once instead of at every item:
+        self.all_images = sorted(glob.glob(os.path.join(imgs_folder, '*.jpg')))
+
+    def perturbation(self, image):
+        # random intensity ratio and Gaussian noise, clipped to the intensity range of the scans
+        noisy = image * random.uniform(0.8, 1.0) + np.random.normal(0.0, 0.15, image.shape).astype('float32')
+        return np.clip(noisy, 0.0, max(float(image.max()), 1.0))
+
+    def __getitem__(self, index):
+        image = imageio.imread(self.all_images[index])
+        image = np.array(image, dtype='float32')
+        #
+        if len(image.shape) == 3:
+            image = image[:, :, 0]
+        #
+        image = image.reshape(1, image.shape[0], image.shape[1])
+        #
+        imagename = os.path.splitext(os.path.basename(self.all_images[index]))[0]
+        #
+        return self.perturbation(image), self.perturbation(image), imagename
+
+    def __len__(self):
+        return len(self.all_images)
+
+
+def getData_unlabelled_OCT(data_directory, batchsize, rank=0, world_size=1):
+    # :param data_directory: folder of the unlabelled scans, images/*.jpg
+    # :param batchsize: unlabelled scans of each optimizer step, split over the processes when distributed
+    # :return: loader of (student view, teacher view, name) batches, shuffled, see stream_batches
+    unlabelled_dataset = UnlabelledDataset_OCT(data_directory + 'images')
+    #
+    if len(unlabelled_dataset) == 0:
+        raise ValueError('No unlabelled scans in {}'.format(data_directory + 'images'))
+    #
+    if world_size > 1:
+        #
+        if batchsize % world_size != 0:
+            raise ValueError('Unlabelled batch size {} is not divisible by {} processes.'.format(batchsize, world_size))
+        #
+        sampler = data.distributed.DistributedSampler(unlabelled_dataset, num_replicas=world_size, rank=rank, shuffle=True)
+        #
+        return data.DataLoader(unlabelled_dataset, batch_size=batchsize // world_size, sampler=sampler, num_workers=max(1, 4 // world_size), drop_last=True)
+    #
+    return data.DataLoader(unlabelled_dataset, batch_size=batchsize, shuffle=True, num_workers=4, drop_last=True)
+
+
+def stream_batches(loader):
+    # endless batches of a loader, reshuffled at every pass: an epoch of the labelled set only sees part of a large unlabelled pool
+    passes = 0
+    #
+    while True:
+        #
+        if isinstance(loader.sampler, data.distributed.DistributedSampler):
+            loader.sampler.set_epoch(passes)
+        #
+        for batch in loader:
+            yield batch
+        #
+        passes += 1
+
+
+def freeze_encoder(model, images):
+    # freezes the parameters used by model.encode, found in the autograd graph of one run of it
+    # (module hooks would miss the strip convs of SOASNet, which run through NNReparam.paired_conv)
+    # :param model: network with encode / decode methods, e.g. SOASNet or UNet
+    # :param images: a batch of scans
+    # :return: list of the parameters left trainable, those of the decoder and the output layer
+    parameters = [parameter for parameter in model.parameters() if parameter.requires_grad]
+    features = [feature for feature in model.encode(images) if feature.requires_grad]
+    #
+    gradients = torch.autograd.grad(sum(feature.sum() for feature in features), parameters, allow_unused=True)
+    #
+    for parameter, gradient in zip(parameters, gradients):
+        if gradient is not None:
+            parameter.requires_grad = False
+    #
+    return [parameter for parameter in model.parameters() if parameter.requires_grad]
+
+
+class CachedFeatures_OCT(torch.utils.data.Dataset):
+    # features of the frozen encoder of a network over a data set, computed once and kept in memory-mapped .npy files,
+    # one per feature level, with the labels. Items are (list of features, label, name), as the input of model.decode.
+    # A cache folder built from the same model file and scans in the same dtype is reused, it is rebuilt otherwise.
+    def __init__(self, model, dataset, cache_folder, device, dtype='float16', batch_size=4, model_file=None):
+        # :param model: network with encode / decode methods
+        # :param dataset: CustomDataset_OCT without random augmentation, a cached epoch sees the same features every time
+        # :param cache_folder: folder of the .npy files
+        # :param dtype: 'float16' halves the size of the cache and the reading time, 'float32' keeps the features exact
+        # :param batch_size: batch size of the encoder forwards filling the cache
+        # :param model_file: file the model was loaded from, its size and modification time tell a retrained model apart
+        self.cache_folder = cache_folder
+        index_file = os.path.join(cache_folder, 'index.json')
+        #
+        index = None
+        #
+        if os.path.isfile(index_file):
+            with open(index_file) as f:
+                index = json.load(f)
+        #
+        source = self.source(dataset, model_file)
+        #
+        if index is None or index['count'] != len(dataset) or index['dtype'] != dtype or index.get('source') != source:
+            index = self.build(model, dataset, device, dtype, batch_size, source)
+        #
+        self.names = index['names']
+        self.features = [np.load(os.path.join(cache_folder, 'features_' + str(level) + '.npy'), mmap_mode='r') for level in range(index['levels'])]
+        self.labels = np.load(os.path.join(cache_folder, 'labels.npy'), mmap_mode='r')
+
+    @staticmethod
+    def source(dataset, model_file):
+        # :return: what the cached features depend on besides the dtype, stored in index.json
+        if dataset.image_files is not None:
+            images = [os.path.abspath(image) for image in dataset.image_files]
+            labels = [os.path.abspath(label) for label in dataset.label_files]
+        else:
+            images = sorted(os.path.abspath(image) for image in glob.glob(os.path.join(dataset.imgs_folder, '*.jpg')))
+            labels = sorted(os.path.abspath(label) for label in glob.glob(os.path.join(dataset.labels_folder, '*.npy')))
+        #
+        model = None
+        #
+        if model_file is not None:
+            model = {'path': os.path.abspath(model_file), 'size': os.path.getsize(model_file), 'mtime': os.path.getmtime(model_file)}
+        #
+        return {'model': model, 'images': images, 'labels': labels}
+
+    def build(self, model, dataset, device, dtype, batch_size, source):
+        # runs the encoder over the data set and writes the cache, the index is written last and marks it complete
+        try:
+            os.makedirs(self.cache_folder)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        # a build stopped half way must not leave the index of the previous cache next to the new features:
+        if os.path.isfile(os.path.join(self.cache_folder, 'index.json')):
+            os.remove(os.path.join(self.cache_folder, 'index.json'))
+        #
+        loader = data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=2, drop_last=False)
+        training = model.training
+        model.eval()
+        #
+        files = None
+        names = []
+        offset = 0
+        #
+        with torch.no_grad():
+            #
+            for images, labels, imagenames in loader:
+                #
+                features = model.encode(images.to(device=device, dtype=torch.float32))
+                #
+                if files is None:
+                    files = [np.lib.format.open_memmap(os.path.join(self.cache_folder, 'features_' + str(level) + '.npy'), mode='w+', dtype=dtype, shape=(len(dataset),) + tuple(feature.shape[1:])) for level, feature in enumerate(features)]
+                    files.append(np.lib.format.open_memmap(os.path.join(self.cache_folder, 'labels.npy'), mode='w+', dtype='float32', shape=(len(dataset),) + tuple(labels.shape[1:])))
+                #
+                for cache_file, feature in zip(files, features + [labels]):
+                    cache_file[offset:offset + images.size(0)] = feature.cpu().numpy()
+                #
+                names += list(imagenames)
+                offset += images.size(0)
+        #
+        for cache_file in files:
+            cache_file.flush()
+        #
+        model.train(training)
+        #
+        index = {'count': len(dataset), 'dtype': dtype, 'levels': len(files) - 1, 'names': names, 'source': source}
+        #
+        with open(os.path.join(self.cache_folder, 'index.json'), 'w') as f:
+            json.dump(index, f)
+        #
+        return index
+
+    def __getitem__(self, index):
+        features = [torch.from_numpy(np.array(feature[index], dtype='float32')) for feature in self.features]
+        #
+        return features, torch.from_numpy(np.array(self.labels[index])), self.names[index]
+
+    def __len__(self):
+        return len(self.names)
+
+
+class DistillationDataset_OCT(torch.utils.data.Dataset):
+    # training set with reproducible augmentation and the logits of a teacher network on every augmented scan.
+    # Augmented pass p of scan i is drawn with the random generators seeded by (seed, p, i), so the teacher runs once
+    # over passes augmented copies of the training set, its logits are cached in a memory-mapped file, and the epochs
+    # of the student cycle over the same copies. Items are (image, label, name, teacher logits).
+    # The logits are stored as float16, or as uint8 with an offset and a step per scan.
+    def __init__(self, dataset, teacher, cache_folder, device, passes=4, dtype='uint8', batch_size=4, seed=0, teacher_file=None):
+        # :param dataset: CustomDataset_OCT of the training set with its augmentation, mix-up is not supported
+        # :param teacher: trained network giving the soft targets
+        # :param cache_folder: folder of the cache, reused when it was built from the same teacher file, training scans,
+        #                      augmentation seed and number of passes in the same dtype, rebuilt otherwise
+        # :param teacher_file: file the teacher was loaded from, its size and modification time tell a retrained teacher apart
+        # :param passes: augmented copies of the training set, epoch e of the student sees copy e % passes
+        # :param dtype: 'uint8' or 'float16'
+        # :param batch_size: batch size of the teacher forwards filling the cache
+        self.dataset = dataset
+        self.passes = passes
+        self.seed = seed
+        # None while the cache is built, then the augmented copy of the current epoch, see set_epoch:
+        self.pass_index = None
+        #
+        index_file = os.path.join(cache_folder, 'index.json')
+        index = None
+        #
+        if os.path.isfile(index_file):
+            with open(index_file) as f:
+                index = json.load(f)
+        #
+        source = self.source(teacher_file)
+        #
+        if index is None or index['count'] != passes * len(dataset) or index['dtype'] != dtype or index.get('source') != source:
+            self.build(teacher, cache_folder, device, dtype, batch_size, source)
+        #
+        self.dtype = dtype
+        self.logits = np.load(os.path.join(cache_folder, 'logits.npy'), mmap_mode='r')
+        self.scales = np.load(os.path.join(cache_folder, 'scales.npy'), mmap_mode='r')
+        self.pass_index = 0
+
+    def source(self, teacher_file):
+        # :return: what the cached logits depend on besides the dtype, stored in index.json
+        if self.dataset.image_files is not None:
+            images = [os.path.abspath(image) for image in self.dataset.image_files]
+        else:
+            images = sorted(os.path.abspath(image) for image in glob.glob(os.path.join(self.dataset.imgs_folder, '*.jpg')))
+        #
+        teacher = None
+        #
+        if teacher_file is not None:
+            teacher = {'path': os.path.abspath(teacher_file), 'size': os.path.getsize(teacher_file), 'mtime': os.path.getmtime(teacher_file)}
+        #
+        return {'teacher': teacher, 'images': images, 'transforms': self.dataset.transform, 'passes': self.passes, 'seed': self.seed}
+
+    def set_epoch(self, epoch):
+        # the workers of a loader are started again every epoch and see the new copy, loaders must not keep persistent workers
+        self.pass_index = epoch % self.passes
+
+    def augmented(self, pass_index, index):
+        # item of the data set with the augmentation drawn for pass_index, the random generators are left as they were
+        python_state, numpy_state = random.getstate(), np.random.get_state()
+        seed = (self.seed * self.passes + pass_index) * len(self.dataset) + index
+        random.seed(seed)
+        np.random.seed(seed % 2 ** 32)
+        #
+        try:
+            return self.dataset[index]
+        finally:
+            random.setstate(python_state)
+            np.random.set_state(numpy_state)
+
+    @staticmethod
+    def quantize(logits, dtype):
+        # :return: quantized logits, per scan offset and step (0 and 1 for float16)
+        if dtype == 'float16':
+            return logits.half(), torch.stack([torch.zeros(logits.size(0)), torch.ones(logits.size(0))], dim=1)
+        #
+        low = logits.amin(dim=(1, 2, 3))
+        step = (logits.amax(dim=(1, 2, 3)) - low).clamp(min=1e-8) / 255
+        quantized = ((logits - low.view(-1, 1, 1, 1)) / step.view(-1, 1, 1, 1)).round_().clamp_(0, 255).to(torch.uint8)
+        #
+        return quantized, torch.stack([low, step], dim=1)
+
+    def build(self, teacher, cache_folder, device, dtype, batch_size, source):
+        # runs the teacher over every augmented copy and writes the cache, the index is written last and marks it complete
+        try:
+            os.makedirs(cache_folder)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        # a build stopped half way must not leave the index of the previous cache next to the new logits:
+        if os.path.isfile(os.path.join(cache_folder, 'index.json')):
+            os.remove(os.path.join(cache_folder, 'index.json'))
+        #
+        loader = data.DataLoader(self, batch_size=batch_size, shuffle=False, num_workers=2, drop_last=False)
+        training = teacher.training
+        teacher.eval()
+        #
+        logits_file = None
+        scales_file = None
+        offset = 0
+        #
+        with torch.no_grad():
+            #
+            for images, labels, imagenames in loader:
+                #
+                logits = teacher(images.to(device=device, dtype=torch.float32)).float().cpu()
+                quantized, scales = self.quantize(logits, dtype)
+                #
+                if logits_file is None:
+                    logits_file = np.lib.format.open_memmap(os.path.join(cache_folder, 'logits.npy'), mode='w+', dtype=dtype, shape=(len(self),) + tuple(logits.shape[1:]))
+                    scales_file = np.lib.format.open_memmap(os.path.join(cache_folder, 'scales.npy'), mode='w+', dtype='float32', shape=(len(self), 2))
+                #
+                logits_file[offset:offset + images.size(0)] = quantized.numpy()
+                scales_file[offset:offset + images.size(0)] = scales.numpy()
+                offset += images.size(0)
+        #
+        logits_file.flush()
+        scales_file.flush()
+        teacher.train(training)
+        #
+        with open(os.path.join(cache_folder, 'index.json'), 'w') as f:
+            json.dump({'count': len(self), 'dtype': dtype, 'source': source}, f)
+
+    def __getitem__(self, index):
+        #
+        if self.pass_index is None:
+            # building the cache, the index runs over all the augmented copies:
+            return self.augmented(*divmod(index, len(self.dataset)))
+        #
+        image, label, imagename = self.augmented(self.pass_index, index)
+        #
+        position = self.pass_index * len(self.dataset) + index
+        offset, step = self.scales[position]
+        logits = np.array(self.logits[position], dtype='float32') * step + offset
+        #
+        return image, label, imagename, logits
+
+    def __len__(self):
+        return len(self.dataset) * (self.passes if self.pass_index is None else 1)
+
+
 def evaluate(data, model, device, class_no):
 
     model.eval()
@@ -320,6 +1040,85 @@ def evaluate(data, model, device, class_no):
     return test_iou / (j + 1), f1 / (j + 1), recall / (j + 1), precision / (j + 1)
 
 
+def _validation_worker(model, data, class_no, threads, tasks, results):
+    # evaluation process of AsyncValidation, model holds the shared-memory snapshot of the weights
+    torch.set_num_threads(threads)
+    #
+    while True:
+        #
+        epoch = tasks.get()
+        #
+        if epoch is None:
+            break
+        #
+        validate_iou, validate_f1, validate_recall, validate_precision = evaluate(data=data, model=model, device=torch.device('cpu'), class_no=class_no)
+        #
+        results.put((epoch, float(validate_iou), float(validate_f1), float(validate_recall), float(validate_precision)))
+
+
+class AsyncValidation(object):
+    # Validation in a background process, so training does not wait for evaluate().
+    # submit() copies the current weights into a cpu snapshot kept in shared memory and returns,
+    # the evaluation process validates the snapshot with its own thread budget.
+    # Finished results are collected with poll() / close() on the training side and logged there.
+    # A new snapshot is only written after the previous one has been validated.
+    def __init__(self, model, data, class_no, threads=1):
+        # :param model: network module being trained
+        # :param data: validation data loader
+        # :param class_no: 2 or multi-class
+        # :param threads: number of cpu threads of the evaluation process
+        self.model = model
+        self.snapshot = deepcopy(model).to('cpu')
+        self.snapshot.share_memory()
+        self.pending = 0
+        #
+        # fork where available: experiment scripts have no __main__ guard, spawn would run them again
+        if 'fork' in torch.multiprocessing.get_all_start_methods():
+            context = torch.multiprocessing.get_context('fork')
+        else:
+            context = torch.multiprocessing.get_context('spawn')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(target=_validation_worker, args=(self.snapshot, data, class_no, threads, self.tasks, self.results))
+        self.process.start()
+        self.finished = []
+
+    def submit(self, epoch):
+        # :param epoch: tag of the results, e.g. the epoch of the weights
+        # wait for the snapshot to be free:
+        while self.pending > 0:
+            self.finished.append(self.results.get())
+            self.pending -= 1
+        #
+        with torch.no_grad():
+            for snapshot_tensor, tensor in zip(self.snapshot.state_dict().values(), self.model.state_dict().values()):
+                snapshot_tensor.copy_(tensor)
+        #
+        self.tasks.put(epoch)
+        self.pending += 1
+
+    def poll(self):
+        # :return: list of finished (epoch, iou, f1, recall, precision), does not block
+        while self.pending > 0 and not self.results.empty():
+            self.finished.append(self.results.get())
+            self.pending -= 1
+        #
+        finished, self.finished = self.finished, []
+        return finished
+
+    def close(self):
+        # :return: list of all remaining results, after the evaluation process has stopped
+        while self.pending > 0:
+            self.finished.append(self.results.get())
+            self.pending -= 1
+        #
+        self.tasks.put(None)
+        self.process.join()
+        #
+        finished, self.finished = self.finished, []
+        return finished
+
+
 def test(data_1, data_2, model, device, class_no, save_location):
 
     model.eval()
@@ -579,58 +1378,119 @@ def test(data_1, data_2, model, device, class_no, save_location):
            data_1_testoutputs, data_2_testoutputs
 
 
-class EWC(object):
-    def __init__(self, model, dataset, device, sample_size):
+class _EWCPenaltyFunction(torch.autograd.Function):
+    # sum of F * (p - mean)^2 over all the parameters with multi-tensor ops, the gradient 2 * F * (p - mean) in closed form:
+    # no concatenation of the parameters and a single saved tensor per parameter
 
-        self.model = model
-        self.dataset = dataset
-        self.device = device
-        self.sample_size = sample_size
+    @staticmethod
+    def forward(ctx, scales, means, *params):
+        # :param scales: square roots of the Fisher information, one tensor per parameter
+        # :param means: anchor weights, one tensor per parameter
+        weighted = torch._foreach_sub(params, means)
+        torch._foreach_mul_(weighted, scales)
+        #
+        ctx.scales = scales
+        ctx.weighted = weighted
+        #
+        return torch.stack(torch._foreach_norm(weighted)).pow(2).sum()
 
-        self.params = {n: p for n, p in self.model.named_parameters() if p.requires_grad}
-        self._means = {}
-        self._precision_matrices = self._diag_fisher()
+    @staticmethod
+    def backward(ctx, grad_output):
+        grads = torch._foreach_mul(ctx.weighted, ctx.scales)
+        torch._foreach_mul_(grads, 2 * grad_output)
+        #
+        return (None, None) + tuple(grads)
 
-        for n, p in deepcopy(self.params).items():
-            #
-            self._means[n] = p.data.clone()
 
-    def _diag_fisher(self):
+class EWC(object):
+    # Elastic weight consolidation: penalty of moving the weights which matter for a previous data set, measured by
+    # the diagonal of the empirical Fisher information. The per-sample gradients are computed in chunks of samples
+    # with torch.func, the Fisher diagonal and the previous weights are each kept in one flat buffer, the penalty
+    # of a training step is one multi-tensor expression over views of them.
+    # Online EWC: consolidate() after training on every new data set, e.g. duke then ours, the Fisher information
+    # decays by gamma and accumulates, the anchor weights move to the weights of the last data set.
+    def __init__(self, model, dataset, device, sample_size, no_class=2, chunk_size=8, gamma=1.0):
+        # :param model: network trained on the previous data set
+        # :param dataset: loader of (images, labels, names) batches of the previous data set
+        # :param sample_size: number of scans used for the Fisher information
+        # :param no_class: 2 or multi-class, selects the loss of the empirical Fisher information
+        # :param chunk_size: scans whose per-sample gradients are computed at once, memory grows with it
+        # :param gamma: decay of the Fisher information of the older data sets in online EWC, 1.0 keeps it all
+        self.model = model
+        self.device = device
+        self.no_class = no_class
+        self.chunk_size = chunk_size
+        self.gamma = gamma
         #
-        precision_matrices = {}
+        self.names = [n for n, p in self.model.named_parameters() if p.requires_grad]
+        self.params = [p for n, p in self.model.named_parameters() if p.requires_grad]
         #
-        for n, p in deepcopy(self.params).items():
-            #
-            p.data.zero_()
-            precision_matrices[n] = p.data.clone()
+        self._precision_matrices = None
+        self._means = None
+        #
+        self.consolidate(dataset, sample_size)
 
-        self.model.eval()
+    def _sample_loss(self, params, others, image, label):
+        # loss of one scan as a function of the trainable parameters, for torch.func.grad
+        output = torch.func.functional_call(self.model, (params, others), (image.unsqueeze(0),))
+        #
+        if self.no_class == 2:
+            return F.binary_cross_entropy_with_logits(output, label.unsqueeze(0))
+        #
+        return F.cross_entropy(output, label.unsqueeze(0).squeeze(1), ignore_index=8)
 
-        for index, (input, label, input_name) in enumerate(self.dataset):
+    def _diag_fisher(self, dataset, sample_size):
+        # :return: flat diagonal of the empirical Fisher information, mean of the squared per-sample gradients
+        training = self.model.training
+        # running statistics of BatchNorm and no dropout, the samples of a chunk are independent:
+        self.model.eval()
+        #
+        params = {n: p.detach() for n, p in zip(self.names, self.params)}
+        others = {n: p.detach() for n, p in self.model.named_parameters() if n not in params}
+        others.update(dict(self.model.named_buffers()))
+        #
+        per_sample_grad = torch.func.vmap(torch.func.grad(self._sample_loss), in_dims=(None, None, 0, 0), chunk_size=self.chunk_size)
+        #
+        fisher = torch.zeros(sum(p.numel() for p in self.params), device=self.device)
+        samples = 0
+        #
+        for input, label, input_name in dataset:
             #
-            if index < self.sample_size:
-                #
-                self.model.zero_grad()
-                #
-                input = input.to(device=self.device, dtype=torch.float32)
-                label = label.to(device=self.device, dtype=torch.float32)
-                #
-                output = self.model(input)
-                # We use empirical Fisher here:
-                loss = F.binary_cross_entropy_with_logits(F.logsigmoid(output), label)
-                loss.backward()
-                #
-                for index, (n, p) in enumerate(self.model.named_parameters()):
-                    #
-                    precision_matrices[n].data += (p.grad.data**2).mean(0)
-
-        precision_matrices = {n: p for n, p in precision_matrices.items()}
-
-        return precision_matrices
+            if samples >= sample_size:
+                break
+            #
+            input = input[:sample_size - samples].to(device=self.device, dtype=torch.float32)
+            label = label[:sample_size - samples].to(device=self.device, dtype=torch.float32 if self.no_class == 2 else torch.long)
+            #
+            grads = per_sample_grad(params, others, input, label)
+            fisher += torch.cat([(grads[n] ** 2).sum(0).reshape(-1) for n in self.names])
+            samples += input.size(0)
+        #
+        self.model.train(training)
+        #
+        return fisher / max(samples, 1)
 
-    def penalty(self, model: nn.Module):
-        loss = 0
-        for n, p in model.named_parameters():
-            _loss = self._precision_matrices[n] * (p - self._means[n]) ** 2
-            loss += _loss.sum()
-        return loss
\ No newline at end of file
+    def consolidate(self, dataset, sample_size):
+        # adds the Fisher information of a data set the model has now been trained on, the weights become the anchor
+        fisher = self._diag_fisher(dataset, sample_size)
+        #
+        if self._precision_matrices is None:
+            self._precision_matrices = fisher
+        else:
+            self._precision_matrices = self.gamma * self._precision_matrices + fisher
+        #
+        self._means = torch.cat([p.detach().reshape(-1) for p in self.params]).clone()
+        # views of the flat buffers shaped as the parameters:
+        sizes = [p.numel() for p in self.params]
+        self._scale_views = [scale.view_as(p) for scale, p in zip(torch.split(self._precision_matrices.sqrt(), sizes), self.params)]
+        self._mean_views = [mean.view_as(p) for mean, p in zip(torch.split(self._means, sizes), self.params)]
+
+    def penalty(self, model: nn.Module = None):
+        # :param model: network being trained, the model of the EWC by default
+        # :return: sum of the Fisher weighted squared distances of the weights to the anchor
+        if model is None or model is self.model:
+            params = self.params
+        else:
+            params = [p for n, p in model.named_parameters() if p.requires_grad]
+        #
+        return _EWCPenaltyFunction.apply(self._scale_views, self._mean_views, *params)
@@ -1,5 +1,7 @@
 import os
 import errno
+import json
+import contextlib
 import torch
 import torch.nn as nn
 import numpy as np
@@ -9,10 +11,15 @@ from torch.utils import data
 import torch.nn.functional as F
 
 from torch.optim import lr_scheduler
-from NNLoss import dice_loss
-from NNMetrics import segmentation_scores, f1_score
-from NNMetrics import intersectionAndUnion
-from NNUtils import evaluate, test
+from NNLoss import ce_dice_loss, binary_hybrid_loss
+from NNMetrics import f1_score
+from NNMetrics import StreamingMetrics
+from NNUtils import evaluate, test, FullBatchStatistics, AsyncValidation, StackedModels, MultiSeedBatchSampler, BatchResize, resize_scale
+from NNUtils import ModelEMA, create_model, sigmoid_rampup, getData_unlabelled_OCT, stream_batches
+from NNUtils import freeze_encoder, CachedFeatures_OCT, WeightAveraging, recalibrate_batchnorm, DistillationDataset_OCT
+from NNCheckpoint import TrainingCheckpoint
+from NNDistributed import launch, number_of_nodes, is_main_process, convert_distributed_batchnorm, revert_distributed_batchnorm
+from torch.nn.parallel import DistributedDataParallel
 from tensorboardX import SummaryWriter
 from torch.autograd import grad
 # ================================================
@@ -28,13 +35,28 @@ from SOASNet_segnet_back import SOASNet_segnet
 from SOASNet_segnet_relay_net import SOASNet_segnet_skip
 from SOASNet_single_scale import SOASNet_ss
 
-from adamW import AdamW
+from adamW import AdamW, Lamb, Lars
 # =============================
 from NNUtils import getData_OCT
 # =============================
 
 
-def trainModels(repeat, data_set, input_dim, train_batch, model, epochs, width, l_r, l_r_s, shuffle, loss, norm, log, class_no, depth, depth_limit, data_augmentation_train, data_augmentation_test, cluster=False):
+def trainModels(repeat, data_set, input_dim, train_batch, model, epochs, width, l_r, l_r_s, shuffle, loss, norm, log, class_no, depth, depth_limit, data_augmentation_train, data_augmentation_test, cluster=False, vectorized=False, **kwargs):
+    # :param vectorized: True to train all the repeats together with trainMultiSeedModels, not for the folds of duke, only checkpoint_every and resume can then be given in kwargs
+    # :param kwargs: extra options forwarded to trainSingleModel, e.g. micro_batch, bn_full_batch, checkpoint_every, resume, async_validation
+    # :param model: network tag, or a list of tags to train them together on the same batches with trainFanOutModels
+    #
+    if isinstance(model, (list, tuple)):
+        trainer = trainFanOutModels
+    else:
+        trainer = trainSingleModel
+    #
+    if vectorized is True:
+        # trainMultiSeedModels only takes the checkpointing options:
+        unsupported = sorted(set(kwargs) - {'checkpoint_every', 'resume'})
+        #
+        if len(unsupported) > 0:
+            raise ValueError('Options not supported when training the repeats together: {}.'.format(', '.join(unsupported)))
     #
     if cluster is False:
         #
@@ -67,29 +89,30 @@ def trainModels(repeat, data_set, input_dim, train_batch, model, epochs, width,
             #
             trainloader, train_dataset, validate_dataset, test_dataset_1, test_dataset_2 = getData_OCT(data_directory, train_batch, shuffle_mode=shuffle, augmentation_train=data_augmentation_train, augmentation_test=data_augmentation_test)
             #
-            trained_model = trainSingleModel(model_name=model,
-                                             epochs=epochs,
-                                             width=width,
-                                             lr=l_r,
-                                             repeat=str(j),
-                                             lr_scedule=l_r_s,
-                                             train_dataset=train_dataset,
-                                             train_batch=train_batch,
-                                             train_loader=trainloader,
-                                             data_name=data_set,
-                                             validate_data=validate_dataset,
-                                             test_data_1=test_dataset_1,
-                                             test_data_2=test_dataset_2,
-                                             data_augmentation_train=data_augmentation_train,
-                                             data_augmentation_test=data_augmentation_test,
-                                             shuffle=shuffle,
-                                             loss=loss,
-                                             norm=norm,
-                                             log=log,
-                                             no_class=class_no,
-                                             input_channel=input_dim,
-                                             depth=depth,
-                                             depth_limit=depth_limit)
+            trained_model = trainer(model_name=model,
+                                    epochs=epochs,
+                                    width=width,
+                                    lr=l_r,
+                                    repeat=str(j),
+                                    lr_scedule=l_r_s,
+                                    train_dataset=train_dataset,
+                                    train_batch=train_batch,
+                                    train_loader=trainloader,
+                                    data_name=data_set,
+                                    validate_data=validate_dataset,
+                                    test_data_1=test_dataset_1,
+                                    test_data_2=test_dataset_2,
+                                    data_augmentation_train=data_augmentation_train,
+                                    data_augmentation_test=data_augmentation_test,
+                                    shuffle=shuffle,
+                                    loss=loss,
+                                    norm=norm,
+                                    log=log,
+                                    no_class=class_no,
+                                    input_channel=input_dim,
+                                    depth=depth,
+                                    depth_limit=depth_limit,
+                                    **kwargs)
 
     elif cluster is True and data_set == 'duke':
         #
@@ -99,59 +122,394 @@ def trainModels(repeat, data_set, input_dim, train_batch, model, epochs, width,
             #
             trainloader, train_dataset, validate_dataset, test_dataset_1, test_dataset_2 = getData_OCT(data_directory, train_batch, shuffle_mode=shuffle, augmentation_train=data_augmentation_train, augmentation_test=data_augmentation_test)
             #
-            trained_model = trainSingleModel(model_name=model,
-                                             epochs=epochs,
-                                             width=width,
-                                             lr=l_r,
-                                             repeat=str(j),
-                                             lr_scedule=l_r_s,
-                                             train_dataset=train_dataset,
-                                             train_batch=train_batch,
-                                             train_loader=trainloader,
-                                             data_name=data_set,
-                                             validate_data=validate_dataset,
-                                             test_data_1=test_dataset_1,
-                                             test_data_2=test_dataset_2,
-                                             data_augmentation_train=data_augmentation_train,
-                                             data_augmentation_test=data_augmentation_test,
-                                             shuffle=shuffle,
-                                             loss=loss,
-                                             norm=norm,
-                                             log=log,
-                                             no_class=class_no,
-                                             input_channel=input_dim,
-                                             depth=depth,
-                                             depth_limit=depth_limit)
+            trained_model = trainer(model_name=model,
+                                    epochs=epochs,
+                                    width=width,
+                                    lr=l_r,
+                                    repeat=str(j),
+                                    lr_scedule=l_r_s,
+                                    train_dataset=train_dataset,
+                                    train_batch=train_batch,
+                                    train_loader=trainloader,
+                                    data_name=data_set,
+                                    validate_data=validate_dataset,
+                                    test_data_1=test_dataset_1,
+                                    test_data_2=test_dataset_2,
+                                    data_augmentation_train=data_augmentation_train,
+                                    data_augmentation_test=data_augmentation_test,
+                                    shuffle=shuffle,
+                                    loss=loss,
+                                    norm=norm,
+                                    log=log,
+                                    no_class=class_no,
+                                    input_channel=input_dim,
+                                    depth=depth,
+                                    depth_limit=depth_limit,
+                                    **kwargs)
 
     else:
         #
         trainloader, train_dataset, validate_dataset, test_dataset_1, test_dataset_2 = getData_OCT(data_directory, train_batch, shuffle_mode=shuffle, augmentation_train=data_augmentation_train, augmentation_test=data_augmentation_test)
         #
+        if vectorized is True:
+            #
+            trainMultiSeedModels(model_name=model,
+                                 seeds=repeat,
+                                 epochs=epochs,
+                                 width=width,
+                                 lr=l_r,
+                                 lr_scedule=l_r_s,
+                                 train_dataset=train_dataset,
+                                 train_batch=train_batch,
+                                 train_loader=trainloader,
+                                 data_name=data_set,
+                                 validate_data=validate_dataset,
+                                 test_data_1=test_dataset_1,
+                                 test_data_2=test_dataset_2,
+                                 data_augmentation_train=data_augmentation_train,
+                                 data_augmentation_test=data_augmentation_test,
+                                 shuffle=shuffle,
+                                 loss=loss,
+                                 norm=norm,
+                                 log=log,
+                                 no_class=class_no,
+                                 input_channel=input_dim,
+                                 depth=depth,
+                                 depth_limit=depth_limit,
+                                 **kwargs)
+            #
+            return
+        #
         for j in range(1, repeat+1, 1):
             #
-            trained_model = trainSingleModel(model_name=model,
-                                             epochs=epochs,
-                                             width=width,
-                                             lr=l_r,
-                                             repeat=str(j),
-                                             lr_scedule=l_r_s,
-                                             train_dataset=train_dataset,
-                                             train_batch=train_batch,
-                                             train_loader=trainloader,
-                                             data_name=data_set,
-                                             validate_data=validate_dataset,
-                                             test_data_1=test_dataset_1,
-                                             test_data_2=test_dataset_2,
-                                             data_augmentation_train=data_augmentation_train,
-                                             data_augmentation_test=data_augmentation_test,
-                                             shuffle=shuffle,
-                                             loss=loss,
-                                             norm=norm,
-                                             log=log,
-                                             no_class=class_no,
-                                             input_channel=input_dim,
-                                             depth=depth,
-                                             depth_limit=depth_limit)
+            trained_model = trainer(model_name=model,
+                                    epochs=epochs,
+                                    width=width,
+                                    lr=l_r,
+                                    repeat=str(j),
+                                    lr_scedule=l_r_s,
+                                    train_dataset=train_dataset,
+                                    train_batch=train_batch,
+                                    train_loader=trainloader,
+                                    data_name=data_set,
+                                    validate_data=validate_dataset,
+                                    test_data_1=test_dataset_1,
+                                    test_data_2=test_dataset_2,
+                                    data_augmentation_train=data_augmentation_train,
+                                    data_augmentation_test=data_augmentation_test,
+                                    shuffle=shuffle,
+                                    loss=loss,
+                                    norm=norm,
+                                    log=log,
+                                    no_class=class_no,
+                                    input_channel=input_dim,
+                                    depth=depth,
+                                    depth_limit=depth_limit,
+                                    **kwargs)
+
+
+def trainJob(data_directory, model, repeat, data_set, input_dim, train_batch, epochs, width, l_r, l_r_s, shuffle, loss, norm, log, class_no, depth, depth_limit, data_augmentation_train, data_augmentation_test, processes=1, distributed=False, **kwargs):
+    # one run of trainModels: a single repeat on a single data split, used by Experiment_queue.py
+    # :param data_directory: folder of the data split, e.g. .../OCT/duke/1/
+    # :param repeat: repeat tag of the run, the fold number for duke
+    # :param processes: number of data-parallel training processes on this node, each with its share of the cores,
+    #                   several nodes also set NNODES, NODE_RANK, MASTER_ADDR and MASTER_PORT, see NNDistributed.py
+    # :param distributed: set by the launched processes themselves
+    # :param kwargs: extra options forwarded to trainSingleModel
+    # :return: path of the saved model, list of paths if model is a list of network tags
+    if distributed is False and processes * number_of_nodes() > 1:
+        #
+        if isinstance(model, (list, tuple)):
+            raise ValueError('Several networks trained together are not supported in distributed training.')
+        #
+        args = (data_directory, model, repeat, data_set, input_dim, train_batch, epochs, width, l_r, l_r_s, shuffle, loss, norm, log, class_no, depth, depth_limit, data_augmentation_train, data_augmentation_test)
+        #
+        return launch(trainJob, processes, args, dict(kwargs, processes=processes, distributed=True))
+    #
+    rank, world_size = (torch.distributed.get_rank(), torch.distributed.get_world_size()) if distributed is True else (0, 1)
+    #
+    trainloader, train_dataset, validate_dataset, test_dataset_1, test_dataset_2 = getData_OCT(data_directory, train_batch, shuffle_mode=shuffle, augmentation_train=data_augmentation_train, augmentation_test=data_augmentation_test, rank=rank, world_size=world_size)
+    #
+    if distributed is True:
+        kwargs['distributed'] = True
+    #
+    trainer = trainFanOutModels if isinstance(model, (list, tuple)) else trainSingleModel
+    #
+    return trainer(model_name=model,
+                   epochs=epochs,
+                   width=width,
+                   lr=l_r,
+                   repeat=str(repeat),
+                   lr_scedule=l_r_s,
+                   train_dataset=train_dataset,
+                   train_batch=train_batch,
+                   train_loader=trainloader,
+                   data_name=data_set,
+                   validate_data=validate_dataset,
+                   test_data_1=test_dataset_1,
+                   test_data_2=test_dataset_2,
+                   data_augmentation_train=data_augmentation_train,
+                   data_augmentation_test=data_augmentation_test,
+                   shuffle=shuffle,
+                   loss=loss,
+                   norm=norm,
+                   log=log,
+                   no_class=class_no,
+                   input_channel=input_dim,
+                   depth=depth,
+                   depth_limit=depth_limit,
+                   **kwargs)
+
+
+# multi-class losses, cross-entropy and Dice from the logits, label 8 is ignored:
+multi_class_losses = {'dice': ce_dice_loss(ce_weight=0.0, dice_weight=1.0, ignore_index=8),
+                      'hybrid': ce_dice_loss(ce_weight=1.0, dice_weight=1.0, ignore_index=8),
+                      'ce': ce_dice_loss(ce_weight=1.0, dice_weight=0.0, ignore_index=8)}
+
+
+def calculate_loss(outputs_logits, labels, loss, no_class):
+    # :param outputs_logits: model outputs before sigmoid / softmax
+    # :param labels: labels of the batch
+    # :param loss: loss function tag, 'dice', 'ce' or 'hybrid'
+    # :param no_class: 2 or multi-class
+    # :return: mean loss of the batch
+    if no_class == 2:
+        #
+        if loss == 'dice':
+            #
+            main_loss = binary_hybrid_loss(outputs_logits, labels, dice_weight=1.0, bce_weight=0.0)
+            #
+        elif loss == 'ce':
+            #
+            main_loss = nn.BCEWithLogitsLoss(reduction='mean')(outputs_logits, labels)
+            #
+        elif loss == 'hybrid':
+            #
+            main_loss = binary_hybrid_loss(outputs_logits, labels, dice_weight=1.0, bce_weight=1.0)
+
+    else:
+        # any other loss tag is the cross-entropy:
+        main_loss, _, _ = multi_class_losses.get(loss, multi_class_losses['ce'])(outputs_logits, labels)
+
+    return main_loss
+
+
+def calculate_mixup_loss(outputs_logits, labels_1, labels_2, lam, loss, no_class):
+    # :param outputs_logits: model outputs of the mixed up images
+    # :param labels_1: labels of the first images
+    # :param labels_2: labels of the second images
+    # :param lam: mix-up ratios of the batch
+    # :return: mean loss of the batch
+    if no_class == 2:
+        # both targets in one pass, the ratios of the batch are averaged as before:
+        if loss == 'dice':
+
+            main_loss = binary_hybrid_loss(outputs_logits, labels_1, labels_2, lam, dice_weight=1.0, bce_weight=0.0)
+
+        elif loss == 'ce':
+
+            main_loss = binary_hybrid_loss(outputs_logits, labels_1, labels_2, lam, dice_weight=0.0, bce_weight=1.0)
+
+        elif loss == 'hybrid':
+
+            main_loss = binary_hybrid_loss(outputs_logits, labels_1, labels_2, lam, dice_weight=1.0, bce_weight=1.0)
+
+    else:
+        # the loss of calculate_loss against both targets, label 8 is ignored:
+        criterion = multi_class_losses.get(loss, multi_class_losses['ce'])
+
+        main_loss = lam * criterion(outputs_logits, labels_1)[0] + (1 - lam) * criterion(outputs_logits, labels_2)[0]
+
+    return main_loss.mean()
+
+
+def calculate_consistency_loss(student_logits, teacher_logits, no_class):
+    # :param student_logits: outputs of the network on the unlabelled scans
+    # :param teacher_logits: outputs of the teacher on other perturbations of the same scans, the targets
+    # :return: mean squared error between the probabilities, as in mean teacher
+    if no_class == 2:
+        return F.mse_loss(torch.sigmoid(student_logits), torch.sigmoid(teacher_logits))
+    #
+    return F.mse_loss(torch.softmax(student_logits, dim=1), torch.softmax(teacher_logits, dim=1))
+
+
+def calculate_distillation_loss(outputs_logits, teacher_logits, temperature, no_class):
+    # :param outputs_logits: outputs of the student
+    # :param teacher_logits: outputs of the teacher on the same scans
+    # :param temperature: softening temperature of both outputs, the loss is scaled by its square
+    # :return: cross-entropy (binary) or KL divergence (multi-class) of the softened outputs, mean over the pixels
+    if no_class == 2:
+        return F.binary_cross_entropy_with_logits(outputs_logits / temperature, torch.sigmoid(teacher_logits / temperature)) * temperature ** 2
+    #
+    divergence = F.kl_div(F.log_softmax(outputs_logits / temperature, dim=1), F.log_softmax(teacher_logits / temperature, dim=1), reduction='none', log_target=True)
+    #
+    return divergence.sum(dim=1).mean() * temperature ** 2
+
+
+def log_validation(writer, epochs, results):
+    # prints and logs the results of AsyncValidation
+    # :param results: list of (epoch, iou, f1, recall, precision)
+    for epoch, validate_iou, validate_f1, validate_recall, validate_precision in results:
+
+        print(
+            'Step [{}/{}], '
+            'val iou: {:.5f}'.format(epoch,
+                                     epochs,
+                                     validate_iou))
+
+        writer.add_scalars('scalars', {'val iou': validate_iou,
+                                       'val f1': validate_f1,
+                                       'val recall': validate_recall,
+                                       'val precision': validate_precision}, epoch)
+
+
+def network(model_name, input_channel, width, depth, depth_limit, norm, no_class, checkpointing, device):
+    # registry of the networks which can be trained
+    # :param model_name: network tag, e.g. 'unet', 'Segnet', 'RelayNet', 'SOASNet' or 'SOASNet_segnet'
+    # :param checkpointing: activation checkpointing policy of SOASNet models and SegNet
+    # :return: network module on the device
+    if model_name == 'unet':
+
+        model = UNet(n_channels=input_channel, n_classes=no_class, bilinear=True).to(device=device)
+
+        # model = UNet2(in_channels=1, n_classes=1, depth=4, wf=32, padding=False, batch_norm=True, up_mode='upconv').to(device=device)
+
+    elif model_name == 'Segnet':
+
+        model = SegNet(in_ch=input_channel, width=width, norm=norm, depth=4, n_classes=no_class, dropout=True, side_output=False, checkpointing=checkpointing).to(device=device)
+
+    elif model_name == 'SOASNet_single':
+
+        model = SOASNet_ss(in_ch=input_channel, width=width, depth=depth, norm=norm, n_classes=no_class, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit, checkpointing=checkpointing).to(device=device)
+
+    elif model_name == 'SOASNet':
+
+        model = SOASNet(in_ch=input_channel, width=width, depth=depth, norm=norm, n_classes=no_class, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit, checkpointing=checkpointing).to(device=device)
+
+    elif model_name == 'SOASNet_large_kernel':
+
+        model = SOASNet_ls(in_ch=input_channel, width=width, depth=depth, norm=norm, n_classes=no_class, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit, checkpointing=checkpointing).to(device=device)
+
+    elif model_name == 'SOASNet_multi_attn':
+
+        model = SOASNet_ma(in_ch=input_channel, width=width, depth=depth, norm=norm, n_classes=no_class, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit, checkpointing=checkpointing).to(device=device)
+
+    elif model_name == 'SOASNet_very_large_kernel':
+
+        model = SOASNet_vls(in_ch=input_channel, width=width, depth=depth, norm=norm, n_classes=no_class, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit, checkpointing=checkpointing).to(device=device)
+
+    elif model_name == 'SOASNet_segnet':
+
+        model = SOASNet_segnet(in_ch=input_channel, width=width, depth=depth, norm=norm, n_classes=no_class, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit, checkpointing=checkpointing).to(device=device)
+
+    elif model_name == 'SOASNet_segnet_skip':
+
+        model = SOASNet_segnet_skip(in_ch=input_channel, width=width, depth=depth, norm=norm, n_classes=no_class, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit, checkpointing=checkpointing).to(device=device)
+
+    elif model_name == 'RelayNet':
+
+        model = SOASNet_segnet_skip(in_ch=input_channel, width=width, depth=depth, norm=norm, n_classes=no_class, mode='relaynet', side_output=False, downsampling_limit=depth_limit, checkpointing=checkpointing).to(device=device)
+
+    elif model_name == 'attn_unet':
+
+        model = AttentionUNet(in_ch=input_channel, width=width, visulisation=False, class_no=no_class).to(device=device)
+
+    return model
+
+
+def experiment_name(model_name, epochs, data_name, train_batch, width, loss, norm, shuffle, data_augmentation_train, data_augmentation_test, lr, repeat):
+    # :return: name of a run, used for its logs, checkpoints and saved model
+    model_name = model_name + '_Epoch_' + str(epochs) + \
+                 '_Dataset_' + data_name + \
+                 '_Batch_' + str(train_batch) + \
+                 '_Width_' + str(width) + \
+                 '_Loss_' + loss + \
+                 '_Norm_' + norm + \
+                 '_ShuffleTraining_' + str(shuffle) + \
+                 '_Data_Augmentation_Train_' + data_augmentation_train + '_' + \
+                 '_Data_Augmentation_Test_' + data_augmentation_test + '_' + \
+                 '_lr_' + str(lr) + \
+                 '_Repeat_' + str(repeat)
+
+    return model_name
+
+
+def gradient_synchronisation(model, last):
+    # :param model: network, or its DistributedDataParallel replica
+    # :param last: True for the backward of the last micro-batch of a batch
+    # :return: context in which the gradients of the replicas are only averaged in the last backward of a batch
+    if isinstance(model, DistributedDataParallel) and last is False:
+        return model.no_sync()
+    #
+    return contextlib.nullcontext()
+
+
+def save_and_test(model, model_name, log, test_data_1, test_data_2, device, no_class):
+    # saves the trained model and its test results in ../../saved_models_<log>
+    # :return: path of the saved model
+    # save model
+    save_folder = '../../saved_models_' + log
+
+    try:
+
+        os.makedirs(save_folder)
+
+    except OSError as exc:
+
+        if exc.errno != errno.EEXIST:
+
+            raise
+    pass
+
+    save_model_name = model_name + '_Final'
+
+    save_model_name_full = save_folder + '/' + save_model_name + '.pt'
+
+    torch.save(model, save_model_name_full)
+    # =======================================================================
+    # testing (disabled during training, because it is too slow)
+    # =======================================================================
+    save_results_folder = save_folder + '/testing_results_' + model_name
+
+    try:
+        os.makedirs(save_results_folder)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    pass
+
+    test_iou_1, test_f1_1, test_recall_1, test_precision_1, mse_1, test_iou_2, test_f1_2, test_recall_2, test_precision_2, mse_2, outputs_1, outputs_2 = test(data_1=test_data_1,
+                                                                                                                                                              data_2=test_data_2,
+                                                                                                                                                              model=model,
+                                                                                                                                                              device=device,
+                                                                                                                                                              class_no=no_class,
+                                                                                                                                                              save_location=save_results_folder)
+
+    print(
+        'test iou data 1: {:.4f}, '
+        'test mse data 1: {:.4f}, '
+        'test f1 data 1: {:.4f},'
+        'test recall data 1: {:.4f}, '
+        'test precision data 1: {:.4f}, '.format(test_iou_1,
+                                                 mse_1,
+                                                 test_f1_1,
+                                                 test_recall_1,
+                                                 test_precision_1))
+
+    print(
+        'test iou data 2: {:.4f}, '
+        'test mse data 2: {:.4f}, '
+        'test f1 data 2: {:.4f},'
+        'test recall data 2: {:.4f}, '
+        'test precision data 2: {:.4f}, '.format(test_iou_2,
+                                                 mse_2,
+                                                 test_f1_2,
+                                                 test_recall_2,
+                                                 test_precision_2))
+
+    print('\nTesting finished and results saved.\n')
+
+    return save_model_name_full
 
 
 def trainSingleModel(model_name,
@@ -176,7 +534,35 @@ def trainSingleModel(model_name,
                      norm,
                      log,
                      no_class,
-                     input_channel):
+                     input_channel,
+                     micro_batch=None,
+                     bn_full_batch=False,
+                     checkpointing=None,
+                     checkpoint_every=1,
+                     resume=True,
+                     async_validation=False,
+                     validation_threads=1,
+                     distributed=False,
+                     stop_epoch=None,
+                     time_budget=None,
+                     resize_schedule=None,
+                     optimizer_type='adamw',
+                     warmup_epochs=0,
+                     semi_supervised=None,
+                     unlabelled_directory=None,
+                     unlabelled_batch=None,
+                     consistency=1.0,
+                     consistency_rampup=5,
+                     ema_decay=0.99,
+                     ema_every=1,
+                     weight_averaging=None,
+                     average_top_k=5,
+                     swa_start=0.75,
+                     distillation_teacher=None,
+                     distillation_alpha=0.5,
+                     distillation_temperature=2.0,
+                     distillation_passes=4,
+                     distillation_dtype='uint8'):
     # :param model: network module
     # :param epochs: training total epochs
     # :param width: first encoder channel number
@@ -184,7 +570,47 @@ def trainSingleModel(model_name,
     # :param lr_scedule: true or false for learning rate schedule
     # :param repeat: repeat same experiments
     # :param train_dataset: training data set
-    # :param train_batch: batch size
+    # :param train_batch: batch size, this is the effective batch size of each optimizer step
+    # :param micro_batch: split each batch into micro-batches of this size and accumulate gradients, None for no split
+    # :param bn_full_batch: True to normalise BatchNorm layers with the statistics of the full batch when micro-batching
+    # :param checkpointing: activation checkpointing policy of SOASNet models and SegNet, e.g. 'all' or ['encoder', 'strip']
+    # :param checkpoint_every: save a resumable training checkpoint every this many epochs, None for no checkpoints
+    # :param resume: True to continue from the training checkpoint of the same experiment if there is one, it must have the same options.
+    #                The checkpoint is deleted once the model is saved and tested, a finished experiment run again trains again
+    # :param async_validation: True to validate in a background process while training continues
+    # :param validation_threads: number of cpu threads of the background validation process
+    # :param distributed: True when running in a process group started by launch(), see trainJob
+    # :param stop_epoch: pause the run after this many epochs, e.g. in a sweep: the lr schedule still spans all the epochs,
+    #                    the run is checkpointed and its validation iou is returned, a later call with a larger stop_epoch continues it,
+    #                    a checkpoint already past stop_epoch raises a ValueError
+    # :param time_budget: wall-clock seconds from this call, e.g. the wall-time limit of the job minus the data loading:
+    #                     training stops after the last epoch which fits in the budget, keeping enough time to save and test,
+    #                     the lr decays over the projected steps instead of the epochs and the best validated model is tested
+    # :param resize_schedule: progressive resizing, list of (fraction of the epochs, scale) of the training batches, see resize_scale:
+    #                         e.g. [(0.5, 0.25), (0.8, 0.5)], validation and testing stay at the native size
+    # :param optimizer_type: 'adamw', or for large batches the layer-wise adaptive 'lamb' (Adam) or 'lars' (SGD with momentum)
+    # :param warmup_epochs: the lr rises linearly from 0 over the steps of this many epochs, e.g. 5 for large batches
+    # :param semi_supervised: None, or 'mean_teacher': an EMA of the network is the teacher of a consistency loss on unlabelled scans,
+    #                         'pi': the network is its own teacher (Pi model), both perturbations go through the network
+    # :param unlabelled_directory: folder of the unlabelled B-scans, images/*.jpg of the size of the training scans,
+    #                              streamed alongside the labelled batches, an epoch is still one pass over the labelled set
+    # :param unlabelled_batch: unlabelled scans of each step, train_batch by default
+    # :param consistency: weight of the consistency loss at the end of its ramp-up
+    # :param consistency_rampup: epochs of the sigmoid ramp-up of the consistency weight
+    # :param ema_decay: decay of the mean teacher
+    # :param ema_every: the mean teacher is updated every this many steps
+    # :param weight_averaging: None, 'top_k': the weights of the average_top_k epochs of the best validation iou are averaged,
+    #                          'swa': the weights at the end of every epoch after swa_start of the run are averaged.
+    #                          The averaged model gets new BatchNorm statistics from one pass over the training loader and is tested
+    # :param average_top_k: number of epochs of the top-k average
+    # :param swa_start: fraction of the epochs after which the stochastic weight average starts
+    # :param distillation_teacher: path of a trained network saved by save_and_test, e.g. a wide SOASNet, None for no distillation:
+    #                              its logits on distillation_passes augmented copies of the training set are computed once and cached,
+    #                              the network trains on the hard labels and on those soft targets, see DistillationDataset_OCT
+    # :param distillation_alpha: weight of the distillation loss, the loss of the labels has 1 - distillation_alpha
+    # :param distillation_temperature: softening temperature of the soft targets
+    # :param distillation_passes: augmented copies of the training set with cached logits, the epochs cycle over them
+    # :param distillation_dtype: 'uint8' or 'float16', dtype of the cached logits
     # :param train_loader: training loader
     # :param validate_loader: validation loader
     # :param shuffle: shuffle training data or not
@@ -200,258 +626,504 @@ def trainSingleModel(model_name,
     # :param temperature_start: 2 or 4
     # :param temperature_end: 4 or 2
     # :return:
-    device = torch.device('cuda:0')
+    start_time = timeit.default_timer()
 
-    # side_output_use = False
-
-    if model_name == 'unet':
-
-        model = UNet(n_channels=input_channel, n_classes=no_class, bilinear=True).to(device=device)
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
-        # model = UNet2(in_channels=1, n_classes=1, depth=4, wf=32, padding=False, batch_norm=True, up_mode='upconv').to(device=device)
+    # side_output_use = False
 
-    elif model_name == 'Segnet':
+    model = network(model_name, input_channel, width, depth, depth_limit, norm, no_class, checkpointing, device)
 
-        model = SegNet(in_ch=input_channel, width=width, norm=norm, depth=4, n_classes=no_class, dropout=True, side_output=False).to(device=device)
+    # the distributed replica is only used for the training forwards, model itself is validated, saved and tested:
+    train_model = model
 
-    elif model_name == 'SOASNet_single':
+    main_process = is_main_process()
 
-        model = SOASNet_ss(in_ch=input_channel, width=width, depth=depth, norm=norm, n_classes=no_class, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit).to(device=device)
+    if distributed is True:
 
-    elif model_name == 'SOASNet':
+        if bn_full_batch is True:
+            raise ValueError('bn_full_batch is not supported in distributed training, BatchNorm layers are synchronised instead.')
 
-        model = SOASNet(in_ch=input_channel, width=width, depth=depth, norm=norm, n_classes=no_class, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit).to(device=device)
+        if device.type == 'cpu':
+            model = convert_distributed_batchnorm(model)
+        else:
+            model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
 
-    elif model_name == 'SOASNet_large_kernel':
+    teacher = None
 
-        model = SOASNet_ls(in_ch=input_channel, width=width, depth=depth, norm=norm, n_classes=no_class, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit).to(device=device)
+    ema = None
 
-    elif model_name == 'SOASNet_multi_attn':
+    unlabelled_batches = None
 
-        model = SOASNet_ma(in_ch=input_channel, width=width, depth=depth, norm=norm, n_classes=no_class, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit).to(device=device)
+    if semi_supervised is not None:
 
-    elif model_name == 'SOASNet_very_large_kernel':
+        if semi_supervised not in ('mean_teacher', 'pi'):
+            raise ValueError('Invalid semi-supervised mode: {}'.format(semi_supervised))
 
-        model = SOASNet_vls(in_ch=input_channel, width=width, depth=depth, norm=norm, n_classes=no_class, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit).to(device=device)
+        if 'mixup' in data_augmentation_train or bn_full_batch is True or resize_schedule is not None or (micro_batch is not None and micro_batch < train_batch):
+            raise ValueError('Semi-supervised training does not support mix-up, micro-batches, bn_full_batch or progressive resizing.')
 
-    elif model_name == 'SOASNet_segnet':
+        rank, world_size = (torch.distributed.get_rank(), torch.distributed.get_world_size()) if distributed is True else (0, 1)
 
-        model = SOASNet_segnet(in_ch=input_channel, width=width, depth=depth, norm=norm, n_classes=no_class, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit).to(device=device)
+        unlabelled_batches = stream_batches(getData_unlabelled_OCT(unlabelled_directory, train_batch if unlabelled_batch is None else unlabelled_batch, rank, world_size))
 
-    elif model_name == 'SOASNet_segnet_skip':
+        if semi_supervised == 'mean_teacher':
 
-        model = SOASNet_segnet_skip(in_ch=input_channel, width=width, depth=depth, norm=norm, n_classes=no_class, mode='low_rank_attn', side_output=False, downsampling_limit=depth_limit).to(device=device)
+            # the teacher starts from the same weights and is only ever changed by the EMA of the network:
+            teacher = create_model(network(model_name, input_channel, width, depth, depth_limit, norm, no_class, None, device), device, student_mode=True)
 
-    elif model_name == 'RelayNet':
+            teacher.load_state_dict(model.state_dict())
 
-        model = SOASNet_segnet_skip(in_ch=input_channel, width=width, depth=depth, norm=norm, n_classes=no_class, mode='relaynet', side_output=False, downsampling_limit=depth_limit).to(device=device)
+            # before the distributed wrapper, the EMA gives the parameters of the network new storage:
+            ema = ModelEMA(model, teacher, mode='static', every=ema_every)
 
-    elif model_name == 'attn_unet':
+    if distributed is True:
 
-        model = AttentionUNet(in_ch=input_channel, width=width, visulisation=False, class_no=no_class).to(device=device)
+        # running statistics are equal on every process, no need to broadcast the buffers every forward:
+        train_model = DistributedDataParallel(model, broadcast_buffers=False)
 
     # ==================================
     training_amount = len(train_dataset)
     iteration_amount = training_amount // train_batch
     iteration_amount = iteration_amount - 1
 
-    model_name = model_name + '_Epoch_' + str(epochs) + \
-                 '_Dataset_' + data_name + \
-                 '_Batch_' + str(train_batch) + \
-                 '_Width_' + str(width) + \
-                 '_Loss_' + loss + \
-                 '_Norm_' + norm + \
-                 '_ShuffleTraining_' + str(shuffle) + \
-                 '_Data_Augmentation_Train_' + data_augmentation_train + '_' + \
-                 '_Data_Augmentation_Test_' + data_augmentation_test + '_' + \
-                 '_lr_' + str(lr) + \
-                 '_Repeat_' + str(repeat)
+    model_name = experiment_name(model_name, epochs, data_name, train_batch, width, loss, norm, shuffle, data_augmentation_train, data_augmentation_test, lr, repeat)
 
-    print(model_name)
+    writer = None
 
-    writer = SummaryWriter('../../Log_' + log + '/' + model_name)
+    if main_process is True:
 
-    optimizer = AdamW(model.parameters(), lr=lr, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-5)
+        print(model_name)
 
-    # if lr_scedule is True:
-    #     learning_rate_steps = lr_scheduler.StepLR(optimizer, step_size=50, gamma=0.1)
+        writer = SummaryWriter('../../Log_' + log + '/' + model_name)
 
-    for epoch in range(epochs):
+    if optimizer_type == 'adamw':
 
-        model.train()
+        optimizer = AdamW(model.parameters(), lr=lr, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-5)
 
-        running_loss = 0
+    elif optimizer_type == 'lamb':
 
-        # i: index of mini batch
-        if 'mixup' not in data_augmentation_train:
+        optimizer = Lamb(model.parameters(), lr=lr, betas=(0.9, 0.999), eps=1e-6, weight_decay=1e-5)
 
-            for j, (images, labels, imagename) in enumerate(train_loader):
+    elif optimizer_type == 'lars':
 
-                images = images.to(device=device, dtype=torch.float32)
+        optimizer = Lars(model.parameters(), lr=lr, momentum=0.9, weight_decay=1e-5)
 
-                if no_class == 2:
+    else:
 
-                    labels = labels.to(device=device, dtype=torch.float32)
+        raise ValueError('Invalid optimizer: {}'.format(optimizer_type))
 
-                else:
+    # lr of the current epoch, the warmup scales it over its first steps:
+    epoch_lr = lr
 
-                    labels = labels.to(device=device, dtype=torch.long)
+    warmup_steps = int(warmup_epochs * len(train_loader))
 
-                outputs_logits = model(images)
+    if micro_batch is None:
 
-                optimizer.zero_grad()
+        micro_batch = train_batch
 
-                # calculate main losses for second time
-                if no_class == 2:
-                    #
-                    if loss == 'dice':
-                        #
-                        main_loss = dice_loss(torch.sigmoid(outputs_logits), labels)
-                        #
-                    elif loss == 'ce':
-                        #
-                        main_loss = nn.BCEWithLogitsLoss(reduction='mean')(outputs_logits, labels)
-                        #
-                    elif loss == 'hybrid':
-                        #
-                        main_loss = dice_loss(torch.sigmoid(outputs_logits), labels) + nn.BCEWithLogitsLoss(reduction='mean')(outputs_logits, labels)
+    bn_statistics = FullBatchStatistics(model, enabled=bn_full_batch)
 
-                else:
+    training_metrics = StreamingMetrics(no_class, device, distributed=distributed)
 
-                    # print(outputs_logits.shape)
+    batch_resize = None
 
-                    # print(labels.shape)
+    if resize_schedule is not None:
 
-                    main_loss = nn.CrossEntropyLoss(reduction='mean', ignore_index=8)(torch.softmax(outputs_logits, dim=1), labels.squeeze(1))
+        # the batches are resized in the loader workers, SOASNet models with low rank attention need square inputs:
+        batch_resize = BatchResize(train_loader.collate_fn, square=getattr(model, 'mode', None) == 'low_rank_attn', multiple=2 ** (depth + 1))
 
-                running_loss += main_loss
+        train_loader.collate_fn = batch_resize
 
-                main_loss.backward()
+    # if lr_scedule is True:
+    #     learning_rate_steps = lr_scheduler.StepLR(optimizer, step_size=50, gamma=0.1)
 
-                optimizer.step()
+    validation = None
 
-                # ==============================================================================
-                # Calculate training and validation metrics at the last iteration of each epoch
-                # ==============================================================================
+    if async_validation is True and main_process is True:
 
-                if (j + 1) % iteration_amount == 0:
+        validation = AsyncValidation(model, validate_data, class_no=no_class, threads=validation_threads)
 
-                    if no_class == 2:
+    if stop_epoch is not None and checkpoint_every is None:
 
-                        outputs = torch.sigmoid(outputs_logits)
+        raise ValueError('A paused run needs its training checkpoint, checkpoint_every must not be None.')
 
-                        # outputs = (outputs > 0.5).float()
+    if time_budget is not None and async_validation is True:
 
-                    else:
+        raise ValueError('A time budget keeps the best validated model, it needs synchronous validation.')
 
-                        _, outputs = torch.max(outputs_logits, dim=1)
+    if distillation_teacher is not None:
 
-                        # outputs = outputs.unsqueeze(1)
+        if 'mixup' in data_augmentation_train or resize_schedule is not None or semi_supervised is not None:
 
-                        labels = labels.squeeze(1)
+            raise ValueError('Distillation does not support mix-up, progressive resizing or semi-supervised training.')
 
-                    # print(outputs.shape)
+        cache_folder = '../../saved_models_' + log + '/distillation_cache/' + os.path.splitext(os.path.basename(distillation_teacher))[0] + '_' + data_name + '_' + data_augmentation_train + '_' + str(distillation_passes) + '_' + distillation_dtype
 
-                    # print(labels.shape)
+        # the main process fills the cache, the others wait and read it:
+        if main_process is False:
 
-                    # mean_iu = segmentation_scores(labels.cpu().detach().numpy(), outputs.cpu().detach().numpy(), no_class)
+            torch.distributed.barrier()
 
-                    mean_iu = intersectionAndUnion(outputs.cpu().detach(), labels.cpu().detach(), no_class)
+        distillation_dataset = DistillationDataset_OCT(train_dataset, torch.load(distillation_teacher, map_location=device, weights_only=False), cache_folder, device,
+                                                       passes=distillation_passes, dtype=distillation_dtype, batch_size=train_batch, teacher_file=distillation_teacher)
 
-                    validate_iou, validate_f1, validate_recall, validate_precision = evaluate(data=validate_data, model=model, device=device, class_no=no_class)
+        if main_process is True and distributed is True:
 
-                    # print(validate_iou.type)
+            torch.distributed.barrier()
 
-                    print(
-                        'Step [{}/{}], '
-                        'loss: {:.5f}, '
-                        'train iou: {:.5f}, '
-                        'val iou: {:.5f}'.format(epoch + 1,
-                                                 epochs,
-                                                 running_loss / (j + 1),
-                                                 mean_iu,
-                                                 validate_iou))
+        if distributed is True:
 
-                    writer.add_scalars('scalars', {'train iou': mean_iu,
-                                                   'val iou': validate_iou,
-                                                   'val f1': validate_f1,
-                                                   'val recall': validate_recall,
-                                                   'val precision': validate_precision}, epoch + 1)
+            distillation_sampler = data.distributed.DistributedSampler(distillation_dataset, num_replicas=torch.distributed.get_world_size(), rank=torch.distributed.get_rank(), shuffle=shuffle)
+
+            train_loader = data.DataLoader(distillation_dataset, batch_size=train_loader.batch_size, sampler=distillation_sampler, num_workers=train_loader.num_workers, drop_last=False)
 
         else:
-            # mix-up strategy requires more calculations:
 
-            for j, (images_1, labels_1, imagename_1, images_2, labels_2, mixed_up_image, lam) in enumerate(train_loader):
+            train_loader = data.DataLoader(distillation_dataset, batch_size=train_loader.batch_size, shuffle=shuffle, num_workers=train_loader.num_workers, drop_last=False)
 
-                mixed_up_image = mixed_up_image.to(device=device, dtype=torch.float32)
-                lam = lam.to(device=device, dtype=torch.float32)
+    if weight_averaging == 'top_k' and async_validation is True:
 
-                if no_class == 2:
-                    labels_1 = labels_1.to(device=device, dtype=torch.float32)
-                    labels_2 = labels_2.to(device=device, dtype=torch.float32)
-                else:
-                    labels_1 = labels_1.to(device=device, dtype=torch.long)
-                    labels_2 = labels_2.to(device=device, dtype=torch.long)
+        raise ValueError('Top-k weight averaging ranks the epochs by validation iou, it needs synchronous validation.')
 
-                outputs_logits = model(mixed_up_image)
+    weight_average = None
 
-                optimizer.zero_grad()
+    if weight_averaging is not None and main_process is True:
 
-                # calculate main losses for second time
-                if no_class == 2:
+        weight_average = WeightAveraging(model, mode=weight_averaging, top_k=average_top_k)
 
-                    if loss == 'dice':
+    start_epoch = 0
 
-                        main_loss = lam * dice_loss(torch.sigmoid(outputs_logits), labels_1) + (1 - lam) * dice_loss(torch.sigmoid(outputs_logits), labels_2)
+    step = 0
 
-                    elif loss == 'ce':
+    training_checkpoint = None
 
-                        main_loss = lam * nn.BCEWithLogitsLoss(reduction='mean')(outputs_logits, labels_1) + (1 - lam) * nn.BCEWithLogitsLoss(reduction='mean')(outputs_logits, labels_2)
+    best_checkpoint = None
 
-                    elif loss == 'hybrid':
+    best_iou = -1.0
 
-                        main_loss = lam * dice_loss(torch.sigmoid(outputs_logits), labels_1) \
-                                    + (1 - lam) * dice_loss(torch.sigmoid(outputs_logits), labels_2) \
-                                    + lam * nn.BCEWithLogitsLoss(reduction='mean')(outputs_logits, labels_1) \
-                                    + (1 - lam) * nn.BCEWithLogitsLoss(reduction='mean')(outputs_logits, labels_2)
+    # seconds of each epoch and of the last validation, for the time budget:
+    epoch_times = []
 
-                elif no_class == 8:
+    validation_time = 0.0
 
-                    main_loss = lam * nn.CrossEntropyLoss(reduction='mean')(outputs_logits, labels_1.squeeze(1)) + (1 - lam) * nn.CrossEntropyLoss(reduction='mean')(outputs_logits, labels_2.squeeze(1))
+    # the options of the run which are not in its name, a checkpoint of the same name is only resumed with the same options:
+    training_options = {'depth': depth, 'depth_limit': depth_limit, 'micro_batch': micro_batch, 'bn_full_batch': bn_full_batch,
+                        'optimizer_type': optimizer_type, 'warmup_epochs': warmup_epochs, 'resize_schedule': resize_schedule, 'time_budget': time_budget,
+                        'semi_supervised': semi_supervised, 'consistency': consistency, 'consistency_rampup': consistency_rampup, 'ema_decay': ema_decay, 'ema_every': ema_every,
+                        'weight_averaging': weight_averaging, 'average_top_k': average_top_k, 'swa_start': swa_start,
+                        'distillation_teacher': distillation_teacher, 'distillation_alpha': distillation_alpha, 'distillation_temperature': distillation_temperature,
+                        'distillation_passes': distillation_passes, 'distillation_dtype': distillation_dtype}
 
-                else:
-                    main_loss = lam * nn.CrossEntropyLoss(reduction='mean')(outputs_logits, labels_1.squeeze(1)) + (1 - lam) * nn.CrossEntropyLoss(reduction='mean')(outputs_logits, labels_2.squeeze(1))
+    # tuples and lists, e.g. of resize_schedule, are the same option:
+    training_options = json.loads(json.dumps(training_options))
 
-                running_loss += main_loss.mean()
+    if checkpoint_every is not None:
 
-                main_loss.mean().backward()
+        training_checkpoint = TrainingCheckpoint('../../saved_models_' + log + '/checkpoints/' + model_name + '_Checkpoint.pt', model, optimizer)
 
-                optimizer.step()
+        if resume is True:
 
-                # ==============================================================================
+            resumed = training_checkpoint.load()
+
+            if resumed is not None:
+
+                checkpoint_options = resumed['extra'].get('training_options', {})
+
+                changed = sorted(key for key in training_options if checkpoint_options.get(key) != training_options[key])
+
+                if len(changed) > 0:
+
+                    raise ValueError('The checkpoint {} was trained with other options ({}), use resume=False to train from scratch.'.format(training_checkpoint.path, ', '.join(changed)))
+
+                start_epoch = resumed['epoch']
+
+                step = resumed['step']
+
+                print('Resumed from epoch {}, step {}'.format(start_epoch, step))
+
+                if stop_epoch is not None and start_epoch > stop_epoch:
+
+                    raise ValueError('The checkpoint of {} is at epoch {}, past stop_epoch {}.'.format(model_name, start_epoch, stop_epoch))
+
+                # the checkpoint lr is the lr of the epoch unless it was taken during the warmup of a constant lr:
+                epoch_lr = optimizer.param_groups[0]['lr'] if lr_scedule is True else lr
+
+                best_iou = resumed['extra'].get('best_iou', best_iou)
+
+                if teacher is not None and resumed['extra'].get('teacher') is not None:
+
+                    teacher.load_state_dict(resumed['extra']['teacher'])
+
+                if weight_average is not None and resumed['extra'].get('weight_average') is not None:
+
+                    weight_average.load_state_dict(resumed['extra']['weight_average'])
+
+    if time_budget is not None and main_process is True:
+
+        best_checkpoint = TrainingCheckpoint('../../saved_models_' + log + '/checkpoints/' + model_name + '_Best.pt', model, optimizer)
+
+    end_epoch = epochs if stop_epoch is None else min(stop_epoch, epochs)
+
+    for epoch in range(start_epoch, end_epoch):
+
+        epoch_start = timeit.default_timer()
+
+        validate_iou = None
+
+        model.train()
+
+        training_metrics.reset()
+
+        if batch_resize is not None:
+
+            batch_resize.scale = resize_scale(resize_schedule, epoch, epochs)
+
+        if distributed is True:
+
+            # a new shuffle of the shards every epoch, the same on every process:
+            train_loader.sampler.set_epoch(epoch)
+
+        if distillation_teacher is not None:
+
+            # the augmented copy of the training set with cached logits for this epoch:
+            train_loader.dataset.set_epoch(epoch)
+
+        # i: index of mini batch
+        if 'mixup' not in data_augmentation_train:
+
+            # batches of the distillation loader also hold the cached logits of the teacher:
+            for j, (images, labels, imagename, *teacher_logits) in enumerate(train_loader):
+
+                images = images.to(device=device, dtype=torch.float32)
+
+                if no_class == 2:
+
+                    labels = labels.to(device=device, dtype=torch.float32)
+
+                else:
+
+                    labels = labels.to(device=device, dtype=torch.long)
+
+                if len(teacher_logits) > 0:
+
+                    teacher_logits = teacher_logits[0].to(device=device, dtype=torch.float32)
+
+                else:
+
+                    teacher_logits = None
+
+                optimizer.zero_grad()
+
+                bn_statistics.collect(images)
+
+                if unlabelled_batches is not None:
+
+                    unlabelled_images, unlabelled_images_teacher, unlabelled_names = next(unlabelled_batches)
+
+                    unlabelled_images = unlabelled_images.to(device=device, dtype=torch.float32)
+
+                    unlabelled_images_teacher = unlabelled_images_teacher.to(device=device, dtype=torch.float32)
+
+                    batches = [images.size(0), unlabelled_images.size(0)]
+
+                    if teacher is not None:
+
+                        # one forward of the network for the labelled and the unlabelled scans, the teacher has no backward:
+                        with torch.no_grad():
+
+                            teacher_logits = teacher(unlabelled_images_teacher)
+
+                        outputs_logits, student_logits = torch.split(train_model(torch.cat([images, unlabelled_images])), batches)
+
+                    else:
+
+                        # Pi model, both perturbations and the labelled scans in one forward:
+                        outputs_logits, student_logits, teacher_logits = torch.split(train_model(torch.cat([images, unlabelled_images, unlabelled_images_teacher])), batches + batches[1:])
+
+                    main_loss = calculate_loss(outputs_logits, labels, loss, no_class)
+
+                    training_metrics.update(outputs_logits, labels, main_loss)
+
+                    consistency_weight = consistency * sigmoid_rampup(step, consistency_rampup * len(train_loader))
+
+                    (main_loss + consistency_weight * calculate_consistency_loss(student_logits, teacher_logits, no_class)).backward()
+
+                else:
+
+                    # accumulate gradients over the micro-batches of the batch:
+                    for k, (images_micro, labels_micro) in enumerate(zip(torch.split(images, micro_batch), torch.split(labels, micro_batch))):
+
+                        # backward stays inside, checkpointed stages are recomputed with the same statistics
+                        with bn_statistics, gradient_synchronisation(train_model, last=(k + 1) * micro_batch >= images.size(0)):
+
+                            outputs_logits = train_model(images_micro)
+
+                            main_loss = calculate_loss(outputs_logits, labels_micro, loss, no_class)
+
+                            if teacher_logits is not None:
+
+                                teacher_logits_micro = teacher_logits[k * micro_batch:(k + 1) * micro_batch]
+
+                                main_loss = (1 - distillation_alpha) * main_loss + distillation_alpha * calculate_distillation_loss(outputs_logits, teacher_logits_micro, distillation_temperature, no_class)
+
+                            main_loss = main_loss * images_micro.size(0) / images.size(0)
+
+                            training_metrics.update(outputs_logits, labels_micro, main_loss)
+
+                            main_loss.backward()
+
+                if step < warmup_steps:
+
+                    # linear warmup, the last warmup step is at the lr of the epoch:
+                    for param_group in optimizer.param_groups:
+                        param_group['lr'] = epoch_lr * (step + 1) / warmup_steps
+
+                optimizer.step()
+
+                step += 1
+
+                if ema is not None:
+
+                    # the teacher follows the network more closely during the first steps:
+                    ema.update(ratio=min(1 - 1 / step, ema_decay))
+
+                # ==============================================================================
                 # Calculate training and validation metrics at the last iteration of each epoch
                 # ==============================================================================
+
                 if (j + 1) % iteration_amount == 0:
 
-                    if no_class == 2:
+                    # loss and iou over all the training batches of the epoch so far:
+                    running_loss, mean_iu = training_metrics.summary(j + 1)
 
-                        outputs = torch.sigmoid(outputs_logits)
+                    # validation and logging on the main process only:
+                    if main_process is False:
 
-                    else:
+                        continue
+
+                    if validation is not None:
+
+                        validation.submit(epoch + 1)
+
+                        print(
+                            'Step [{}/{}], '
+                            'loss: {:.5f}, '
+                            'train iou: {:.5f}'.format(epoch + 1,
+                                                       epochs,
+                                                       running_loss,
+                                                       mean_iu))
+
+                        writer.add_scalars('scalars', {'train iou': mean_iu}, epoch + 1)
+
+                        continue
+
+                    validation_start = timeit.default_timer()
+
+                    validate_iou, validate_f1, validate_recall, validate_precision = evaluate(data=validate_data, model=model, device=device, class_no=no_class)
+
+                    validation_time = timeit.default_timer() - validation_start
+
+                    # evaluate() leaves the model in eval mode, the remaining batches of the epoch are training batches:
+                    model.train()
+
+                    # print(validate_iou.type)
+
+                    print(
+                        'Step [{}/{}], '
+                        'loss: {:.5f}, '
+                        'train iou: {:.5f}, '
+                        'val iou: {:.5f}'.format(epoch + 1,
+                                                 epochs,
+                                                 running_loss,
+                                                 mean_iu,
+                                                 validate_iou))
+
+                    writer.add_scalars('scalars', {'train iou': mean_iu,
+                                                   'val iou': validate_iou,
+                                                   'val f1': validate_f1,
+                                                   'val recall': validate_recall,
+                                                   'val precision': validate_precision}, epoch + 1)
+
+        else:
+            # mix-up strategy requires more calculations:
+
+            for j, (images_1, labels_1, imagename_1, images_2, labels_2, mixed_up_image, lam) in enumerate(train_loader):
+
+                mixed_up_image = mixed_up_image.to(device=device, dtype=torch.float32)
+                lam = lam.to(device=device, dtype=torch.float32)
+
+                if no_class == 2:
+                    labels_1 = labels_1.to(device=device, dtype=torch.float32)
+                    labels_2 = labels_2.to(device=device, dtype=torch.float32)
+                else:
+                    labels_1 = labels_1.to(device=device, dtype=torch.long)
+                    labels_2 = labels_2.to(device=device, dtype=torch.long)
+
+                optimizer.zero_grad()
+
+                bn_statistics.collect(mixed_up_image)
+
+                # accumulate gradients over the micro-batches of the batch:
+                for k, (mixed_up_image_micro, labels_1_micro, labels_2_micro, lam_micro) in enumerate(zip(torch.split(mixed_up_image, micro_batch), torch.split(labels_1, micro_batch), torch.split(labels_2, micro_batch), torch.split(lam, micro_batch))):
+
+                    with bn_statistics, gradient_synchronisation(train_model, last=(k + 1) * micro_batch >= mixed_up_image.size(0)):
+
+                        outputs_logits = train_model(mixed_up_image_micro)
+
+                        main_loss = calculate_mixup_loss(outputs_logits, labels_1_micro, labels_2_micro, lam_micro, loss, no_class) * mixed_up_image_micro.size(0) / mixed_up_image.size(0)
+
+                        training_metrics.update(outputs_logits, labels_1_micro, main_loss, weight=lam_micro)
+
+                        training_metrics.update(outputs_logits, labels_2_micro, weight=1 - lam_micro)
+
+                        main_loss.backward()
 
-                        _, outputs = torch.max(outputs_logits, dim=1)
+                if step < warmup_steps:
 
-                        outputs = outputs.unsqueeze(1)
+                    # linear warmup, the last warmup step is at the lr of the epoch:
+                    for param_group in optimizer.param_groups:
+                        param_group['lr'] = epoch_lr * (step + 1) / warmup_steps
 
-                    mean_iu_1 = segmentation_scores(labels_1.cpu().detach().numpy(), outputs.cpu().detach().numpy(), no_class)
+                optimizer.step()
+
+                step += 1
+
+                # ==============================================================================
+                # Calculate training and validation metrics at the last iteration of each epoch
+                # ==============================================================================
+                if (j + 1) % iteration_amount == 0:
+
+                    # confusion matrix weighted by lam against both labels:
+                    running_loss, mean_iu = training_metrics.summary(j + 1)
 
-                    mean_iu_2 = segmentation_scores(labels_2.cpu().detach().numpy(), outputs.cpu().detach().numpy(), no_class)
+                    if main_process is False:
 
-                    mean_iu = lam.data.sum() * mean_iu_1 + (1 - lam.data.sum()) * mean_iu_2
+                        continue
+
+                    if validation is not None:
+
+                        validation.submit(epoch + 1)
+
+                        print(
+                            'Step [{}/{}], '
+                            'loss: {:.4f}, '
+                            'train iou: {:.4f}'.format(epoch + 1,
+                                                       epochs,
+                                                       running_loss,
+                                                       mean_iu))
+
+                        writer.add_scalars('scalars', {'train iou': mean_iu}, epoch + 1)
+
+                        continue
+
+                    validation_start = timeit.default_timer()
 
                     validate_iou, validate_f1, validate_recall, validate_precision = evaluate(data=validate_data, model=model, device=device, class_no=no_class)
 
-                    mean_iu = mean_iu.item()
+                    validation_time = timeit.default_timer() - validation_start
+
+                    model.train()
 
                     print(
                         'Step [{}/{}], '
@@ -459,7 +1131,7 @@ def trainSingleModel(model_name,
                         'train iou: {:.4f}, '
                         'val iou: {:.4f}'.format(epoch + 1,
                                                  epochs,
-                                                 running_loss / (j + 1),
+                                                 running_loss,
                                                  mean_iu,
                                                  validate_iou))
 
@@ -469,72 +1141,629 @@ def trainSingleModel(model_name,
                                                    'val recall': validate_recall,
                                                    'val precision': validate_precision}, epoch + 1)
 
+        fitting_epochs = end_epoch - epoch - 1
+
+        if time_budget is not None:
+
+            epoch_times.append(timeit.default_timer() - epoch_start)
+
+            # time kept for saving and testing, testing saves the segmentations and takes about twice as long per image as validating:
+            test_time = 2 * validation_time * (len(test_data_1) + len(test_data_2)) / len(validate_data.dataset)
+
+            if weight_averaging is not None:
+
+                # the BatchNorm recalibration is a forward of the training set, about a third of an epoch:
+                test_time += np.mean(epoch_times) / 3
+
+            remaining_time = time_budget - (timeit.default_timer() - start_time) - test_time
+
+            fitting_epochs = int(min(max(remaining_time // np.mean(epoch_times), 0), fitting_epochs))
+
+            if distributed is True:
+
+                # every process stops after the same epoch, the one measured by the main process:
+                fitting_epochs = torch.tensor(fitting_epochs)
+
+                torch.distributed.broadcast(fitting_epochs, 0)
+
+                fitting_epochs = int(fitting_epochs)
+
+        if lr_scedule is True:
+
+            if time_budget is None:
+
+                epoch_lr = lr*((1 - epoch / epochs)**0.999)
+
+            else:
+
+                # the polynomial decay over the epochs projected to fit in the budget, the epoch schedule when all of them fit:
+                projected_epochs = epoch + 1 + fitting_epochs
+
+                epoch_lr = lr*((1 - epoch / projected_epochs)**0.999)
+
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = epoch_lr
+
+        if validation is not None:
+
+            log_validation(writer, epochs, validation.poll())
+
+        if best_checkpoint is not None and validate_iou is not None and validate_iou > best_iou:
+
+            best_iou = float(validate_iou)
+
+            best_checkpoint.save(epoch=epoch + 1, step=step, validate_iou=best_iou)
+
+        if weight_average is not None:
+
+            if weight_averaging == 'top_k' and validate_iou is not None:
+
+                weight_average.update(float(validate_iou))
+
+            elif weight_averaging == 'swa' and epoch + 1 > swa_start * epochs:
+
+                weight_average.update()
+
+        # the checkpoint is taken after the lr update, so a resumed run starts the next epoch with the right lr:
+        if training_checkpoint is not None and main_process is True and ((epoch + 1) % checkpoint_every == 0 or epoch + 1 == end_epoch or fitting_epochs == 0):
+
+            training_checkpoint.save(epoch=epoch + 1, step=step, training_options=training_options, best_iou=best_iou, teacher=None if teacher is None else teacher.state_dict(), weight_average=None if weight_average is None else weight_average.state_dict())
+
+        if time_budget is not None and fitting_epochs == 0:
+
+            if main_process is True and epoch + 1 < end_epoch:
+
+                print('Time budget: stopping after epoch {} of {}'.format(epoch + 1, epochs))
+
+            break
+
+    if training_checkpoint is not None:
+
+        training_checkpoint.close()
+
+    if batch_resize is not None:
+
+        # the loader may be used again for the next repeat:
+        train_loader.collate_fn = batch_resize.collate_fn
+
+    if best_checkpoint is not None:
+
+        best_checkpoint.close()
+
+        # the best validated model is saved and tested instead of the last one:
+        if best_checkpoint.load() is not None:
+
+            print('Testing the model of the best validation iou {:.4f}'.format(best_iou))
+
+    if validation is not None:
+
+        log_validation(writer, epochs, validation.close())
+
+    if main_process is False:
+
+        return None
+
+    # the event writer thread must finish before a launched process exits:
+    writer.close()
+
+    if stop_epoch is not None:
+
+        # the paused model stays in its checkpoint, it is only validated:
+        validate_iou, validate_f1, validate_recall, validate_precision = evaluate(data=validate_data, model=model, device=device, class_no=no_class)
+
+        return float(validate_iou)
+
+    if distributed is True and device.type == 'cpu':
+
+        # the saved model is loaded and tested without a process group:
+        model = revert_distributed_batchnorm(model)
+
+    if weight_average is not None:
+
+        averaged_epochs = weight_average.average_into(model)
+
+        if averaged_epochs > 0:
+
+            # on the shard of the main process when distributed, the other processes have finished:
+            recalibrate_batchnorm(model, train_loader, device)
+
+            validate_iou, validate_f1, validate_recall, validate_precision = evaluate(data=validate_data, model=model, device=device, class_no=no_class)
+
+            print('Weights averaged over {} epochs, val iou: {:.5f}'.format(averaged_epochs, validate_iou))
+
+    saved_model = save_and_test(model, model_name, log, test_data_1, test_data_2, device, no_class)
+
+    # the run is finished, running the experiment again trains it again:
+    for checkpoint in [training_checkpoint, best_checkpoint]:
+
+        if checkpoint is not None:
+
+            checkpoint.remove()
+
+    return saved_model
+
+
+def trainMultiSeedModels(model_name,
+                         seeds,
+                         depth_limit,
+                         epochs,
+                         width,
+                         depth,
+                         lr,
+                         lr_scedule,
+                         train_dataset,
+                         train_batch,
+                         data_name,
+                         data_augmentation_train,
+                         data_augmentation_test,
+                         train_loader,
+                         validate_data,
+                         test_data_1,
+                         test_data_2,
+                         shuffle,
+                         loss,
+                         norm,
+                         log,
+                         no_class,
+                         input_channel,
+                         checkpoint_every=1,
+                         resume=True):
+    # trains the repeats 1, ..., seeds of one experiment together in one process:
+    # the copies have their own initialisation, their parameters are stacked and the forward / backward
+    # are vectorised over the copies with torch.func.vmap. Every copy has its own shuffling of the training
+    # set (MultiSeedBatchSampler), one loader step loads the next batch of every copy.
+    # Each repeat is logged, saved and tested as by trainSingleModel.
+    # :param seeds: number of repeats trained together
+    # see trainSingleModel for the other parameters, micro-batching, activation checkpointing and mix-up are not supported
+    # :return: list of the paths of the saved models
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
+    if 'mixup' in data_augmentation_train:
+
+        raise ValueError('Mix-up is not supported when training repeats together.')
+
+    # consecutive initialisations from the global generator, as sequential repeats:
+    models = [network(model_name, input_channel, width, depth, depth_limit, norm, no_class, None, device) for k in range(seeds)]
+
+    stacked_models = StackedModels(models)
+
+    # train_loader only gives its number of workers, the batches of the copies are drawn from the training set:
+    seed_sampler = MultiSeedBatchSampler(len(train_dataset), train_batch, seeds, shuffle=shuffle, seed=int(torch.randint(2 ** 31, (1,))))
+
+    train_loader = data.DataLoader(train_dataset, batch_sampler=seed_sampler, num_workers=train_loader.num_workers)
+
+    # ==================================
+    training_amount = len(train_dataset)
+    iteration_amount = training_amount // train_batch
+    iteration_amount = iteration_amount - 1
+
+    model_names = [experiment_name(model_name, epochs, data_name, train_batch, width, loss, norm, shuffle, data_augmentation_train, data_augmentation_test, lr, k + 1) for k in range(seeds)]
+
+    print(model_names)
+
+    writers = [SummaryWriter('../../Log_' + log + '/' + name) for name in model_names]
+
+    # AdamW is element-wise, the stacked copies are optimised independently:
+    optimizer = AdamW(stacked_models.parameters(), lr=lr, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-5)
+
+    training_metrics = [StreamingMetrics(no_class, device) for k in range(seeds)]
+
+    start_epoch = 0
+
+    step = 0
+
+    training_checkpoint = None
+
+    if checkpoint_every is not None:
+
+        training_checkpoint = TrainingCheckpoint('../../saved_models_' + log + '/checkpoints/' + model_names[0] + '_Seeds_' + str(seeds) + '_Checkpoint.pt', stacked_models, optimizer)
+
+        if resume is True:
+
+            resumed = training_checkpoint.load()
+
+            if resumed is not None:
+
+                start_epoch = resumed['epoch']
+
+                step = resumed['step']
+
+                # the remaining epochs keep the shufflings of the interrupted run:
+                seed_sampler.seed = resumed['extra'].get('sampler_seed', seed_sampler.seed)
+
+                print('Resumed from epoch {}, step {}'.format(start_epoch, step))
+
+    for epoch in range(start_epoch, epochs):
+
+        seed_sampler.set_epoch(epoch)
+
+        stacked_models.train()
+
+        for k in range(seeds):
+
+            training_metrics[k].reset()
+
+        for j, (images, labels, imagename) in enumerate(train_loader):
+
+            images = images.to(device=device, dtype=torch.float32)
+
+            if no_class == 2:
+
+                labels = labels.to(device=device, dtype=torch.float32)
+
+            else:
+
+                labels = labels.to(device=device, dtype=torch.long)
+
+            # the batches of the copies one after the other, see MultiSeedBatchSampler:
+            seed_images = images.view((seeds, -1) + tuple(images.shape[1:]))
+
+            seed_labels = labels.view((seeds, -1) + tuple(labels.shape[1:]))
+
+            optimizer.zero_grad()
+
+            outputs_logits = stacked_models(seed_images)
+
+            main_losses = [calculate_loss(outputs_logits[k], seed_labels[k], loss, no_class) for k in range(seeds)]
+
+            # the copies do not share parameters, the gradient of the sum is the gradient of each loss:
+            sum(main_losses).backward()
+
+            optimizer.step()
+
+            step += 1
+
+            for k in range(seeds):
+
+                training_metrics[k].update(outputs_logits[k], seed_labels[k], main_losses[k])
+
+            # ==============================================================================
+            # Calculate training and validation metrics at the last iteration of each epoch
+            # ==============================================================================
+
+            if (j + 1) % iteration_amount == 0:
+
+                for k, model in enumerate(stacked_models.unstack()):
+
+                    running_loss, mean_iu = training_metrics[k].summary(j + 1)
+
+                    validate_iou, validate_f1, validate_recall, validate_precision = evaluate(data=validate_data, model=model, device=device, class_no=no_class)
+
+                    print(
+                        'Repeat {}, '
+                        'Step [{}/{}], '
+                        'loss: {:.5f}, '
+                        'train iou: {:.5f}, '
+                        'val iou: {:.5f}'.format(k + 1,
+                                                 epoch + 1,
+                                                 epochs,
+                                                 running_loss,
+                                                 mean_iu,
+                                                 validate_iou))
+
+                    writers[k].add_scalars('scalars', {'train iou': mean_iu,
+                                                       'val iou': validate_iou,
+                                                       'val f1': validate_f1,
+                                                       'val recall': validate_recall,
+                                                       'val precision': validate_precision}, epoch + 1)
+
+                stacked_models.train()
+
         if lr_scedule is True:
             for param_group in optimizer.param_groups:
                 param_group['lr'] = lr*((1 - epoch / epochs)**0.999)
 
-    # save model
-    save_folder = '../../saved_models_' + log
+        if training_checkpoint is not None and ((epoch + 1) % checkpoint_every == 0 or epoch + 1 == epochs):
+
+            training_checkpoint.save(epoch=epoch + 1, step=step, sampler_seed=seed_sampler.seed)
+
+    if training_checkpoint is not None:
+
+        training_checkpoint.close()
+
+    saved_models = [save_and_test(model, name, log, test_data_1, test_data_2, device, no_class) for model, name in zip(stacked_models.unstack(), model_names)]
+
+    if training_checkpoint is not None:
+
+        training_checkpoint.remove()
+
+    return saved_models
+
+
+def trainFanOutModels(model_name,
+                      depth_limit,
+                      epochs,
+                      width,
+                      depth,
+                      repeat,
+                      lr,
+                      lr_scedule,
+                      train_dataset,
+                      train_batch,
+                      data_name,
+                      data_augmentation_train,
+                      data_augmentation_test,
+                      train_loader,
+                      validate_data,
+                      test_data_1,
+                      test_data_2,
+                      shuffle,
+                      loss,
+                      norm,
+                      log,
+                      no_class,
+                      input_channel,
+                      checkpointing=None,
+                      checkpoint_every=1,
+                      resume=True):
+    # trains several architectures on the same batches: every loaded and augmented batch feeds all the networks,
+    # so loading and augmentation are paid once for the whole comparison.
+    # Each network has its own optimizer, metrics, logs, checkpoints, saved model and test results, as by trainSingleModel.
+    # :param model_name: list of network tags of the registry in network(), e.g. ['unet', 'Segnet', 'RelayNet', 'SOASNet']
+    # see trainSingleModel for the other parameters
+    # :return: list of the paths of the saved models
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
+    models = [network(name, input_channel, width, depth, depth_limit, norm, no_class, checkpointing, device) for name in model_name]
 
-    try:
+    # ==================================
+    training_amount = len(train_dataset)
+    iteration_amount = training_amount // train_batch
+    iteration_amount = iteration_amount - 1
 
-        os.makedirs(save_folder)
+    model_names = [experiment_name(name, epochs, data_name, train_batch, width, loss, norm, shuffle, data_augmentation_train, data_augmentation_test, lr, repeat) for name in model_name]
 
-    except OSError as exc:
+    print(model_names)
 
-        if exc.errno != errno.EEXIST:
+    writers = [SummaryWriter('../../Log_' + log + '/' + name) for name in model_names]
 
-            raise
-    pass
+    optimizers = [AdamW(model.parameters(), lr=lr, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-5) for model in models]
 
-    save_model_name = model_name + '_Final'
+    training_metrics = [StreamingMetrics(no_class, device) for model in models]
 
-    save_model_name_full = save_folder + '/' + save_model_name + '.pt'
+    start_epoch = 0
 
-    torch.save(model, save_model_name_full)
-    # =======================================================================
-    # testing (disabled during training, because it is too slow)
-    # =======================================================================
-    save_results_folder = save_folder + '/testing_results_' + model_name
+    step = 0
 
-    try:
-        os.makedirs(save_results_folder)
-    except OSError as exc:
-        if exc.errno != errno.EEXIST:
-            raise
-    pass
+    training_checkpoints = []
 
-    test_iou_1, test_f1_1, test_recall_1, test_precision_1, mse_1, test_iou_2, test_f1_2, test_recall_2, test_precision_2, mse_2, outputs_1, outputs_2 = test(data_1=test_data_1,
-                                                                                                                                                              data_2=test_data_2,
-                                                                                                                                                              model=model,
-                                                                                                                                                              device=device,
-                                                                                                                                                              class_no=no_class,
-                                                                                                                                                              save_location=save_results_folder)
+    if checkpoint_every is not None:
 
-    print(
-        'test iou data 1: {:.4f}, '
-        'test mse data 1: {:.4f}, '
-        'test f1 data 1: {:.4f},'
-        'test recall data 1: {:.4f}, '
-        'test precision data 1: {:.4f}, '.format(test_iou_1,
-                                                 mse_1,
-                                                 test_f1_1,
-                                                 test_recall_1,
-                                                 test_precision_1))
+        training_checkpoints = [TrainingCheckpoint('../../saved_models_' + log + '/checkpoints/' + name + '_Checkpoint.pt', model, optimizer) for name, model, optimizer in zip(model_names, models, optimizers)]
 
-    print(
-        'test iou data 2: {:.4f}, '
-        'test mse data 2: {:.4f}, '
-        'test f1 data 2: {:.4f},'
-        'test recall data 2: {:.4f}, '
-        'test precision data 2: {:.4f}, '.format(test_iou_2,
-                                                 mse_2,
-                                                 test_f1_2,
-                                                 test_recall_2,
-                                                 test_precision_2))
+        if resume is True:
 
-    print('\nTesting finished and results saved.\n')
+            resumed = [training_checkpoint.load() for training_checkpoint in training_checkpoints]
 
-    return save_model_name_full
+            # all the networks continue from the same epoch, or all of them start again:
+            if all(r is not None for r in resumed) and len(set(r['epoch'] for r in resumed)) == 1:
+
+                start_epoch = resumed[0]['epoch']
+
+                step = resumed[0]['step']
+
+                print('Resumed from epoch {}, step {}'.format(start_epoch, step))
+
+            elif any(r is not None for r in resumed):
+
+                raise RuntimeError('Checkpoints of the networks are from different epochs, remove them to start again.')
+
+    for epoch in range(start_epoch, epochs):
+
+        for model, metrics in zip(models, training_metrics):
+
+            model.train()
+
+            metrics.reset()
+
+        for j, batch in enumerate(train_loader):
+
+            if 'mixup' not in data_augmentation_train:
+
+                images, labels, imagename = batch
+
+                images = images.to(device=device, dtype=torch.float32)
+
+                labels = labels.to(device=device, dtype=torch.float32 if no_class == 2 else torch.long)
+
+            else:
+
+                images_1, labels_1, imagename_1, images_2, labels_2, images, lam = batch
+
+                images = images.to(device=device, dtype=torch.float32)
+
+                lam = lam.to(device=device, dtype=torch.float32)
+
+                labels_1 = labels_1.to(device=device, dtype=torch.float32 if no_class == 2 else torch.long)
+
+                labels_2 = labels_2.to(device=device, dtype=torch.float32 if no_class == 2 else torch.long)
+
+            for model, optimizer, metrics in zip(models, optimizers, training_metrics):
+
+                optimizer.zero_grad()
+
+                outputs_logits = model(images)
+
+                if 'mixup' not in data_augmentation_train:
+
+                    main_loss = calculate_loss(outputs_logits, labels, loss, no_class)
+
+                    metrics.update(outputs_logits, labels, main_loss)
+
+                else:
+
+                    main_loss = calculate_mixup_loss(outputs_logits, labels_1, labels_2, lam, loss, no_class)
+
+                    metrics.update(outputs_logits, labels_1, main_loss, weight=lam)
+
+                    metrics.update(outputs_logits, labels_2, weight=1 - lam)
+
+                main_loss.backward()
+
+                optimizer.step()
+
+            step += 1
+
+            # ==============================================================================
+            # Calculate training and validation metrics at the last iteration of each epoch
+            # ==============================================================================
+
+            if (j + 1) % iteration_amount == 0:
+
+                for name, model, metrics, writer in zip(model_name, models, training_metrics, writers):
+
+                    running_loss, mean_iu = metrics.summary(j + 1)
+
+                    validate_iou, validate_f1, validate_recall, validate_precision = evaluate(data=validate_data, model=model, device=device, class_no=no_class)
+
+                    print(
+                        '{}, '
+                        'Step [{}/{}], '
+                        'loss: {:.5f}, '
+                        'train iou: {:.5f}, '
+                        'val iou: {:.5f}'.format(name,
+                                                 epoch + 1,
+                                                 epochs,
+                                                 running_loss,
+                                                 mean_iu,
+                                                 validate_iou))
+
+                    writer.add_scalars('scalars', {'train iou': mean_iu,
+                                                   'val iou': validate_iou,
+                                                   'val f1': validate_f1,
+                                                   'val recall': validate_recall,
+                                                   'val precision': validate_precision}, epoch + 1)
+
+                    model.train()
+
+        if lr_scedule is True:
+            for optimizer in optimizers:
+                for param_group in optimizer.param_groups:
+                    param_group['lr'] = lr*((1 - epoch / epochs)**0.999)
+
+        if (epoch + 1) % (checkpoint_every or 1) == 0 or epoch + 1 == epochs:
+
+            for training_checkpoint in training_checkpoints:
+
+                training_checkpoint.save(epoch=epoch + 1, step=step)
+
+    for training_checkpoint in training_checkpoints:
+
+        training_checkpoint.close()
+
+    saved_models = [save_and_test(model, name, log, test_data_1, test_data_2, device, no_class) for model, name in zip(models, model_names)]
+
+    for training_checkpoint in training_checkpoints:
+
+        training_checkpoint.remove()
+
+    return saved_models
+
+
+def adaptModel(saved_model,
+               data_directory,
+               data_name,
+               epochs,
+               lr,
+               train_batch,
+               loss,
+               log,
+               no_class,
+               lr_scedule=True,
+               cache_dtype='float16',
+               repeat=1):
+    # site adaptation: fine-tunes the decoder of a trained network on the data of a new scanner, the encoder stays frozen.
+    # The frozen encoder runs once over the training scans, its multi-scale features (for SOASNet also the height and
+    # width path features) are cached in memory-mapped files and every epoch only runs the decoder on them.
+    # The cached scans are not augmented. Validation and testing run the whole network.
+    # :param saved_model: path of a network saved by save_and_test, with encode / decode methods (SOASNet models, unet)
+    # :param data_directory: folder of the data of the new site, with train, val, test_1 and test_2 as for getData_OCT
+    # :param data_name: name of the new site, for the cache, logs and saved model
+    # :param cache_dtype: 'float16' or 'float32', dtype of the cached features
+    # see trainSingleModel for the other parameters
+    # :return: path of the adapted model
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
+    model = torch.load(saved_model, map_location=device, weights_only=False)
+
+    if not hasattr(model, 'encode'):
+
+        raise ValueError('{} has no encode / decode split, it can not be adapted on cached features.'.format(type(model).__name__))
+
+    train_loader, train_dataset, validate_data, test_data_1, test_data_2 = getData_OCT(data_directory, train_batch, shuffle_mode=False, augmentation_train='none', augmentation_test='none')
+
+    source_name = os.path.splitext(os.path.basename(saved_model))[0]
+
+    if source_name.endswith('_Final'):
+
+        source_name = source_name[:-len('_Final')]
+
+    model_name = source_name + '_Adapted_' + data_name + '_Epoch_' + str(epochs) + '_Batch_' + str(train_batch) + '_lr_' + str(lr) + '_Repeat_' + str(repeat)
+
+    print(model_name)
+
+    writer = SummaryWriter('../../Log_' + log + '/' + model_name)
+
+    images, labels, imagename = train_dataset[0]
+
+    parameters = freeze_encoder(model, torch.from_numpy(images).unsqueeze(0).to(device=device, dtype=torch.float32))
+
+    cached_features = CachedFeatures_OCT(model, train_dataset, '../../saved_models_' + log + '/feature_cache/' + source_name + '_' + data_name, device, dtype=cache_dtype, batch_size=train_batch, model_file=saved_model)
+
+    cached_loader = data.DataLoader(cached_features, batch_size=train_batch, shuffle=True, num_workers=2, drop_last=False)
+
+    optimizer = AdamW(parameters, lr=lr, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-5)
+
+    training_metrics = StreamingMetrics(no_class, device)
+
+    for epoch in range(epochs):
+
+        model.train()
+
+        training_metrics.reset()
+
+        for j, (features, labels, imagename) in enumerate(cached_loader):
+
+            features = [feature.to(device=device, dtype=torch.float32) for feature in features]
+
+            labels = labels.to(device=device, dtype=torch.float32 if no_class == 2 else torch.long)
+
+            optimizer.zero_grad()
+
+            outputs_logits = model.decode(features)
+
+            main_loss = calculate_loss(outputs_logits, labels, loss, no_class)
+
+            training_metrics.update(outputs_logits, labels, main_loss)
+
+            main_loss.backward()
+
+            optimizer.step()
+
+        running_loss, mean_iu = training_metrics.summary(len(cached_loader))
+
+        validate_iou, validate_f1, validate_recall, validate_precision = evaluate(data=validate_data, model=model, device=device, class_no=no_class)
+
+        print(
+            'Step [{}/{}], '
+            'loss: {:.5f}, '
+            'train iou: {:.5f}, '
+            'val iou: {:.5f}'.format(epoch + 1,
+                                     epochs,
+                                     running_loss,
+                                     mean_iu,
+                                     validate_iou))
+
+        writer.add_scalars('scalars', {'train iou': mean_iu,
+                                       'val iou': validate_iou,
+                                       'val f1': validate_f1,
+                                       'val recall': validate_recall,
+                                       'val precision': validate_precision}, epoch + 1)
+
+        if lr_scedule is True:
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = lr*((1 - epoch / epochs)**0.999)
 
+    writer.close()
 
+    return save_and_test(model, model_name, log, test_data_1, test_data_2, device, no_class)
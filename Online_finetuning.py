@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+from Experiment_queue import make_folder, write_json
+# ==========================================================================
+# Online fine-tuning service.
+# Watches the training folder of a data set (train/images/*.jpg with the
+# masks train/masks/<same name>.npy) and keeps a manifest of the labelled
+# scans seen so far. When enough new scans have arrived, the published model
+# is fine-tuned on the new scans mixed with a replay buffer of old ones, and
+# a new version is published only if its validation iou does not regress.
+# The replay buffer is a reservoir sample of all the scans seen before, its
+# size is bounded whatever the number of scans.
+#
+# The state folder holds:
+# - manifest.json: the labelled scans seen so far
+# - replay.json: the replay buffer and the number of scans offered to it
+# - published.json: version, path and validation iou of the published model
+# - models/model_v<version>.pt: the published versions
+#
+# Usage:
+#   python Online_finetuning.py /data/OCT/ours/ --model saved_models_ours/SOASNet_..._Final.pt --state online/
+#   python Online_finetuning.py /data/OCT/ours/ --state online/ --once
+# ==========================================================================
+
+
+def read_json(path, default):
+    if os.path.isfile(path):
+        with open(path) as f:
+            return json.load(f)
+    return default
+
+
+def scan_folder(data_directory, manifest, settle=60):
+    # :param data_directory: folder of the data set, the scans are in train/images and train/masks
+    # :param manifest: dictionary {name: {'image', 'label', 'time'}} of the scans already seen
+    # :param settle: seconds without modification after which a file is complete, files still being copied are left for later
+    # :return: list of the names of the new labelled scans, added to the manifest
+    image_folder = os.path.join(data_directory, 'train', 'images')
+    label_folder = os.path.join(data_directory, 'train', 'masks')
+    now = time.time()
+    new = []
+    #
+    for image_name in sorted(os.listdir(image_folder)):
+        #
+        name, extension = os.path.splitext(image_name)
+        #
+        if extension != '.jpg' or name in manifest:
+            continue
+        #
+        image = os.path.join(image_folder, image_name)
+        label = os.path.join(label_folder, name + '.npy')
+        # a scan is only used once its mask has arrived:
+        if not os.path.isfile(label) or now - max(os.path.getmtime(image), os.path.getmtime(label)) < settle:
+            continue
+        #
+        manifest[name] = {'image': os.path.abspath(image), 'label': os.path.abspath(label), 'time': now}
+        new.append(name)
+    #
+    return new
+
+
+class ReservoirBuffer(object):
+    # uniform sample of at most size of all the scans offered so far (reservoir sampling)
+    def __init__(self, size, state=None, seed=0):
+        self.size = size
+        self.items = [] if state is None else state['items']
+        self.seen = 0 if state is None else state['seen']
+        self.generator = random.Random(seed + self.seen)
+
+    def add(self, item):
+        self.seen += 1
+        #
+        if len(self.items) < self.size:
+            self.items.append(item)
+        else:
+            # the n-th scan replaces a random one with probability size / n:
+            k = self.generator.randrange(self.seen)
+            if k < self.size:
+                self.items[k] = item
+
+    def state_dict(self):
+        return {'items': self.items, 'seen': self.seen}
+
+
+def finetune(model_path, entries, data_directory, epochs, lr, batch, loss, no_class, augmentation):
+    # fine-tunes the model on the scans of the entries
+    # :param entries: manifest entries of the new scans and of the replayed ones
+    # :return: fine-tuned model, its validation iou, validation iou of the model before fine-tuning
+    import torch
+    from torch.utils import data
+    from NNUtils import CustomDataset_OCT, evaluate
+    from OCT_train import calculate_loss
+    from adamW import AdamW
+    #
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    model = torch.load(model_path, map_location=device, weights_only=False)
+    #
+    validate_dataset = CustomDataset_OCT(os.path.join(data_directory, 'val', 'images'), os.path.join(data_directory, 'val', 'masks'), teacher_student=False, transforms='none')
+    validate_data = data.DataLoader(validate_dataset, batch_size=2, shuffle=False, num_workers=2, drop_last=False)
+    #
+    previous_iou = evaluate(data=validate_data, model=model, device=device, class_no=no_class)[0]
+    #
+    train_dataset = CustomDataset_OCT(None, None, teacher_student=False, transforms=augmentation, image_files=[entry['image'] for entry in entries], label_files=[entry['label'] for entry in entries])
+    train_loader = data.DataLoader(train_dataset, batch_size=batch, shuffle=True, num_workers=4, drop_last=False)
+    #
+    optimizer = AdamW(model.parameters(), lr=lr, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-5)
+    #
+    for epoch in range(epochs):
+        #
+        model.train()
+        #
+        for images, labels, imagename in train_loader:
+            #
+            images = images.to(device=device, dtype=torch.float32)
+            labels = labels.to(device=device, dtype=torch.float32 if no_class == 2 else torch.long)
+            #
+            optimizer.zero_grad()
+            main_loss = calculate_loss(model(images), labels, loss, no_class)
+            main_loss.backward()
+            optimizer.step()
+        # the lr decays linearly over the few epochs of a refresh:
+        for param_group in optimizer.param_groups:
+            param_group['lr'] = lr * (1 - (epoch + 1) / epochs)
+    #
+    validate_iou = evaluate(data=validate_data, model=model, device=device, class_no=no_class)[0]
+    #
+    return model, float(validate_iou), float(previous_iou)
+
+
+def publish(model, state_directory, published, validate_iou, samples):
+    # saves the model as the next version, written to a temporary file and renamed, then updates published.json
+    import torch
+    #
+    version = published.get('version', 0) + 1
+    path = os.path.join(state_directory, 'models', 'model_v' + str(version) + '.pt')
+    temp_path = path + '.tmp'
+    torch.save(model, temp_path)
+    os.replace(temp_path, path)
+    #
+    published = {'version': version, 'path': os.path.abspath(path), 'val_iou': validate_iou, 'samples': samples, 'time': time.time()}
+    write_json(os.path.join(state_directory, 'published.json'), published)
+    #
+    return published
+
+
+def refresh(args):
+    # one round of the service: new scans, fine-tuning and publishing
+    # :return: True if a new version was published
+    manifest_file = os.path.join(args.state, 'manifest.json')
+    replay_file = os.path.join(args.state, 'replay.json')
+    published_file = os.path.join(args.state, 'published.json')
+    #
+    manifest = read_json(manifest_file, {})
+    published = read_json(published_file, {})
+    replay = ReservoirBuffer(args.replay_size, read_json(replay_file, None), seed=args.seed)
+    #
+    if 'path' not in published:
+        #
+        if args.model is None:
+            raise ValueError('No published model yet, the first model must be given with --model.')
+        #
+        published = {'version': 0, 'path': os.path.abspath(args.model), 'val_iou': None, 'samples': 0, 'time': time.time()}
+        write_json(published_file, published)
+    #
+    # scans of a previous round which were not fine-tuned yet are pending in the manifest:
+    new = scan_folder(args.data_directory, manifest, settle=args.settle)
+    pending = [name for name, entry in manifest.items() if entry.get('used', False) is False]
+    write_json(manifest_file, manifest)
+    #
+    if len(new) > 0:
+        print('{} new labelled scans, {} pending'.format(len(new), len(pending)))
+    #
+    if len(pending) < args.min_new:
+        return False
+    #
+    entries = [manifest[name] for name in pending] + [manifest[name] for name in replay.items if name in manifest]
+    print('Fine-tuning version {} on {} new and {} replayed scans'.format(published['version'], len(pending), len(entries) - len(pending)))
+    #
+    start = time.time()
+    model, validate_iou, previous_iou = finetune(published['path'], entries, args.data_directory, args.epochs, args.lr, args.batch, args.loss, args.class_no, args.augmentation)
+    #
+    print('val iou {:.5f}, published version {:.5f}, {:.0f} s'.format(validate_iou, previous_iou, time.time() - start))
+    # the scans are used either way, they go into the replay buffer once they have been trained on:
+    for name in pending:
+        manifest[name]['used'] = True
+        replay.add(name)
+    #
+    write_json(manifest_file, manifest)
+    write_json(replay_file, replay.state_dict())
+    #
+    if validate_iou + args.tolerance < previous_iou:
+        print('Not published, the val iou regressed.')
+        return False
+    #
+    published = publish(model, args.state, published, validate_iou, published['samples'] + len(pending))
+    print('Published version {}: {}'.format(published['version'], published['path']))
+    #
+    return True
+
+
+if __name__ == '__main__':
+    #
+    parser = argparse.ArgumentParser(description='Fine-tune and publish a model as new labelled scans arrive.')
+    parser.add_argument('data_directory', help='data set with train/images, train/masks, val/images and val/masks')
+    parser.add_argument('--model', default=None, help='model to start from, a model saved by save_and_test')
+    parser.add_argument('--state', default='online', help='folder of the manifest, replay buffer and published models')
+    parser.add_argument('--poll', type=float, default=600, help='seconds between two scans of the folder')
+    parser.add_argument('--settle', type=float, default=60, help='seconds without modification before a new file is used')
+    parser.add_argument('--min-new', type=int, default=16, help='new scans needed for a refresh')
+    parser.add_argument('--replay-size', type=int, default=256, help='old scans kept in the replay buffer')
+    parser.add_argument('--epochs', type=int, default=5, help='epochs of a refresh over the new and replayed scans')
+    parser.add_argument('--lr', type=float, default=1e-4, help='learning rate of the fine-tuning')
+    parser.add_argument('--batch', type=int, default=4)
+    parser.add_argument('--loss', default='ce')
+    parser.add_argument('--class-no', type=int, default=2)
+    parser.add_argument('--augmentation', default='flip', help='augmentation of the training scans, see CustomDataset_OCT')
+    parser.add_argument('--tolerance', type=float, default=0.0, help='val iou drop still published')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--once', action='store_true', help='one refresh round, e.g. from cron, instead of the service')
+    args = parser.parse_args()
+    #
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    #
+    make_folder(os.path.join(args.state, 'models'))
+    #
+    while True:
+        #
+        refresh(args)
+        #
+        if args.once is True:
+            break
+        #
+        time.sleep(args.poll)
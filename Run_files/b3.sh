@@ -1,7 +0,0 @@
-#$ -l tmem=7G
-#$ -l gpu=true
-#$ -S /bin/bash
-#$ -j y
-#$ -wd /cluster/project0/CityScapes/projects_codes/MICCAI_2020_OCT/Experiments
-
-~/anaconda3/bin/python baseline_segnet_none_none.py
\ No newline at end of file
@@ -0,0 +1,9 @@
+#$ -l tmem=28G
+#$ -l gpu=true
+#$ -pe smp 16
+#$ -S /bin/bash
+#$ -j y
+#$ -wd /cluster/project0/CityScapes/projects_codes/MICCAI_2020_OCT
+
+# submit this file to as many nodes as wanted, the nodes share Experiments/queue/ and never run the same job twice
+~/anaconda3/bin/python Experiment_queue.py Experiments/experiments.json --threads 16 --memory 28
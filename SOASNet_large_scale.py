@@ -4,6 +4,9 @@ import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 
+from NNCheckpoint import checkpointing_policy, run_stage
+from NNReparam import paired_conv
+
 
 def double_conv(in_channels, out_channels, kernel_1, kernel_2, step_1, step_2, norm):
     # ===================
@@ -74,10 +77,14 @@ def conv_block(in_channels, out_channels, kernel_h, kernel_w, step_h, step_w, pa
 
 
 class SOASNet_ls(nn.Module):
+    # groups of the strip-conv banks summed in the height and width paths, see NNReparam.merge_strip_banks
+    strip_bank_groups = (1, 2, 3, 4)
+    strip_banks_merged = False
     #
-    def __init__(self, in_ch, width, depth, norm, n_classes, side_output=False, downsampling_limit=5, mode='low_rank_attn'):
+    def __init__(self, in_ch, width, depth, norm, n_classes, side_output=False, downsampling_limit=5, mode='low_rank_attn', checkpointing=None):
         # =================================================================================================================
         # mode == 'low_rank_attn': our model
+        # checkpointing: None, 'all' or a list of 'encoder', 'decoder', 'strip', see NNCheckpoint
         # mode == 'unet': standard u-net
         # depth-wise mixed attention
         # ls: large scale
@@ -88,6 +95,7 @@ class SOASNet_ls(nn.Module):
         self.depth = depth
         self.mode = mode
         self.downsampling_stages_limit = downsampling_limit
+        self.checkpointing = checkpointing_policy(checkpointing)
 
         if n_classes == 2:
 
@@ -353,34 +361,121 @@ class SOASNet_ls(nn.Module):
 
         self.classification_layer = nn.Conv2d(width, output_channel, kernel_size=1, stride=1, padding=0, bias=True)
 
-    def forward(self, x):
 
+    def encoder_strip_banks(self, i, x_height, x_width):
+        # multi-kernel strip convolutions of the height and width paths at encoder level i
+        # the width path is transposed, both paths run together on their concatenation along the channels, see NNReparam.paired_conv
+        x = paired_conv(self.encoders_bottlenecks[i], self.encoders_bottlenecks[i], torch.cat([x_height, x_width], dim=1))
+        #
+        if i > self.downsampling_stages_limit:
+            #
+            j = i - self.downsampling_stages_limit - 1
+            #
+            if self.strip_banks_merged is True:
+                # one conv per bank, see NNReparam.merge_strip_banks
+                x = paired_conv(self.height_encoders_group_1[j], self.width_encoders_group_1[j], x)
+            else:
+                x = paired_conv(self.height_encoders_group_1[j], self.width_encoders_group_1[j], x) + paired_conv(self.height_encoders_group_2[j], self.width_encoders_group_2[j], x) + paired_conv(self.height_encoders_group_3[j], self.width_encoders_group_3[j], x) + paired_conv(self.height_encoders_group_4[j], self.width_encoders_group_4[j], x)
+            #
+        else:
+            #
+            if self.strip_banks_merged is True:
+                # one conv per bank, see NNReparam.merge_strip_banks
+                x = paired_conv(self.height_encoders_first_group_1, self.width_encoders_first_group_1, x)
+            else:
+                x = paired_conv(self.height_encoders_first_group_1, self.width_encoders_first_group_1, x) + paired_conv(self.height_encoders_first_group_2, self.width_encoders_first_group_2, x) + paired_conv(self.height_encoders_first_group_3, self.width_encoders_first_group_3, x) + paired_conv(self.height_encoders_first_group_4, self.width_encoders_first_group_4, x)
+        #
+        x_height, x_width = torch.chunk(x, 2, dim=1)
+        #
+        return x_height, x_width
+
+    def decoder_strip_banks(self, i, x_height, x_width):
+        # multi-kernel strip convolutions of the height and width paths at decoder level i
+        # the width path is transposed, both paths run together on their concatenation along the channels, see NNReparam.paired_conv
+        x = self.upsample(torch.cat([x_height, x_width], dim=1))
+        #
+        if self.strip_banks_merged is True:
+            # one conv per bank, see NNReparam.merge_strip_banks
+            x = paired_conv(self.height_decoders_group_1[i], self.width_decoders_group_1[i], x)
+        else:
+            x = paired_conv(self.height_decoders_group_1[i], self.width_decoders_group_1[i], x) + paired_conv(self.height_decoders_group_2[i], self.width_decoders_group_2[i], x) + paired_conv(self.height_decoders_group_3[i], self.width_decoders_group_3[i], x) + paired_conv(self.height_decoders_group_4[i], self.width_decoders_group_4[i], x)
+        #
+        x_height, x_width = torch.chunk(x, 2, dim=1)
+        #
+        return x_height, x_width
+
+    def attention_gate(self, x_main, x_height, x_width, scale):
+        # low rank attention of the height and width paths applied on the main path
+        # the width path is transposed already:
+        x_a = x_height * x_width
+        #
+        b, c, h, w = x_a.shape
+        #
+        if h > w:
+            #
+            x_a = torch.reshape(x_a, (b, scale*c, h // scale, w))
+            #
+        elif h < w:
+            #
+            x_a = torch.reshape(x_a, (b, scale*c, h, w // scale))
+        #
+        x_main = torch.sigmoid(x_a) * x_main + x_main
+        #
+        return x_main, x_a
+
+    def decoder_main(self, i, x_main, x_skip):
+        # main path of decoder level i
+        x_main = self.upsample(x_main)
+        #
+        return self.decoders[i](torch.cat([x_main, x_skip], dim=1))
+
+    def encoder_stage(self, i, x_main, x_height, x_width):
+        # encoder level i of the low rank attention mode
+        x_main = self.encoders[i](x_main)
+        #
+        x_height, x_width = run_stage(self, 'encoder_strip', self.encoder_strip_banks, i, x_height, x_width)
+        #
+        x_main, x_a = self.attention_gate(x_main, x_height, x_width, 2**(i+1))
+        #
+        return x_main, x_height, x_width, x_a
+
+    def decoder_stage(self, i, x_main, x_height, x_width, x_height_skip, x_width_skip, *main_skips):
+        # decoder level i of the low rank attention mode
+        x_main = self.decoder_main(i, x_main, *main_skips)
+        #
+        x_height, x_width = run_stage(self, 'decoder_strip', self.decoder_strip_banks, i, x_height + x_height_skip, x_width + x_width_skip)
+        #
+        x_main, x_a = self.attention_gate(x_main, x_height, x_width, 2**(self.depth - i))
+        #
+        return x_main, x_height, x_width, x_a
+
+    def encode(self, x, side_outputs=None):
+        # first layer and encoder levels, the part kept frozen when adapting a trained network to a new site
+        # :param side_outputs: list receiving the side outputs of the encoder levels, None for no side outputs
+        # :return: list of features, [first layer output, deepest main path output] + main path skips
+        #          + in low rank attention mode the height path and the width path features of every encoder level
         x_ = self.first_layer(x)
 
         x_main = x_
 
         encoder_features = []
 
-        if self.mode == 'low_rank_attn':
-
-            x_height = x_
+        encoder_height_features = []
 
-            x_width = x_
+        encoder_width_features = []
 
-            encoder_height_features = []
-
-            encoder_width_features = []
+        if self.mode == 'low_rank_attn':
 
-            if self.side_output_mode is True:
+            x_height = x_
 
-                side_outputs = []
+            x_width = torch.transpose(x_, 2, 3)
 
         for i in range(self.depth + 1):
 
-            x_main = self.encoders[i](x_main)
-
             if self.mode == 'single_dim_net':
 
+                x_main = self.encoders[i](x_main)
+
                 if i == 0:
 
                     single_dim_conv_start_index = 0
@@ -398,132 +493,48 @@ class SOASNet_ls(nn.Module):
                 encoder_features.append(x_height)
 
             elif self.mode == 'low_rank_attn':
-
-                if i > self.downsampling_stages_limit:
-                    #
-                    x_height = self.encoders_bottlenecks[i](x_height)
-                    #
-                    x_height_1 = self.height_encoders_group_1[i - self.downsampling_stages_limit - 1](x_height)
-                    #
-                    # print(x_height_1.shape)
-                    #
-                    x_height_2 = self.height_encoders_group_2[i - self.downsampling_stages_limit - 1](x_height)
-                    #
-                    # print(x_height_2.shape)
-                    #
-                    x_height_3 = self.height_encoders_group_3[i - self.downsampling_stages_limit - 1](x_height)
-                    #
-                    # print(x_height_3.shape)
-                    #
-                    x_height_4 = self.height_encoders_group_4[i - self.downsampling_stages_limit - 1](x_height)
-                    #
-                    # print(x_height_4.shape)
-                    #
-                    x_height = x_height_1 + x_height_2 + x_height_3 + x_height_4
-                    #
-                    # diffY = torch.tensor([x_height_1.size()[2] - x_height_2.size()[2]])
-                    # diffX = torch.tensor([y_e.size()[3] - y.size()[3]])
-                    #
-                    x_width = self.encoders_bottlenecks[i](x_width)
-                    #
-                    x_width_1 = self.width_encoders_group_1[i - self.downsampling_stages_limit - 1](x_width)
-                    #
-                    # print(x_width_1.shape)
-                    #
-                    x_width_2 = self.width_encoders_group_2[i - self.downsampling_stages_limit - 1](x_width)
-                    #
-                    # print(x_width_2.shape)
-                    #
-                    x_width_3 = self.width_encoders_group_3[i - self.downsampling_stages_limit - 1](x_width)
-                    #
-                    # print(x_width_3.shape)
-                    #
-                    x_width_4 = self.width_encoders_group_4[i - self.downsampling_stages_limit - 1](x_width)
-                    #
-                    # print(x_width_4.shape)
-                    #
-                    x_width = x_width_1 + x_width_2 + x_width_3 + x_width_4
-                    #
-                    #
-                else:
-                    #
-                    x_height = self.encoders_bottlenecks[i](x_height)
-                    #
-                    x_height_1 = self.height_encoders_first_group_1(x_height)
-                    #
-                    # print(x_height_1.shape)
-                    #
-                    x_height_2 = self.height_encoders_first_group_2(x_height)
-                    #
-                    # print(x_height_2.shape)
-                    #
-                    x_height_3 = self.height_encoders_first_group_3(x_height)
-                    #
-                    # print(x_height_3.shape)
-                    #
-                    x_height_4 = self.height_encoders_first_group_4(x_height)
-                    #
-                    # print(x_height_4.shape)
-                    #
-                    x_height = x_height_1 + x_height_2 + x_height_3 + x_height_4
-                    #
-                    # diffY = torch.tensor([x_height_1.size()[2] - x_height_2.size()[2]])
-                    # diffX = torch.tensor([y_e.size()[3] - y.size()[3]])
-                    #
-                    x_width = self.encoders_bottlenecks[i](x_width)
-                    #
-                    x_width_1 = self.width_encoders_first_group_1(x_width)
-                    #
-                    # print(x_width_1.shape)
-                    #
-                    x_width_2 = self.width_encoders_first_group_2(x_width)
-                    #
-                    # print(x_width_2.shape)
-                    #
-                    x_width_3 = self.width_encoders_first_group_3(x_width)
-                    #
-                    # print(x_width_3.shape)
-                    #
-                    x_width_4 = self.width_encoders_first_group_4(x_width)
-                    #
-                    # print(x_width_4.shape)
-                    #
-                    x_width = x_width_1 + x_width_2 + x_width_3 + x_width_4
-                    #
-                    #
+                #
+                x_main, x_height, x_width, x_a = run_stage(self, 'encoder', self.encoder_stage, i, x_main, x_height, x_width)
+                #
                 encoder_height_features.append(x_height)
                 #
                 encoder_width_features.append(x_width)
                 #
-                x_a = x_height * (torch.transpose(x_width, 2, 3))
+                if side_outputs is not None:
+                    #
+                    avg_rep = torch.mean(x_a, dim=1, keepdim=True)
+                    #
+                    side_outputs.append(avg_rep)
 
-                b, c, h, w = x_a.shape
+                encoder_features.append(x_main)
 
-                if h > w:
+            else:
 
-                    x_a = torch.reshape(x_a, (b, (2**(i+1))*c, h // (2**(i+1)), w))
+                x_main = run_stage(self, 'encoder', self.encoders[i], x_main)
 
-                elif h < w:
+                encoder_features.append(x_main)
 
-                    x_a = torch.reshape(x_a, (b, (2**(i+1))*c, h, w // (2**(i+1))))
+        # the width path features are returned in the orientation of the scans:
+        return [x_, x_main] + encoder_features + encoder_height_features + [torch.transpose(x_width, 2, 3) for x_width in encoder_width_features]
 
-                else:
+    def decode(self, features, side_outputs=None):
+        # bridge, decoder levels and classification layer, trained alone on cached features when adapting to a new site
+        # :param features: output of encode
+        # :param side_outputs: list receiving the side outputs of the decoder levels, None for no side outputs
+        # :return: logits
+        x_, x_main = features[0], features[1]
 
-                    x_a = x_a
+        encoder_features = features[2:self.depth + 3]
 
-                x_main = torch.sigmoid(x_a) * x_main + x_main
+        if self.mode == 'low_rank_attn':
 
-                if self.side_output_mode is True:
-                    #
-                    avg_rep = torch.mean(x_a, dim=1, keepdim=True)
-                    #
-                    side_outputs.append(avg_rep)
+            encoder_height_features = features[self.depth + 3:2 * self.depth + 4]
 
-                encoder_features.append(x_main)
+            encoder_width_features = [torch.transpose(x_width, 2, 3) for x_width in features[2 * self.depth + 4:]]
 
-            else:
+            x_height = encoder_height_features[-1]
 
-                encoder_features.append(x_main)
+            x_width = encoder_width_features[-1]
 
         if self.mode == 'unet' or self.mode == 'low_rank_attn':
 
@@ -536,11 +547,19 @@ class SOASNet_ls(nn.Module):
         # =================================================================================
         for i in range(self.depth):
             #
-            if self.mode == 'unet' or self.mode == 'low_rank_attn':
-
-                x_main = self.upsample(x_main)
+            if self.mode == 'low_rank_attn':
+                #
+                x_main, x_height, x_width, x_a = run_stage(self, 'decoder', self.decoder_stage, i, x_main, x_height, x_width, encoder_height_features[-i - 1], encoder_width_features[-i - 1], encoder_features[-(i + 2)])
+                #
+                if side_outputs is not None:
+                    #
+                    avg_rep = torch.mean(x_a, dim=1, keepdim=True)
+                    #
+                    side_outputs.append(avg_rep)
+                #
+            elif self.mode == 'unet':
                 #
-                x_main = self.decoders[i](torch.cat([x_main, encoder_features[-(i + 2)]], dim=1))
+                x_main = run_stage(self, 'decoder', self.decoder_main, i, x_main, encoder_features[-(i + 2)])
 
             else:
 
@@ -549,86 +568,20 @@ class SOASNet_ls(nn.Module):
                 x_main = self.decoders[i*2](x_main)
 
                 x_main = self.decoders[i*2 + 1](torch.cat([x_main, encoder_features[-(i + 2)]], dim=1))
-
-            #
-            if self.mode == 'low_rank_attn':
-                #
-                x_height = x_height + encoder_height_features[-i - 1]
-                #
-                x_width = x_width + encoder_width_features[-i - 1]
-                #
-                x_height = self.upsample(x_height)
-                #
-                x_width = self.upsample(x_width)
-                #
-                x_height_1 = self.height_decoders_group_1[i](x_height)
-                #
-                # print(x_height_1.shape)
-                #
-                x_height_2 = self.height_decoders_group_2[i](x_height)
-                #
-                # print(x_height_2.shape)
-                #
-                x_height_3 = self.height_decoders_group_3[i](x_height)
-                #
-                # print(x_height_3.shape)
-                #
-                x_height_4 = self.height_decoders_group_4[i](x_height)
-                #
-                # print(x_height_4.shape)
-                #
-                x_height = x_height_1 + x_height_2 + x_height_3 + x_height_4
-                #
-                #
-                x_width_1 = self.width_decoders_group_1[i](x_width)
-                #
-                # print(x_width_1.shape)
-                #
-                x_width_2 = self.width_decoders_group_2[i](x_width)
-                #
-                # print(x_width_2.shape)
-                #
-                x_width_3 = self.width_decoders_group_3[i](x_width)
-                #
-                # print(x_width_3.shape)
-                #
-                x_width_4 = self.width_decoders_group_4[i](x_width)
-                #
-                # print(x_width_4.shape)
-                #
-                x_width = x_width_1 + x_width_2 + x_width_3 + x_width_4
-                #
-                x_a = x_height * (torch.transpose(x_width, 2, 3))
-                #
-                b, c, h, w = x_a.shape
-                #
-                if h > w:
-                    #
-                    x_a = torch.reshape(x_a, (b, (2**(self.depth - i))*c, h // (2**(self.depth - i)), w))
-                    #
-                elif h < w:
-                    #
-                    x_a = torch.reshape(x_a, (b, (2**(self.depth - i))*c, h, w // (2**(self.depth - i))))
-                    #
-                else:
-                    #
-                    x_a = x_a
-                #
-                x_main = torch.sigmoid(x_a) * x_main + x_main
-                #
-                if self.side_output_mode is True:
-                    #
-                    avg_rep = torch.mean(x_a, dim=1, keepdim=True)
-                    #
-                    side_outputs.append(avg_rep)
-                #
+        #
         if self.mode == 'low_rank_attn' or self.mode == 'unet':
 
             x_main = self.decoder_last_conv(torch.cat([self.upsample(x_main), x_], dim=1))
         #
-        output = self.classification_layer(x_main)
+        return self.classification_layer(x_main)
+
+    def forward(self, x):
+
+        side_outputs = [] if self.side_output_mode is True and self.mode == 'low_rank_attn' else None
+
+        output = self.decode(self.encode(x, side_outputs), side_outputs)
         #
-        if self.side_output_mode is True and self.mode == 'low_rank_attn':
+        if side_outputs is not None:
             #
             return output, side_outputs
         else:
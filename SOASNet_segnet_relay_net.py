@@ -4,6 +4,9 @@ import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 
+from NNCheckpoint import checkpointing_policy, run_stage
+from NNReparam import paired_conv
+
 from NNBaselines import segnet_encoder, segnet_decoder, unpool_layer
 
 
@@ -76,10 +79,14 @@ def conv_block(in_channels, out_channels, kernel_h, kernel_w, step_h, step_w, pa
 
 
 class SOASNet_segnet_skip(nn.Module):
+    # groups of the strip-conv banks summed in the height and width paths, see NNReparam.merge_strip_banks
+    strip_bank_groups = (1, 2, 3, 4)
+    strip_banks_merged = False
     #
-    def __init__(self, in_ch, width, depth, norm, n_classes, side_output=False, downsampling_limit=5, mode='relaynet'):
+    def __init__(self, in_ch, width, depth, norm, n_classes, side_output=False, downsampling_limit=5, mode='relaynet', checkpointing=None):
         # =================================================================================================================
         # mode == 'low_rank_attn': our model
+        # checkpointing: None, 'all' or a list of 'encoder', 'decoder', 'strip', see NNCheckpoint
         # mode == 'unet': standard u-net
         # depth-wise mixed attention
         # ==============================
@@ -89,6 +96,7 @@ class SOASNet_segnet_skip(nn.Module):
         self.depth = depth
         self.mode = mode
         self.downsampling_stages_limit = downsampling_limit
+        self.checkpointing = checkpointing_policy(checkpointing)
 
         if n_classes == 2:
 
@@ -365,6 +373,94 @@ class SOASNet_segnet_skip(nn.Module):
 
         self.classification_layer = nn.Conv2d(width, output_channel, kernel_size=1, stride=1, padding=0, bias=True)
 
+
+    def encoder_strip_banks(self, i, x_height, x_width):
+        # multi-kernel strip convolutions of the height and width paths at encoder level i
+        # the width path is transposed, both paths run together on their concatenation along the channels, see NNReparam.paired_conv
+        x = paired_conv(self.encoders_bottlenecks[i], self.encoders_bottlenecks[i], torch.cat([x_height, x_width], dim=1))
+        #
+        if i > self.downsampling_stages_limit:
+            #
+            j = i - self.downsampling_stages_limit - 1
+            #
+            if self.strip_banks_merged is True:
+                # one conv per bank, see NNReparam.merge_strip_banks
+                x = paired_conv(self.height_encoders_group_1[j], self.width_encoders_group_1[j], x)
+            else:
+                x = paired_conv(self.height_encoders_group_1[j], self.width_encoders_group_1[j], x) + paired_conv(self.height_encoders_group_2[j], self.width_encoders_group_2[j], x) + paired_conv(self.height_encoders_group_3[j], self.width_encoders_group_3[j], x) + paired_conv(self.height_encoders_group_4[j], self.width_encoders_group_4[j], x)
+            #
+        else:
+            #
+            if self.strip_banks_merged is True:
+                # one conv per bank, see NNReparam.merge_strip_banks
+                x = paired_conv(self.height_encoders_first_group_1, self.width_encoders_first_group_1, x)
+            else:
+                x = paired_conv(self.height_encoders_first_group_1, self.width_encoders_first_group_1, x) + paired_conv(self.height_encoders_first_group_2, self.width_encoders_first_group_2, x) + paired_conv(self.height_encoders_first_group_3, self.width_encoders_first_group_3, x) + paired_conv(self.height_encoders_first_group_4, self.width_encoders_first_group_4, x)
+        #
+        x_height, x_width = torch.chunk(x, 2, dim=1)
+        #
+        return x_height, x_width
+
+    def decoder_strip_banks(self, i, x_height, x_width):
+        # multi-kernel strip convolutions of the height and width paths at decoder level i
+        # the width path is transposed, both paths run together on their concatenation along the channels, see NNReparam.paired_conv
+        x = self.upsample(torch.cat([x_height, x_width], dim=1))
+        #
+        if self.strip_banks_merged is True:
+            # one conv per bank, see NNReparam.merge_strip_banks
+            x = paired_conv(self.height_decoders_group_1[i], self.width_decoders_group_1[i], x)
+        else:
+            x = paired_conv(self.height_decoders_group_1[i], self.width_decoders_group_1[i], x) + paired_conv(self.height_decoders_group_2[i], self.width_decoders_group_2[i], x) + paired_conv(self.height_decoders_group_3[i], self.width_decoders_group_3[i], x) + paired_conv(self.height_decoders_group_4[i], self.width_decoders_group_4[i], x)
+        #
+        x_height, x_width = torch.chunk(x, 2, dim=1)
+        #
+        return x_height, x_width
+
+    def attention_gate(self, x_main, x_height, x_width, scale):
+        # low rank attention of the height and width paths applied on the main path
+        # the width path is transposed already:
+        x_a = x_height * x_width
+        #
+        b, c, h, w = x_a.shape
+        #
+        if h > w:
+            #
+            x_a = torch.reshape(x_a, (b, scale*c, h // scale, w))
+            #
+        elif h < w:
+            #
+            x_a = torch.reshape(x_a, (b, scale*c, h, w // scale))
+        #
+        x_main = torch.sigmoid(x_a) * x_main + x_main
+        #
+        return x_main, x_a
+
+    def decoder_main(self, i, x_main, x_skip, indices, pool_shape):
+        # main path of decoder level i
+        x_main = self.decoders_unpooling[i](x_main, indices, pool_shape)
+        #
+        return self.decoders[i](torch.cat([x_main, x_skip], dim=1))
+
+    def encoder_stage(self, i, x_main, x_height, x_width):
+        # encoder level i of the low rank attention mode
+        x_main, indice, shape = self.encoders[i](x_main)
+        #
+        x_height, x_width = run_stage(self, 'encoder_strip', self.encoder_strip_banks, i, x_height, x_width)
+        #
+        x_main, x_a = self.attention_gate(x_main, x_height, x_width, 2**(i+1))
+        #
+        return x_main, indice, shape, x_height, x_width, x_a
+
+    def decoder_stage(self, i, x_main, x_height, x_width, x_height_skip, x_width_skip, *main_skips):
+        # decoder level i of the low rank attention mode
+        x_main = self.decoder_main(i, x_main, *main_skips)
+        #
+        x_height, x_width = run_stage(self, 'decoder_strip', self.decoder_strip_banks, i, x_height + x_height_skip, x_width + x_width_skip)
+        #
+        x_main, x_a = self.attention_gate(x_main, x_height, x_width, 2**(self.depth - i))
+        #
+        return x_main, x_height, x_width, x_a
+
     def forward(self, x):
 
         x_ = self.first_layer(x)
@@ -379,7 +475,7 @@ class SOASNet_segnet_skip(nn.Module):
 
             x_height = x_
 
-            x_width = x_
+            x_width = torch.transpose(x_, 2, 3)
 
             encoder_height_features = []
 
@@ -391,128 +487,18 @@ class SOASNet_segnet_skip(nn.Module):
 
         for i in range(self.depth + 1):
 
-            x_main, indice, shape = self.encoders[i](x_main)
-            encoder_indices.append(indice)
-            encoder_pool_shapes.append(shape)
-
             if self.mode == 'low_rank_attn':
-
-                if i > self.downsampling_stages_limit:
-                    #
-                    x_height = self.encoders_bottlenecks[i](x_height)
-                    #
-                    x_height_1 = self.height_encoders_group_1[i - self.downsampling_stages_limit - 1](x_height)
-                    #
-                    # print(x_height_1.shape)
-                    #
-                    x_height_2 = self.height_encoders_group_2[i - self.downsampling_stages_limit - 1](x_height)
-                    #
-                    # print(x_height_2.shape)
-                    #
-                    x_height_3 = self.height_encoders_group_3[i - self.downsampling_stages_limit - 1](x_height)
-                    #
-                    # print(x_height_3.shape)
-                    #
-                    x_height_4 = self.height_encoders_group_4[i - self.downsampling_stages_limit - 1](x_height)
-                    #
-                    # print(x_height_4.shape)
-                    #
-                    x_height = x_height_1 + x_height_2 + x_height_3 + x_height_4
-                    #
-                    # diffY = torch.tensor([x_height_1.size()[2] - x_height_2.size()[2]])
-                    # diffX = torch.tensor([y_e.size()[3] - y.size()[3]])
-                    #
-                    x_width = self.encoders_bottlenecks[i](x_width)
-                    #
-                    x_width_1 = self.width_encoders_group_1[i - self.downsampling_stages_limit - 1](x_width)
-                    #
-                    # print(x_width_1.shape)
-                    #
-                    x_width_2 = self.width_encoders_group_2[i - self.downsampling_stages_limit - 1](x_width)
-                    #
-                    # print(x_width_2.shape)
-                    #
-                    x_width_3 = self.width_encoders_group_3[i - self.downsampling_stages_limit - 1](x_width)
-                    #
-                    # print(x_width_3.shape)
-                    #
-                    x_width_4 = self.width_encoders_group_4[i - self.downsampling_stages_limit - 1](x_width)
-                    #
-                    # print(x_width_4.shape)
-                    #
-                    x_width = x_width_1 + x_width_2 + x_width_3 + x_width_4
-                    #
-                    #
-                else:
-                    #
-                    x_height = self.encoders_bottlenecks[i](x_height)
-                    #
-                    x_height_1 = self.height_encoders_first_group_1(x_height)
-                    #
-                    # print(x_height_1.shape)
-                    #
-                    x_height_2 = self.height_encoders_first_group_2(x_height)
-                    #
-                    # print(x_height_2.shape)
-                    #
-                    x_height_3 = self.height_encoders_first_group_3(x_height)
-                    #
-                    # print(x_height_3.shape)
-                    #
-                    x_height_4 = self.height_encoders_first_group_4(x_height)
-                    #
-                    # print(x_height_4.shape)
-                    #
-                    x_height = x_height_1 + x_height_2 + x_height_3 + x_height_4
-                    #
-                    # diffY = torch.tensor([x_height_1.size()[2] - x_height_2.size()[2]])
-                    # diffX = torch.tensor([y_e.size()[3] - y.size()[3]])
-                    #
-                    x_width = self.encoders_bottlenecks[i](x_width)
-                    #
-                    x_width_1 = self.width_encoders_first_group_1(x_width)
-                    #
-                    # print(x_width_1.shape)
-                    #
-                    x_width_2 = self.width_encoders_first_group_2(x_width)
-                    #
-                    # print(x_width_2.shape)
-                    #
-                    x_width_3 = self.width_encoders_first_group_3(x_width)
-                    #
-                    # print(x_width_3.shape)
-                    #
-                    x_width_4 = self.width_encoders_first_group_4(x_width)
-                    #
-                    # print(x_width_4.shape)
-                    #
-                    x_width = x_width_1 + x_width_2 + x_width_3 + x_width_4
-                    #
-                    #
-                encoder_height_features.append(x_height)
                 #
-                encoder_width_features.append(x_width)
+                x_main, indice, shape, x_height, x_width, x_a = run_stage(self, 'encoder', self.encoder_stage, i, x_main, x_height, x_width)
                 #
-                x_a = x_height * (torch.transpose(x_width, 2, 3))
+                encoder_indices.append(indice)
                 #
-                # print(x_a.shape)
+                encoder_pool_shapes.append(shape)
+                #
+                encoder_height_features.append(x_height)
+                #
+                encoder_width_features.append(x_width)
                 #
-                b, c, h, w = x_a.shape
-
-                if h > w:
-
-                    x_a = torch.reshape(x_a, (b, (2**(i+1))*c, h // (2**(i+1)), w))
-
-                elif h < w:
-
-                    x_a = torch.reshape(x_a, (b, (2**(i+1))*c, h, w // (2**(i+1))))
-
-                else:
-
-                    x_a = x_a
-
-                x_main = torch.sigmoid(x_a) * x_main + x_main
-
                 if self.side_output_mode is True:
                     #
                     avg_rep = torch.mean(x_a, dim=1, keepdim=True)
@@ -523,6 +509,12 @@ class SOASNet_segnet_skip(nn.Module):
 
             else:
 
+                x_main, indice, shape = run_stage(self, 'encoder', self.encoders[i], x_main)
+
+                encoder_indices.append(indice)
+
+                encoder_pool_shapes.append(shape)
+
                 encoder_features.append(x_main)
 
         if self.mode == 'low_rank_attn':
@@ -536,77 +528,9 @@ class SOASNet_segnet_skip(nn.Module):
         # =================================================================================
         for i in range(self.depth):
             #
-            if self.mode == 'relaynet' or self.mode == 'low_rank_attn':
-                #
-                x_main = self.decoders_unpooling[i](x_main, encoder_indices[self.depth - i], encoder_pool_shapes[self.depth - i])
-                #
-                x_main = self.decoders[i](torch.cat([x_main, encoder_features[-(i + 2)]], dim=1))
-            #
             if self.mode == 'low_rank_attn':
                 #
-                x_height = x_height + encoder_height_features[-i - 1]
-                #
-                x_width = x_width + encoder_width_features[-i - 1]
-                #
-                x_height = self.upsample(x_height)
-                #
-                x_width = self.upsample(x_width)
-                #
-                x_height_1 = self.height_decoders_group_1[i](x_height)
-                #
-                # print(x_height_1.shape)
-                #
-                x_height_2 = self.height_decoders_group_2[i](x_height)
-                #
-                # print(x_height_2.shape)
-                #
-                x_height_3 = self.height_decoders_group_3[i](x_height)
-                #
-                # print(x_height_3.shape)
-                #
-                x_height_4 = self.height_decoders_group_4[i](x_height)
-                #
-                # print(x_height_4.shape)
-                #
-                x_height = x_height_1 + x_height_2 + x_height_3 + x_height_4
-                #
-                #
-                x_width_1 = self.width_decoders_group_1[i](x_width)
-                #
-                # print(x_width_1.shape)
-                #
-                x_width_2 = self.width_decoders_group_2[i](x_width)
-                #
-                # print(x_width_2.shape)
-                #
-                x_width_3 = self.width_decoders_group_3[i](x_width)
-                #
-                # print(x_width_3.shape)
-                #
-                x_width_4 = self.width_decoders_group_4[i](x_width)
-                #
-                # print(x_width_4.shape)
-                #
-                x_width = x_width_1 + x_width_2 + x_width_3 + x_width_4
-                #
-                x_a = x_height * (torch.transpose(x_width, 2, 3))
-                #
-                b, c, h, w = x_a.shape
-                #
-                #
-                if h > w:
-                    #
-                    x_a = torch.reshape(x_a, (b, (2**(self.depth - i))*c, h // (2**(self.depth - i)), w))
-                    #
-                elif h < w:
-                    #
-                    x_a = torch.reshape(x_a, (b, (2**(self.depth - i))*c, h, w // (2**(self.depth - i))))
-                    #
-                else:
-                    #
-                    x_a = x_a
-                #
-                x_main = torch.sigmoid(x_a) * x_main + x_main
+                x_main, x_height, x_width, x_a = run_stage(self, 'decoder', self.decoder_stage, i, x_main, x_height, x_width, encoder_height_features[-i - 1], encoder_width_features[-i - 1], encoder_features[-(i + 2)], encoder_indices[self.depth - i], encoder_pool_shapes[self.depth - i])
                 #
                 if self.side_output_mode is True:
                     #
@@ -614,6 +538,10 @@ class SOASNet_segnet_skip(nn.Module):
                     #
                     side_outputs.append(avg_rep)
                 #
+            elif self.mode == 'relaynet':
+                #
+                x_main = run_stage(self, 'decoder', self.decoder_main, i, x_main, encoder_features[-(i + 2)], encoder_indices[self.depth - i], encoder_pool_shapes[self.depth - i])
+        #
         if self.mode == 'low_rank_attn' or self.mode == 'relaynet':
 
             x_main = self.decoder_last_conv(torch.cat([self.upsample(x_main), x_], dim=1))
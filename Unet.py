@@ -113,15 +113,24 @@ class UNet(nn.Module):
         # self.up4 = Up(32, 16, bilinear)
         # self.outc = OutConv(16, n_classes)
 
-    def forward(self, x):
+    def encode(self, x):
+        """Contracting path, the part kept frozen when adapting a trained network to a new site"""
         x1 = self.inc(x)
         x2 = self.down1(x1)
         x3 = self.down2(x2)
         x4 = self.down3(x3)
         x5 = self.down4(x4)
+        return [x1, x2, x3, x4, x5]
+
+    def decode(self, features):
+        """Expanding path and output layer from the features of encode"""
+        x1, x2, x3, x4, x5 = features
         x = self.up1(x5, x4)
         x = self.up2(x, x3)
         x = self.up3(x, x2)
         x = self.up4(x, x1)
         logits = self.outc(x)
-        return logits
\ No newline at end of file
+        return logits
+
+    def forward(self, x):
+        return self.decode(self.encode(x))
\ No newline at end of file
@@ -21,6 +21,9 @@ class AdamW(Optimizer):
         amsgrad (boolean, optional): whether to use the AMSGrad variant of this
             algorithm from the paper `On the Convergence of Adam and Beyond`_
             (default: False)
+        foreach (boolean, optional): whether to update all the parameters of a
+            group together with the multi-tensor torch._foreach kernels instead
+            of one parameter at a time, the results are the same (default: True)
 
     .. _Adam\: A Method for Stochastic Optimization:
         https://arxiv.org/abs/1412.6980
@@ -31,7 +34,7 @@ class AdamW(Optimizer):
     """
 
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=1e-2, amsgrad=False):
+                 weight_decay=1e-2, amsgrad=False, foreach=True):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -41,13 +44,76 @@ class AdamW(Optimizer):
         if not 0.0 <= betas[1] < 1.0:
             raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
         defaults = dict(lr=lr, betas=betas, eps=eps,
-                        weight_decay=weight_decay, amsgrad=amsgrad)
+                        weight_decay=weight_decay, amsgrad=amsgrad, foreach=foreach)
         super(AdamW, self).__init__(params, defaults)
 
     def __setstate__(self, state):
         super(AdamW, self).__setstate__(state)
         for group in self.param_groups:
             group.setdefault('amsgrad', False)
+            group.setdefault('foreach', True)
+
+    def _init_state(self, p, amsgrad):
+        state = self.state[p]
+        if len(state) == 0:
+            state['step'] = 0
+            # Exponential moving average of gradient values
+            state['exp_avg'] = torch.zeros_like(p.data)
+            # Exponential moving average of squared gradient values
+            state['exp_avg_sq'] = torch.zeros_like(p.data)
+            if amsgrad:
+                # Maintains max of all exp. moving avg. of sq. grad. values
+                state['max_exp_avg_sq'] = torch.zeros_like(p.data)
+        return state
+
+    def _foreach_step(self, group):
+        # the steps of all the parameters of the group, one kernel per operation for all the tensors of a device and dtype
+        amsgrad = group['amsgrad']
+        beta1, beta2 = group['betas']
+        tensors = {}
+
+        for p in group['params']:
+            if p.grad is None:
+                continue
+            if p.grad.is_sparse:
+                raise RuntimeError('Adam does not support sparse gradients, please consider SparseAdam instead')
+
+            state = self._init_state(p, amsgrad)
+            state['step'] += 1
+
+            lists = tensors.setdefault((p.device, p.dtype), {'params': [], 'grads': [], 'exp_avgs': [], 'exp_avg_sqs': [],
+                                                             'max_exp_avg_sqs': [], 'step_sizes': [], 'bias_corrections2': []})
+            lists['params'].append(p.data)
+            lists['grads'].append(p.grad.data)
+            lists['exp_avgs'].append(state['exp_avg'])
+            lists['exp_avg_sqs'].append(state['exp_avg_sq'])
+            if amsgrad:
+                lists['max_exp_avg_sqs'].append(state['max_exp_avg_sq'])
+            # steps may differ between parameters, e.g. a parameter added to the group later:
+            lists['step_sizes'].append(-group['lr'] / (1 - beta1 ** state['step']))
+            lists['bias_corrections2'].append(math.sqrt(1 - beta2 ** state['step']))
+
+        for lists in tensors.values():
+            # Perform stepweight decay
+            torch._foreach_mul_(lists['params'], 1 - group['lr'] * group['weight_decay'])
+
+            # Decay the first and second moment running average coefficient
+            torch._foreach_mul_(lists['exp_avgs'], beta1)
+            torch._foreach_add_(lists['exp_avgs'], lists['grads'], alpha=1 - beta1)
+            torch._foreach_mul_(lists['exp_avg_sqs'], beta2)
+            torch._foreach_addcmul_(lists['exp_avg_sqs'], lists['grads'], lists['grads'], value=1 - beta2)
+
+            if amsgrad:
+                # Maintains the maximum of all 2nd moment running avg. till now
+                torch._foreach_maximum_(lists['max_exp_avg_sqs'], lists['exp_avg_sqs'])
+                denom = torch._foreach_sqrt(lists['max_exp_avg_sqs'])
+            else:
+                denom = torch._foreach_sqrt(lists['exp_avg_sqs'])
+
+            torch._foreach_div_(denom, lists['bias_corrections2'])
+            torch._foreach_add_(denom, group['eps'])
+
+            torch._foreach_addcdiv_(lists['params'], lists['exp_avgs'], denom, lists['step_sizes'])
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -61,6 +127,11 @@ class AdamW(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            # groups of optimizer states saved before the multi-tensor path have no 'foreach':
+            if group.get('foreach', True):
+                self._foreach_step(group)
+                continue
+
             for p in group['params']:
                 if p.grad is None:
                     continue
@@ -74,18 +145,8 @@ class AdamW(Optimizer):
                     raise RuntimeError('Adam does not support sparse gradients, please consider SparseAdam instead')
                 amsgrad = group['amsgrad']
 
-                state = self.state[p]
-
                 # State initialization
-                if len(state) == 0:
-                    state['step'] = 0
-                    # Exponential moving average of gradient values
-                    state['exp_avg'] = torch.zeros_like(p.data)
-                    # Exponential moving average of squared gradient values
-                    state['exp_avg_sq'] = torch.zeros_like(p.data)
-                    if amsgrad:
-                        # Maintains max of all exp. moving avg. of sq. grad. values
-                        state['max_exp_avg_sq'] = torch.zeros_like(p.data)
+                state = self._init_state(p, amsgrad)
 
                 exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
                 if amsgrad:
@@ -97,8 +158,8 @@ class AdamW(Optimizer):
                 bias_correction2 = 1 - beta2 ** state['step']
 
                 # Decay the first and second moment running average coefficient
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
+                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
                 if amsgrad:
                     # Maintains the maximum of all 2nd moment running avg. till now
                     torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
@@ -109,6 +170,183 @@ class AdamW(Optimizer):
 
                 step_size = group['lr'] / bias_correction1
 
-                p.data.addcdiv_(-step_size, exp_avg, denom)
+                p.data.addcdiv_(exp_avg, denom, value=-step_size)
+
+        return loss
+
+class Lamb(Optimizer):
+
+    r"""Implements the LAMB algorithm, layer-wise adaptive Adam for large batches.
+
+    It was proposed in `Large Batch Optimization for Deep Learning: Training BERT in 76 minutes`_.
+    The Adam update of every parameter tensor is scaled by the trust ratio
+    ||p|| / ||update||, so each layer moves by a similar fraction of its own
+    norm whatever the batch size. The weight decay is decoupled as in AdamW:
+    p is multiplied by 1 - lr * weight_decay, outside of the trust ratio.
+
+    Arguments:
+        params (iterable): iterable of parameters to optimize or dicts defining
+            parameter groups
+        lr (float, optional): learning rate (default: 1e-3)
+        betas (Tuple[float, float], optional): coefficients used for computing
+            running averages of gradient and its square (default: (0.9, 0.999))
+        eps (float, optional): term added to the denominator to improve
+            numerical stability (default: 1e-6)
+        weight_decay (float, optional): weight decay coefficient (default: 1e-2)
+        trust_clip (float, optional): upper bound of the trust ratio (default: 10)
+
+    .. _Large Batch Optimization for Deep Learning\: Training BERT in 76 minutes:
+        https://arxiv.org/abs/1904.00962
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-6,
+                 weight_decay=1e-2, trust_clip=10.0):
+        if not 0.0 <= lr:
+            raise ValueError("Invalid learning rate: {}".format(lr))
+        if not 0.0 <= eps:
+            raise ValueError("Invalid epsilon value: {}".format(eps))
+        if not 0.0 <= betas[0] < 1.0:
+            raise ValueError("Invalid beta parameter at index 0: {}".format(betas[0]))
+        if not 0.0 <= betas[1] < 1.0:
+            raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
+        defaults = dict(lr=lr, betas=betas, eps=eps,
+                        weight_decay=weight_decay, trust_clip=trust_clip)
+        super(Lamb, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        """Performs a single optimization step.
+
+        Arguments:
+            closure (callable, optional): A closure that reevaluates the model
+                and returns the loss.
+        """
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+
+                grad = p.grad
+                if grad.is_sparse:
+                    raise RuntimeError('Lamb does not support sparse gradients')
+
+                # Perform stepweight decay
+                p.mul_(1 - group['lr'] * group['weight_decay'])
+
+                state = self.state[p]
+
+                # State initialization
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(p)
+                    state['exp_avg_sq'] = torch.zeros_like(p)
+
+                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+
+                state['step'] += 1
+                bias_correction1 = 1 - beta1 ** state['step']
+                bias_correction2 = 1 - beta2 ** state['step']
+
+                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+
+                update = (exp_avg / bias_correction1) / (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(group['eps'])
+
+                # layer-wise trust ratio, 1 for tensors of zero norm (e.g. biases at initialisation):
+                weight_norm = p.norm()
+                update_norm = update.norm()
+                trust_ratio = torch.where((weight_norm > 0) & (update_norm > 0),
+                                          (weight_norm / update_norm).clamp(max=group['trust_clip']),
+                                          torch.ones_like(weight_norm))
+
+                p.add_(update * trust_ratio, alpha=-group['lr'])
+
+        return loss
+
+
+class Lars(Optimizer):
+
+    r"""Implements LARS, layer-wise adaptive SGD with momentum for large batches.
+
+    It was proposed in `Large Batch Training of Convolutional Networks`_.
+    The gradient of every parameter tensor is scaled by the local learning rate
+    trust_coefficient * ||p|| / ||grad|| before the momentum. The weight decay
+    is decoupled as in AdamW: p is multiplied by 1 - lr * weight_decay.
+
+    Arguments:
+        params (iterable): iterable of parameters to optimize or dicts defining
+            parameter groups
+        lr (float, optional): learning rate (default: 1e-1)
+        momentum (float, optional): momentum factor (default: 0.9)
+        weight_decay (float, optional): weight decay coefficient (default: 1e-2)
+        trust_coefficient (float, optional): trust coefficient of the local
+            learning rate (default: 1e-3)
+        eps (float, optional): term added to the denominator to improve
+            numerical stability (default: 1e-8)
+
+    .. _Large Batch Training of Convolutional Networks:
+        https://arxiv.org/abs/1708.03888
+    """
+
+    def __init__(self, params, lr=1e-1, momentum=0.9, weight_decay=1e-2,
+                 trust_coefficient=1e-3, eps=1e-8):
+        if not 0.0 <= lr:
+            raise ValueError("Invalid learning rate: {}".format(lr))
+        if not 0.0 <= momentum < 1.0:
+            raise ValueError("Invalid momentum value: {}".format(momentum))
+        if not 0.0 < trust_coefficient:
+            raise ValueError("Invalid trust coefficient: {}".format(trust_coefficient))
+        defaults = dict(lr=lr, momentum=momentum, weight_decay=weight_decay,
+                        trust_coefficient=trust_coefficient, eps=eps)
+        super(Lars, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        """Performs a single optimization step.
+
+        Arguments:
+            closure (callable, optional): A closure that reevaluates the model
+                and returns the loss.
+        """
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+
+                grad = p.grad
+                if grad.is_sparse:
+                    raise RuntimeError('Lars does not support sparse gradients')
+
+                # Perform stepweight decay
+                p.mul_(1 - group['lr'] * group['weight_decay'])
+
+                # layer-wise local learning rate, 1 for tensors of zero norm (e.g. biases at initialisation):
+                weight_norm = p.norm()
+                grad_norm = grad.norm()
+                local_lr = torch.where((weight_norm > 0) & (grad_norm > 0),
+                                       group['trust_coefficient'] * weight_norm / (grad_norm + group['eps']),
+                                       torch.ones_like(weight_norm))
+
+                state = self.state[p]
+
+                if len(state) == 0:
+                    state['momentum_buffer'] = torch.zeros_like(p)
+
+                buf = state['momentum_buffer']
+                buf.mul_(group['momentum']).add_(grad * local_lr)
+
+                p.add_(buf, alpha=-group['lr'])
 
-        return loss
\ No newline at end of file
+        return loss
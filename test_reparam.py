@@ -0,0 +1,73 @@
+import copy
+import pytest
+import torch
+
+from NNReparam import merge_strip_banks, strip_banks
+from SOASNet_basic import SOASNet
+from SOASNet_large_scale import SOASNet_ls
+from SOASNet_very_large_scale import SOASNet_vls
+from SOASNet_multi_attention import SOASNet_ma
+from SOASNet_segnet_back import SOASNet_segnet
+from SOASNet_segnet_relay_net import SOASNet_segnet_skip
+from SOASNet_single_scale import SOASNet_ss
+# ==========================================================================
+# Parity of the merged strip-conv banks (NNReparam.merge_strip_banks) with
+# the original banks, for every SOASNet variant, in float64: the merged
+# network must give the outputs of the original one up to rounding.
+# Run with: python -m pytest -q test_reparam.py
+# ==========================================================================
+
+variants = [SOASNet, SOASNet_ls, SOASNet_vls, SOASNet_ma, SOASNet_segnet, SOASNet_segnet_skip, SOASNet_ss]
+
+
+def flat_outputs(outputs):
+    # :return: list of the output tensors, the side outputs included
+    if isinstance(outputs, (tuple, list)):
+        return [tensor for output in outputs for tensor in flat_outputs(output)]
+    #
+    return [outputs]
+
+
+def random_network(network, side_output, seed=0):
+    # :return: network in float64 and eval mode with random weights and BatchNorm statistics
+    torch.manual_seed(seed)
+    model = network(in_ch=1, width=16, depth=3, norm='bn', n_classes=4, side_output=side_output, downsampling_limit=6, mode='low_rank_attn').double()
+    #
+    with torch.no_grad():
+        #
+        for parameter in model.parameters():
+            parameter.add_(torch.randn_like(parameter) * 0.1)
+        #
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                module.running_mean.normal_(0, 0.1)
+                module.running_var.uniform_(0.5, 1.5)
+    #
+    return model.eval()
+
+
+@pytest.mark.parametrize('side_output', [False, True])
+@pytest.mark.parametrize('network', variants, ids=[network.__name__ for network in variants])
+def test_merged_strip_banks(network, side_output):
+    model = random_network(network, side_output)
+    merged = merge_strip_banks(copy.deepcopy(model))
+    #
+    # a single-scale network has one conv per bank, it is left as it is:
+    assert merged.strip_banks_merged is (len(network.strip_bank_groups) > 1)
+    #
+    for bank in strip_banks:
+        for group in network.strip_bank_groups[1:]:
+            assert getattr(merged, bank + '_group_' + str(group), None) is None
+    #
+    images = torch.randn(2, 1, 64, 64, dtype=torch.float64)
+    #
+    with torch.no_grad():
+        outputs = flat_outputs(model(images))
+        merged_outputs = flat_outputs(merged(images))
+    #
+    assert len(outputs) == len(merged_outputs)
+    assert (len(outputs) > 1) is side_output
+    #
+    for output, merged_output in zip(outputs, merged_outputs):
+        assert output.shape == merged_output.shape
+        assert torch.allclose(output, merged_output, rtol=1e-10, atol=1e-10)